@@ -1,25 +1,37 @@
-from src.WADViewer import WadViewer
-from src.WADParser import WAD_file
+import io
 import matplotlib.pyplot as plt
 from loguru import logger
-import os
 import streamlit as st
-from app_utils import banner_html
+from app_utils import banner_html, get_wad_cache
+from src.prewarm import PrewarmJob
+from src.wad_cache import wad_digest
 
 
 def get_titlepic(viewer):
+    """Title picture of the WAD, as PNG data."""
+    if "TITLEPIC" not in viewer.wad.lump_names and "TITLE" not in viewer.wad.lump_names:
+        return None
+
     fig, ax = plt.subplots(1, 1, figsize=(1.6, 1))
     fig.patch.set_alpha(0)
     ax.axis("off")
 
     if "TITLEPIC" in viewer.wad.lump_names:
         viewer.draw_patch("TITLEPIC", ax=ax)
-    elif "TITLE" in viewer.wad.lump_names:
-        viewer.draw_flat("TITLE", ax=ax)
     else:
-        return None
+        viewer.draw_flat("TITLE", ax=ax)
 
-    return fig
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=300, bbox_inches="tight", transparent=True)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+@st.fragment(run_every=2)
+def show_prewarm_progress():
+    job = st.session_state["prewarm"]
+    if job is not None and not job.finished:
+        st.progress(job.done / max(job.total, 1), text=f"Preparing {job.current or '...'} ({job.done}/{job.total})")
 
 
 def init_app():
@@ -27,7 +39,11 @@ def init_app():
         st.session_state["wad"] = None
         st.session_state["viewer"] = None
         st.session_state["wad_path"] = None
+        st.session_state["wad_digest"] = None
+        # Key of the upload widget, changed to drop each upload once it is parsed.
+        st.session_state["uploader_key"] = 0
         st.session_state["title_pic"] = None
+        st.session_state["prewarm"] = None
 
 
 st.set_page_config(page_title="WAD Viewer",
@@ -46,26 +62,45 @@ with head_container:
     head_col1, head_col2 = st.columns([1, 1])
 with head_col1:
     uploaded_file = st.file_uploader(
-        "Upload a WAD file to get started.", accept_multiple_files=False)
+        "Upload a WAD file to get started.", accept_multiple_files=False,
+        key=f"uploader_{st.session_state['uploader_key']}")
+    if uploaded_file is None and st.session_state["wad_path"] is not None:
+        st.caption(f"Showing {st.session_state['wad_path']}.")
 
+# Parsed WADs are shared by all the sessions, keyed by the hash of their content.
+# A session only keeps references to the shared WAD and viewer, and the digest of their cache entry.
 if uploaded_file is not None:
-    if uploaded_file.name != st.session_state["wad_path"]:
-
-        wad = WAD_file(uploaded_file)
-        st.session_state["wad"] = wad
-        st.session_state["wad_path"] = uploaded_file.name
-        st.session_state["viewer"] = WadViewer(wad)
-        logger.info("App: WAD file uploaded.")
+    # The upload is hashed and parsed without copying it, large WADs being spooled to disk by the cache.
+    digest = wad_digest(uploaded_file.getbuffer())
+    entry = get_wad_cache().load(uploaded_file, digest)
+    st.session_state["wad"] = entry.wad
+    st.session_state["wad_path"] = uploaded_file.name
+    st.session_state["wad_digest"] = digest
+    st.session_state["viewer"] = entry.viewer
+    logger.info("App: WAD file uploaded.")
+
+    if "title_pic" not in entry.extras:
         try:
-            pic = get_titlepic(st.session_state["viewer"])
+            entry.extras["title_pic"] = get_titlepic(entry.viewer)
         except:
-            pic = None
-        st.session_state["title_pic"] = pic
-
-        # Cleaning the output folder.
-        for f in os.listdir("output"):
-            if f != ".gitkeep":
-                os.remove(os.path.join("output", f))
+            entry.extras["title_pic"] = None
+    st.session_state["title_pic"] = entry.extras["title_pic"]
+
+    # Maps, thumbnails and musics are prepared in the background, as soon as the WAD is loaded.
+    # The job of a WAD is shared by its sessions: the job of the previous WAD of this session is released,
+    # and only stops when no other session uses it.
+    if "prewarm" not in entry.extras:
+        entry.extras.setdefault("prewarm", PrewarmJob(entry.viewer))
+    job = entry.extras["prewarm"]
+    if st.session_state["prewarm"] is not job:
+        if st.session_state["prewarm"] is not None:
+            st.session_state["prewarm"].release()
+        job.acquire()
+        st.session_state["prewarm"] = job
+
+    # The upload is not kept by the widget once parsed: the uploader is reset, which drops its bytes.
+    st.session_state["uploader_key"] += 1
+    st.rerun()
 
 if st.session_state["wad"] is None:
     for col in st.columns(5):
@@ -80,9 +115,7 @@ if st.session_state["wad"] is None:
 else:
     if st.session_state["title_pic"] is not None:
         with head_col2:
-            st.pyplot(
-                st.session_state["title_pic"], format="png", dpi=300, bbox_inches="tight", use_container_width=True
-            )
+            st.image(st.session_state["title_pic"], use_container_width=True, output_format="PNG")
     pages = []
     if st.session_state["wad"].maps is not None:
         pages.append(st.Page("st_pages/maps.py", title="Maps"))
@@ -98,4 +131,7 @@ else:
         pages.append(st.Page("st_pages/sounds.py", title="Sounds"))
     pg = st.navigation(pages)
 
+    with st.sidebar:
+        show_prewarm_progress()
+
     pg.run()
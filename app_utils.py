@@ -1,4 +1,11 @@
 import base64
+import uuid
+
+import streamlit as st
+from loguru import logger
+
+from src.session_store import SessionStore, SessionStores
+from src.wad_cache import WadCache
 
 def image_to_base64(img_path):
     with open(img_path, "rb") as f:
@@ -25,3 +32,56 @@ banner_html = """
     }
 </style>
 """
+
+
+@st.cache_resource
+def get_wad_cache() -> WadCache:
+    """Parsed WADs shared by every session of the app process."""
+    return WadCache()
+
+
+@st.cache_resource
+def get_session_stores() -> SessionStores:
+    """Exported assets of every session of the app process, kept apart."""
+    return SessionStores(ttl=3600, max_bytes=64 * 1024**2, spill=True)
+
+
+def get_session_store() -> SessionStore:
+    """Asset store of the current session."""
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return get_session_stores().get(st.session_state["session_id"])
+
+
+def _show_more(state_key: str, page_size: int):
+    st.session_state[state_key] += page_size
+
+
+def show_gallery(kind: str, names: list[str], key: str | None = None, ncols: int = 8, page_size: int = 48,
+                 max_size: int = 128):
+    """Gallery of flats, textures or sprites, with a name search. Pages of thumbnails are added below the
+    previous ones with the "Show more" button: only the shown thumbnails are rendered, each once for all sessions,
+    as they are cached by the shared viewer."""
+    key = key or kind
+    viewer = st.session_state["viewer"]
+
+    search = st.text_input("Search", key=f"{key}_search", placeholder="Part of a name, e.g. STAR")
+    matches = [x for x in names if search.strip().upper() in x.upper()]
+
+    # Back to the first page when the search or the gallery changes.
+    if st.session_state.get(f"{key}_query") != search:
+        st.session_state[f"{key}_query"] = search
+        st.session_state[f"{key}_shown"] = page_size
+    n_shown = min(st.session_state[f"{key}_shown"], len(matches))
+
+    st.caption(f"{len(matches)} {kind} out of {len(names)}, {n_shown} shown.")
+    for row_start in range(0, n_shown, ncols):
+        for col, name in zip(st.columns(ncols), matches[row_start: min(row_start + ncols, n_shown)]):
+            try:
+                col.image(viewer.get_thumbnail(kind, name, max_size), caption=name, use_container_width=True)
+            except (NotImplementedError, ValueError) as e:
+                logger.error(f"Error drawing {name}: {e}")
+                col.caption(name)
+
+    if n_shown < len(matches):
+        st.button("Show more", key=f"{key}_more", on_click=_show_more, args=(f"{key}_shown", page_size))
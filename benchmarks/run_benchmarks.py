@@ -0,0 +1,189 @@
+import argparse
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from loguru import logger
+
+from benchmarks.synthetic_wad import MAP_FORMATS, SyntheticWadSpec, generate_wad
+from src.WADParser import WAD_file
+from src.WADViewer import WadViewer
+from src.map_parser import parse_map
+from src.mus2mid import mus2mid
+
+"""Benchmarks of the parser and the renderers on synthetic WADs, one per map format.
+
+Each case is run several times: the fastest and median times are reported, with the throughput of the fastest run.
+The peak memory is measured in an extra run, under tracemalloc (which slows it down, so it is not timed).
+Results are saved as JSON, and can be compared with the results of another commit.
+
+CLI use:
+
+python -m benchmarks.run_benchmarks -p <small|medium|large> -o <output JSON> [-c <baseline JSON>]
+"""
+
+PRESETS = {
+    "small": dict(n_maps=2, grid_size=16),
+    "medium": dict(n_maps=4, grid_size=48, n_patches=256, n_textures=512, n_flats=64, n_sprites=256, n_musics=8),
+    "large": dict(n_maps=8, grid_size=120, n_patches=512, n_textures=2048, n_flats=128, n_sprites=512, n_musics=16,
+                  mus_events=20000),
+}
+
+
+def benchmark_cases(data: bytes) -> dict:
+    """Cases of one WAD: name -> (function to time, number of items processed, unit of the items, bytes processed)."""
+
+    wad = WAD_file(io.BytesIO(data))
+    viewer = WadViewer(wad)
+    maps = list(wad.maps.keys())
+    patches = [wad.lumps[wad._lump_index[name]] for name in wad._parse_patches()]
+    musics = [wad._lump_data_by_name(name) for name in wad.musics]
+    map_bytes = sum(size for name in maps for offset, size in wad._maps_lumps[name].values())
+
+    def draw_maps():
+        for name in maps:
+            # Polylines are cached in the parsed map, they are computed again on each run.
+            wad.maps[name]._polylines.clear()
+            fig = viewer.draw_map(name)
+            fig.canvas.draw()
+            plt.close(fig)
+
+    return {
+        "WAD_file": (lambda: WAD_file(io.BytesIO(data)), 1, "WAD", len(data)),
+        "parse_map": (lambda: [parse_map(wad, name) for name in maps], len(maps), "maps", map_bytes),
+        "get_patch_data": (lambda: [viewer.get_patch_data(offset, size) for _, offset, size in patches],
+                           len(patches), "patches", sum(size for _, _, size in patches)),
+        "get_tex_data": (lambda: [viewer.get_tex_data(name) for name in wad.textures], len(wad.textures), "textures",
+                         None),
+        "draw_map": (draw_maps, len(maps), "maps", None),
+        "mus2mid": (lambda: [mus2mid(x) for x in musics], len(musics), "musics", sum(len(x) for x in musics)),
+    }
+
+
+def run_case(function, repeat: int) -> tuple[list[float], int]:
+    """Times of repeat runs, in seconds, and peak memory of one more run, in bytes."""
+    function()  # Warm-up
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(preset: str = "small", formats: list[str] = MAP_FORMATS, repeat: int = 5, seed: int = 0) -> dict:
+    """Runs every case on a synthetic WAD of each format, and returns the results with their context."""
+
+    results = []
+    specs = {}
+    for map_format in formats:
+        spec = SyntheticWadSpec(map_format=map_format, seed=seed, **PRESETS[preset])
+        specs[map_format] = asdict(spec)
+        data = generate_wad(spec)
+        logger.info(f"{map_format} WAD: {len(data) / 1e6:.1f} MB.")
+
+        for case, (function, items, unit, n_bytes) in benchmark_cases(data).items():
+            times, peak = run_case(function, repeat)
+            best = min(times)
+            result = {
+                "wad": map_format,
+                "case": case,
+                "repeat": repeat,
+                "seconds_min": best,
+                "seconds_median": statistics.median(times),
+                "items": items,
+                "throughput": items / best,
+                "unit": f"{unit}/s",
+                "mb_per_s": n_bytes / 1e6 / best if n_bytes else None,
+                "peak_mb": peak / 1e6,
+            }
+            results.append(result)
+            logger.info(f"{map_format} {case}: {best * 1000:.1f} ms, {result['throughput']:.1f} {result['unit']}, "
+                        f"peak {result['peak_mb']:.1f} MB.")
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(),
+            "preset": preset,
+            "specs": specs,
+        },
+        "results": results,
+    }
+
+
+def compare_results(results: dict, baseline: dict, threshold: float = 0.1) -> list[dict]:
+    """Median times of the results against the baseline. Cases slower than threshold (relative) are regressions."""
+
+    baseline_times = {(x["wad"], x["case"]): x["seconds_median"] for x in baseline["results"]}
+    comparison = []
+    for result in results["results"]:
+        key = (result["wad"], result["case"])
+        if key not in baseline_times:
+            continue
+        ratio = result["seconds_median"] / baseline_times[key]
+        comparison.append({"wad": key[0], "case": key[1], "ratio": ratio, "regression": ratio > 1 + threshold})
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", "-p", type=str, help="Size of the WADs", default="small", choices=PRESETS)
+    parser.add_argument("--formats", "-f", nargs="+", help="Map formats", default=MAP_FORMATS, choices=MAP_FORMATS)
+    parser.add_argument("--repeat", "-r", type=int, help="Timed runs of each case", default=5)
+    parser.add_argument("--seed", "-s", type=int, help="Random seed of the WADs", default=0)
+    parser.add_argument("--output", "-o", type=str, help="Output JSON file", default="output/benchmarks.json")
+    parser.add_argument("--compare", "-c", type=str, help="JSON results to compare with", default=None)
+    parser.add_argument("--threshold", "-t", type=float, help="Relative slowdown counted as a regression", default=0.1)
+
+    args = parser.parse_args()
+
+    # The parser logs every WAD it opens: only its warnings are kept.
+    logger.remove()
+    logger.add(sys.stderr, filter=lambda record: record["level"].no >= 30 or record["name"].startswith("__main__"))
+
+    results = run_benchmarks(args.preset, args.formats, args.repeat, args.seed)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {args.output}.")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        comparison = compare_results(results, baseline, args.threshold)
+        for x in comparison:
+            state = "REGRESSION" if x["regression"] else "ok"
+            logger.info(f"{x['wad']:>6} {x['case']:<15} x{x['ratio']:.2f} {state}")
+        # A non-zero exit code, so that a CI job fails on regressions.
+        sys.exit(1 if any(x["regression"] for x in comparison) else 0)
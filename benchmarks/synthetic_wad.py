@@ -0,0 +1,347 @@
+import argparse
+import struct
+from dataclasses import asdict, dataclass
+
+import numpy as np
+from loguru import logger
+
+from src.map_parser import SECTOR_DTYPE, SIDEDEF_DTYPE
+from src.palettes import DEFAULT_PALETTE
+
+"""Deterministic generator of synthetic WADs, to benchmark the parser and the renderers without shipping any game data.
+
+Maps are grids of square rooms, in Doom, Hexen or UDMF format: the outer walls are one-sided, the walls between rooms
+are two-sided, a few lines are specials or secrets and things are scattered in the rooms.
+The WADs also hold patches (PNAMES / TEXTURE1), flats, sprites, DMX sounds and MUS tracks.
+The same spec and seed always give the same bytes.
+
+CLI use:
+
+python -m benchmarks.synthetic_wad -o <output WAD> -f <doom|hexen|udmf> -m <maps> -g <rooms per side>
+"""
+
+MAP_FORMATS = ["doom", "hexen", "udmf"]
+ROOM_SIZE = 128
+# Player 1 start, then monsters, items and decorations of Doom.
+THING_TYPES = [3004, 9, 3001, 3002, 2011, 2012, 2035, 2014, 48, 2028]
+SPRITE_FRAMES = "ABCD"
+
+ML_BLOCKING = 0x0001
+ML_TWOSIDED = 0x0004
+ML_SECRET = 0x0020
+
+DOOM_LINEDEF = struct.Struct("<HHHHHHH")
+HEXEN_LINEDEF = struct.Struct("<HHHBBBBBBHH")
+DOOM_THING = struct.Struct("<hhhhh")
+HEXEN_THING = struct.Struct("<7h6B")
+
+
+@dataclass
+class SyntheticWadSpec:
+    map_format: str = "doom"
+    n_maps: int = 2
+    # Each map is a grid of grid_size x grid_size rooms.
+    grid_size: int = 16
+    n_patches: int = 64
+    n_textures: int = 128
+    patches_per_texture: int = 4
+    n_flats: int = 32
+    n_sprites: int = 64
+    n_sounds: int = 16
+    n_musics: int = 4
+    mus_events: int = 4000
+    seed: int = 0
+
+
+def _pad8(name: str) -> bytes:
+    return name.encode("ascii")[:8].ljust(8, b"\0")
+
+
+def build_wad(lumps: list[tuple[str, bytes]], wad_type: str = "PWAD") -> bytes:
+    """Writes lumps as a WAD: header, lump data, then directory."""
+    data = bytearray(12)
+    directory = []
+    for name, lump in lumps:
+        directory.append(struct.pack("<ii8s", len(data), len(lump), _pad8(name)))
+        data += lump
+    dir_offset = len(data)
+    data += b"".join(directory)
+    data[:12] = struct.pack("<4sii", wad_type.encode("ascii"), len(lumps), dir_offset)
+    return bytes(data)
+
+
+def make_patch(rng: np.random.Generator, width: int, height: int, holes: bool = False) -> bytes:
+    """Picture format lump. Columns are one post each, or two with holes (as sprites have)."""
+    columns = []
+    for _ in range(width):
+        pixels = rng.integers(0, 256, height, dtype=np.uint8)
+        if holes and height > 4:
+            cut = int(rng.integers(1, height - 2))
+            gap = int(rng.integers(1, height - cut))
+            posts = [(0, pixels[:cut]), (cut + gap, pixels[cut + gap:])]
+        else:
+            posts = [(0, pixels)]
+        column = b"".join(bytes([top, len(p), 0]) + p.tobytes() + b"\0" for top, p in posts if len(p) > 0)
+        columns.append(column + b"\xff")
+
+    header_size = 8 + 4 * width
+    offsets = header_size + np.concatenate([[0], np.cumsum([len(c) for c in columns])[:-1]])
+    return (struct.pack("<2H2h", width, height, width // 2, height - 4) + struct.pack(f"<{width}I", *offsets.tolist())
+            + b"".join(columns))
+
+
+def make_dmx_sound(rng: np.random.Generator, n_samples: int, sample_rate: int = 11025) -> bytes:
+    t = np.arange(n_samples)
+    samples = 128 + 100 * np.sin(2 * np.pi * t * rng.uniform(100, 1000) / sample_rate) * np.exp(-t / n_samples)
+    samples = samples.astype(np.uint8)
+    padded = np.concatenate([np.full(16, samples[0]), samples, np.full(16, samples[-1])]).astype(np.uint8)
+    return struct.pack("<HHI", 3, sample_rate, len(padded)) + padded.tobytes()
+
+
+def make_mus(rng: np.random.Generator, n_events: int) -> bytes:
+    """MUS track of notes pressed and released on a few channels, with program changes."""
+    body = bytearray()
+    channels = [0, 1, 2, 3, 15]
+    for channel in channels[:-1]:
+        body += bytes([0x40 | channel, 0, int(rng.integers(0, 128))])  # Change instrument
+    held = {}
+    for _ in range(n_events):
+        channel = int(rng.choice(channels))
+        if channel in held and rng.random() < 0.5:
+            event = bytes([0x00 | channel, held.pop(channel)])  # Release note
+        else:
+            note = int(rng.integers(30, 90))
+            event = bytes([0x10 | channel, 0x80 | note, int(rng.integers(40, 128))])  # Play note, with volume
+            held[channel] = note
+        if rng.random() < 0.4:
+            delay = int(rng.integers(1, 300))
+            encoded = [delay & 0x7F]
+            while delay > 0x7F:
+                delay >>= 7
+                encoded.append(0x80 | (delay & 0x7F))
+            event = bytes([event[0] | 0x80]) + event[1:] + bytes(reversed(encoded))
+        body += event
+    body.append(0x60)  # Score end
+
+    instruments = sorted({0, 1, 2, 3})
+    header_size = 16 + 2 * len(instruments)
+    return (struct.pack("<4sHHHHHH", b"MUS\x1a", len(body), header_size, len(channels) - 1, 0, len(instruments), 0)
+            + struct.pack(f"<{len(instruments)}H", *instruments) + bytes(body))
+
+
+def grid_map(rng: np.random.Generator, grid_size: int, textures: list[str], flats: list[str]) -> dict:
+    """Geometry of a grid of rooms: vertices, linedefs (v1, v2, flags, special, front, back), sidedefs, sectors and
+    things (x, y, type), as arrays."""
+
+    n = grid_size
+    ij = np.stack(np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="xy"), axis=-1).reshape(-1, 2)
+    vertices = ij * ROOM_SIZE
+
+    def vertex(i, j):
+        return j * (n + 1) + i
+
+    def sector(i, j):
+        return np.where((i >= 0) & (i < n) & (j >= 0) & (j < n), j * n + i, -1)
+
+    # Horizontal walls, v1 -> v2 towards +x: the front (right) side is the room below.
+    i, j = [x.ravel() for x in np.meshgrid(np.arange(n), np.arange(n + 1))]
+    h_lines = np.column_stack((vertex(i, j), vertex(i + 1, j), sector(i, j - 1), sector(i, j)))
+    # Vertical walls, v1 -> v2 towards +y: the front (right) side is the room on the right.
+    i, j = [x.ravel() for x in np.meshgrid(np.arange(n + 1), np.arange(n))]
+    v_lines = np.column_stack((vertex(i, j), vertex(i, j + 1), sector(i, j), sector(i - 1, j)))
+    lines = np.concatenate((h_lines, v_lines))
+
+    # Outer walls are flipped so that their only side is the front one.
+    flip = lines[:, 2] < 0
+    lines[flip] = lines[flip][:, [1, 0, 3, 2]]
+    two_sided = lines[:, 3] >= 0
+
+    n_lines = len(lines)
+    flags = np.where(two_sided, ML_TWOSIDED, ML_BLOCKING)
+    flags |= np.where(rng.random(n_lines) < 0.02, ML_SECRET, 0)
+    specials = np.where(rng.random(n_lines) < 0.05, rng.integers(1, 140, n_lines), 0)
+
+    # One sidedef per side: front sides first, then back sides.
+    front = np.arange(n_lines)
+    back = np.where(two_sided, n_lines + np.cumsum(two_sided) - 1, -1)
+    side_sectors = np.concatenate((lines[:, 2], lines[two_sided, 3]))
+    n_sides = len(side_sectors)
+    side_two_sided = np.concatenate((two_sided, np.ones(two_sided.sum(), dtype=bool)))
+    tex_idx = rng.integers(0, len(textures), (n_sides, 2))
+    names = np.array(textures + ["-"], dtype="S8")
+    sidedefs = np.zeros(n_sides, dtype=SIDEDEF_DTYPE)
+    sidedefs["upper"] = np.where(side_two_sided, names[tex_idx[:, 0]], b"-")
+    sidedefs["lower"] = np.where(side_two_sided, names[tex_idx[:, 1]], b"-")
+    sidedefs["middle"] = np.where(side_two_sided, b"-", names[tex_idx[:, 0]])
+    sidedefs["sector"] = side_sectors
+
+    sectors = np.zeros(n * n, dtype=SECTOR_DTYPE)
+    flat_names = np.array(flats, dtype="S8")
+    sectors["floor_height"] = rng.integers(-4, 5, n * n) * 8
+    sectors["ceiling_height"] = 128 + rng.integers(0, 4, n * n) * 16
+    sectors["floor"] = flat_names[rng.integers(0, len(flats), n * n)]
+    sectors["ceiling"] = flat_names[rng.integers(0, len(flats), n * n)]
+    sectors["light"] = rng.integers(8, 32, n * n) * 8
+
+    n_things = max(1, n * n // 2)
+    things = np.column_stack((
+        rng.integers(16, n * ROOM_SIZE - 16, n_things),
+        rng.integers(16, n * ROOM_SIZE - 16, n_things),
+        np.array(THING_TYPES)[rng.integers(0, len(THING_TYPES), n_things)],
+    ))
+    things[0, 2] = 1  # Player 1 start
+
+    return {
+        "vertices": vertices,
+        "linedefs": np.column_stack((lines[:, :2], flags, specials, front, back)),
+        "sidedefs": sidedefs,
+        "sectors": sectors,
+        "things": things,
+    }
+
+
+def map_lumps(name: str, geometry: dict, map_format: str) -> list[tuple[str, bytes]]:
+    """Lumps of a map, in the given format."""
+
+    if map_format == "udmf":
+        return [(name, b""), ("TEXTMAP", udmf_text(geometry).encode("utf8")), ("ENDMAP", b"")]
+
+    if len(geometry["sidedefs"]) > 0xFFFF:
+        raise ValueError(f"{name} has {len(geometry['sidedefs'])} sidedefs: the {map_format} format indexes at most "
+                         f"{0xFFFF} of them (0xFFFF means no sidedef). Use a smaller grid, or the udmf format.")
+
+    linedefs = geometry["linedefs"]
+    sides = np.where(linedefs[:, 4:] < 0, 0xFFFF, linedefs[:, 4:])
+    if map_format == "hexen":
+        lines = b"".join(HEXEN_LINEDEF.pack(v1, v2, flags, special & 0xFF, 0, 0, 0, 0, 0, front, back)
+                         for (v1, v2, flags, special), (front, back) in zip(linedefs[:, :4].tolist(), sides.tolist()))
+        things = b"".join(HEXEN_THING.pack(0, x, y, 0, 0, thing_type, 7, 0, 0, 0, 0, 0, 0)
+                          for x, y, thing_type in geometry["things"].tolist())
+    else:
+        lines = b"".join(DOOM_LINEDEF.pack(v1, v2, flags, special, 0, front, back)
+                         for (v1, v2, flags, special), (front, back) in zip(linedefs[:, :4].tolist(), sides.tolist()))
+        things = b"".join(DOOM_THING.pack(x, y, 0, thing_type, 7) for x, y, thing_type in geometry["things"].tolist())
+
+    lumps = [
+        (name, b""),
+        ("THINGS", things),
+        ("LINEDEFS", lines),
+        ("SIDEDEFS", geometry["sidedefs"].tobytes()),
+        ("VERTEXES", geometry["vertices"].astype("<i2").tobytes()),
+        ("SECTORS", geometry["sectors"].tobytes()),
+    ]
+    if map_format == "hexen":
+        # An empty ACS script library: its presence marks the Hexen format.
+        lumps.append(("BEHAVIOR", b"ACS\0" + struct.pack("<I", 8)))
+    return lumps
+
+
+def udmf_text(geometry: dict) -> str:
+    blocks = ['namespace = "zdoom";']
+    blocks += [f"thing {{ x = {x:.1f}; y = {y:.1f}; type = {thing_type}; }}"
+               for x, y, thing_type in geometry["things"].tolist()]
+    blocks += [f"vertex {{ x = {x:.1f}; y = {y:.1f}; }}" for x, y in geometry["vertices"].tolist()]
+    for v1, v2, flags, special, front, back in geometry["linedefs"].tolist():
+        props = [f"v1 = {v1};", f"v2 = {v2};", f"sidefront = {front};"]
+        if back >= 0:
+            props.append(f"sideback = {back};")
+        if flags & ML_BLOCKING:
+            props.append("blocking = true;")
+        if flags & ML_TWOSIDED:
+            props.append("twosided = true;")
+        if flags & ML_SECRET:
+            props.append("secret = true;")
+        if special:
+            props.append(f"special = {special};")
+        blocks.append(f"linedef {{ {' '.join(props)} }}")
+    for side in geometry["sidedefs"]:
+        blocks.append(
+            f'sidedef {{ sector = {side["sector"]}; texturetop = "{side["upper"].decode()}"; '
+            f'texturebottom = "{side["lower"].decode()}"; texturemiddle = "{side["middle"].decode()}"; }}'
+        )
+    for sector in geometry["sectors"]:
+        blocks.append(
+            f'sector {{ heightfloor = {sector["floor_height"]}; heightceiling = {sector["ceiling_height"]}; '
+            f'texturefloor = "{sector["floor"].decode()}"; textureceiling = "{sector["ceiling"].decode()}"; '
+            f'lightlevel = {sector["light"]}; }}'
+        )
+    return "\n".join(blocks) + "\n"
+
+
+def sprite_names(n_sprites: int) -> list[str]:
+    """Sprite lump names: 4-letter prefixes, each with a few frames seen from the front."""
+    names = []
+    for k in range(n_sprites):
+        prefix_idx, frame = divmod(k, len(SPRITE_FRAMES))
+        prefix = "".join(chr(ord("A") + (prefix_idx // 26**p) % 26) for p in range(3, -1, -1))
+        names.append(f"{prefix}{SPRITE_FRAMES[frame]}1")
+    return names
+
+
+def generate_wad(spec: SyntheticWadSpec) -> bytes:
+    """Builds the WAD described by spec."""
+
+    if spec.map_format not in MAP_FORMATS:
+        raise ValueError(f"Unknown map format: {spec.map_format}. Use one of {MAP_FORMATS}.")
+    rng = np.random.default_rng(spec.seed)
+
+    patch_names = [f"PAT{k:05d}" for k in range(spec.n_patches)]
+    texture_names = [f"TEX{k:05d}" for k in range(spec.n_textures)]
+    flat_names = [f"FLT{k:05d}" for k in range(spec.n_flats)]
+
+    lumps = [
+        ("PLAYPAL", DEFAULT_PALETTE * 14),
+        ("COLORMAP", np.tile(np.arange(256, dtype=np.uint8), 34).tobytes()),
+    ]
+
+    for k in range(spec.n_maps):
+        geometry = grid_map(rng, spec.grid_size, texture_names, flat_names)
+        lumps += map_lumps(f"MAP{k + 1:02d}", geometry, spec.map_format)
+
+    # Textures made of patches side by side.
+    widths = rng.choice([16, 32, 64], spec.n_patches)
+    lumps.append(("PNAMES", struct.pack("<I", spec.n_patches) + b"".join(_pad8(x) for x in patch_names)))
+    definitions = []
+    for name in texture_names:
+        patches = rng.integers(0, spec.n_patches, spec.patches_per_texture)
+        x = np.concatenate([[0], np.cumsum(widths[patches])[:-1]])
+        definition = _pad8(name) + struct.pack("<ihhih", 0, int(x[-1] + widths[patches[-1]]), 128, 0, len(patches))
+        definition += b"".join(struct.pack("<hhhhh", int(px), 0, int(p), 1, 0) for px, p in zip(x, patches))
+        definitions.append(definition)
+    offsets = 4 + 4 * len(definitions) + np.concatenate([[0], np.cumsum([len(d) for d in definitions])[:-1]])
+    lumps.append(("TEXTURE1", struct.pack(f"<i{len(definitions)}i", len(definitions), *offsets.tolist())
+                  + b"".join(definitions)))
+    lumps.append(("P_START", b""))
+    lumps += [(name, make_patch(rng, int(width), 128)) for name, width in zip(patch_names, widths)]
+    lumps.append(("P_END", b""))
+
+    lumps.append(("F_START", b""))
+    lumps += [(name, rng.integers(0, 256, 4096, dtype=np.uint8).tobytes()) for name in flat_names]
+    lumps.append(("F_END", b""))
+
+    lumps.append(("S_START", b""))
+    lumps += [(name, make_patch(rng, int(rng.integers(16, 64)), int(rng.integers(32, 80)), holes=True))
+              for name in sprite_names(spec.n_sprites)]
+    lumps.append(("S_END", b""))
+
+    lumps += [(f"DSSND{k:03d}", make_dmx_sound(rng, int(rng.integers(2000, 20000)))) for k in range(spec.n_sounds)]
+    lumps += [(f"D_MUS{k:03d}", make_mus(rng, spec.mus_events)) for k in range(spec.n_musics)]
+
+    return build_wad(lumps, "IWAD")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o", type=str, help="Output WAD file", default="output/synthetic.wad")
+    parser.add_argument("--format", "-f", type=str, help="Map format", default="doom", choices=MAP_FORMATS)
+    parser.add_argument("--maps", "-m", type=int, help="Number of maps", default=2)
+    parser.add_argument("--grid", "-g", type=int, help="Rooms per side of each map", default=16)
+    parser.add_argument("--seed", "-s", type=int, help="Random seed", default=0)
+
+    args = parser.parse_args()
+
+    spec = SyntheticWadSpec(map_format=args.format, n_maps=args.maps, grid_size=args.grid, seed=args.seed)
+    data = generate_wad(spec)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    logger.info(f"Synthetic WAD of {len(data) / 1e6:.1f} MB written to {args.output}: {asdict(spec)}")
@@ -0,0 +1,360 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from loguru import logger
+
+from src.WADParser import WAD_file, open_wad_file
+from src.WADViewer import WadViewer
+from src.parser_utils import find_wads, wad_stem
+from src.mus2mid import MUS_ID
+
+"""Batch export of every asset of one or many WAD files.
+Work is fanned out over a process pool, and a manifest of finished items (content hash + parameters)
+is kept in the output directory so that reruns only export what changed.
+
+CLI use:
+
+python -m src.WADExporter -w <WAD files or folders> -o <output dir> -j <workers> -a maps floors flats textures sprites sounds musics
+
+Or use
+python -m src.WADExporter -h
+
+to get help on the command line arguments.
+"""
+
+ASSET_KINDS = ["maps", "floors", "flats", "textures", "sprites", "sounds", "musics"]
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
+
+def wad_folder(wad_path: str) -> str:
+    """Output folder of a WAD: its name and a short hash of its path, so that WADs of a same name do not collide."""
+    return f"{wad_stem(wad_path)}_{hashlib.sha1(os.path.abspath(wad_path).encode()).hexdigest()[:8]}"
+
+
+@dataclass
+class ExportItem:
+    wad_path: str
+    kind: str
+    name: str
+    digest: str
+
+    @property
+    def key(self) -> str:
+        return f"{wad_folder(self.wad_path)}/{self.kind}/{self.name}"
+
+
+@dataclass
+class ExportStats:
+    total: int = 0
+    exported: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes_written: int = 0
+    start_time: float = field(default_factory=time.perf_counter)
+
+    @property
+    def done(self) -> int:
+        return self.exported + self.skipped + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def rate(self) -> float:
+        return (self.exported + self.failed) / max(self.elapsed, 1e-9)
+
+
+class Manifest:
+    """Record of the exported items, saved as JSON in the output directory.
+    Each item is stored with the hash of its source data and export parameters, and the files it produced."""
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.items = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    content = json.load(f)
+                if content.get("version") == MANIFEST_VERSION:
+                    self.items = content["items"]
+            except (OSError, ValueError, KeyError):
+                logger.warning(f"Unreadable manifest {self.path}, starting from scratch.")
+
+    def is_done(self, item: ExportItem, output_dir: str) -> bool:
+        entry = self.items.get(item.key)
+        if entry is None or entry["hash"] != item.digest:
+            return False
+        return all(os.path.isfile(os.path.join(output_dir, f)) for f in entry["outputs"])
+
+    def add(self, item: ExportItem, outputs: list[str]):
+        self.items[item.key] = {"hash": item.digest, "outputs": outputs}
+
+    def save(self):
+        # Written to a temporary file first, so that an interrupted run never leaves a broken manifest.
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "items": self.items}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def _lump_bytes(wad: WAD_file, name: str) -> bytes:
+    return wad._lump_data(*wad._misc_lumps[name])
+
+
+def _asset_source(wad: WAD_file, kind: str, name: str) -> bytes:
+    """Raw data an exported asset depends on, used to detect changes between runs."""
+
+    if kind == "maps":
+        lumps = wad._maps_lumps[name]
+        return b"".join(wad._lump_data(*lumps[lump]) for lump in sorted(lumps))
+
+    if kind == "floors":
+        data = [_asset_source(wad, "maps", name)]
+        data += [_lump_bytes(wad, lump) for lump in ["COLORMAP"] + sorted(wad.flats or []) if lump in wad._misc_lumps]
+        return b"".join(data)
+
+    if kind == "textures":
+        texture = wad.textures[name]
+        data = [json.dumps(texture, sort_keys=True).encode()]
+        data += [wad._lump_data_by_name(patch_name) for patch_name, _, _ in texture["patches"]]
+        return b"".join(data)
+
+    return _lump_bytes(wad, name)
+
+
+def list_items(wad_path: str, kinds: list[str], params: dict) -> list[ExportItem]:
+    """Lists every asset of a WAD, with the hash of its data and of the export parameters."""
+
+    wad, _ = _get_worker_wad(wad_path)
+    palette = wad.palette.tobytes()
+
+    assets = {
+        "maps": list(wad.maps.keys()) if wad.maps else [],
+        "floors": [x for x, parsed_map in (wad.maps or {}).items() if parsed_map and parsed_map.sectors is not None],
+        "flats": wad.flats or [],
+        "textures": list(wad.textures.keys()) if wad.textures else [],
+        "sprites": wad.sprites or [],
+        "sounds": (wad.sounds or []) + ((wad.pc_sounds or []) if params.get("sounds", {}).get("pc_speaker") else []),
+        "musics": wad.musics or [],
+    }
+
+    items = []
+    for kind in kinds:
+        kind_params = json.dumps(params.get(kind, {}), sort_keys=True).encode()
+        for name in sorted(assets[kind]):
+            hasher = hashlib.sha1(_asset_source(wad, kind, name))
+            hasher.update(kind_params)
+            if kind in ["maps", "floors", "flats", "textures", "sprites"]:
+                hasher.update(palette)
+            items.append(ExportItem(wad_path, kind, name, hasher.hexdigest()))
+
+    return items
+
+
+# Each worker process keeps the last opened WADs, so that consecutive items of a same WAD are not parsed again.
+_WORKER_WADS = {}
+_WORKER_WADS_MAX = 2
+
+
+def _get_worker_wad(wad_path: str) -> tuple[WAD_file, WadViewer]:
+    if wad_path not in _WORKER_WADS:
+        if len(_WORKER_WADS) >= _WORKER_WADS_MAX:
+            _WORKER_WADS.pop(next(iter(_WORKER_WADS)))
+        wad = open_wad_file(wad_path)
+        _WORKER_WADS[wad_path] = (wad, WadViewer(wad))
+    return _WORKER_WADS[wad_path]
+
+
+def _save_image(rgba_img: np.ndarray, output_path: str):
+    plt.imsave(output_path, np.clip(rgba_img, 0, 255).astype(np.uint8))
+
+
+def export_item(item: ExportItem, output_dir: str, params: dict) -> list[str]:
+    """Exports a single asset and returns the paths of the written files, relative to output_dir."""
+
+    wad, viewer = _get_worker_wad(item.wad_path)
+    kind_params = params.get(item.kind, {})
+
+    rel_dir = os.path.join(wad_folder(item.wad_path), item.kind)
+    os.makedirs(os.path.join(output_dir, rel_dir), exist_ok=True)
+    rel_path = os.path.join(rel_dir, item.name)
+    output_path = os.path.join(output_dir, rel_path)
+
+    if item.kind == "maps":
+        fmt = kind_params.get("format", "png")
+        fig = viewer.draw_map(
+            item.name,
+            palette=kind_params.get("palette", "OMGIFOL"),
+            scale=kind_params.get("scale", 2.0),
+            max_width=kind_params.get("max_width", 4096),
+        )
+        fig.savefig(f"{output_path}.{fmt}", bbox_inches="tight", dpi=150)
+        plt.close(fig)
+        return [f"{rel_path}.{fmt}"]
+
+    if item.kind == "floors":
+        rgba_img, _ = viewer.get_floor_data(item.name, max_width=kind_params.get("max_width", 2048))
+        _save_image(rgba_img, f"{output_path}.png")
+        return [f"{rel_path}.png"]
+
+    if item.kind in ["flats", "textures", "sprites"]:
+        _save_image(viewer.get_image_data(item.kind, item.name), f"{output_path}.png")
+        return [f"{rel_path}.png"]
+
+    if item.kind == "sounds":
+        path = wad.export_sound(item.name, output_dir=os.path.join(output_dir, rel_dir))
+        return [os.path.relpath(path, output_dir)]
+
+    if item.kind == "musics":
+        path = wad.export_music(item.name, output_dir=os.path.join(output_dir, rel_dir))
+        outputs = [os.path.relpath(path, output_dir)]
+        if kind_params.get("midi", True) and _lump_bytes(wad, item.name)[:4] == MUS_ID:
+            wad.write_music(item.name, f"{output_path}.mid", to_midi=True)
+            outputs.append(f"{rel_path}.mid")
+        return outputs
+
+    raise ValueError(f"Unknown asset kind: {item.kind}")
+
+
+def _export_worker(item: ExportItem, output_dir: str, params: dict) -> tuple[ExportItem, list[str], str | None]:
+    """Pool entry point: never raises, so that one broken asset does not stop the whole export."""
+    try:
+        return item, export_item(item, output_dir, params), None
+    except Exception as exc:
+        return item, [], f"{type(exc).__name__}: {exc}"
+
+
+def export_wads(
+    wad_paths: list[str],
+    output_dir: str,
+    kinds: list[str] | None = None,
+    params: dict | None = None,
+    workers: int | None = None,
+    force: bool = False,
+) -> ExportStats:
+    """Exports every asset of the given WADs into output_dir/<WAD name>_<path hash>/<asset kind>/.
+
+    Parameters
+    ----------
+    wad_paths : list[str]
+        WAD files to export.
+    output_dir : str
+        Root of the output tree, also holding the manifest.
+    kinds : list[str], optional
+        Asset kinds to export, see ASSET_KINDS. Defaults to all of them.
+    params : dict, optional
+        Export parameters per asset kind, e.g. {"maps": {"palette": "DOOM", "format": "svg"}}.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    force : bool
+        Export everything again, ignoring the manifest.
+
+    Returns
+    -------
+    ExportStats
+        Counters of the run.
+    """
+
+    kinds = kinds or ASSET_KINDS
+    params = params or {}
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(output_dir)
+    stats = ExportStats()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Listing the assets is done in the pool too, as it requires parsing every WAD.
+        listings = [pool.submit(list_items, wad_path, kinds, params) for wad_path in wad_paths]
+        items = []
+        for future, wad_path in zip(listings, wad_paths):
+            try:
+                items += future.result()
+            except Exception as exc:
+                logger.error(f"Unable to read {wad_path}: {exc}")
+
+        stats.total = len(items)
+        todo = [item for item in items if force or not manifest.is_done(item, output_dir)]
+        stats.skipped = stats.total - len(todo)
+        logger.info(
+            f"{stats.total} assets found in {len(wad_paths)} WADs, {stats.skipped} already exported, {len(todo)} to go."
+        )
+
+        futures = [pool.submit(_export_worker, item, output_dir, params) for item in todo]
+        last_save = time.perf_counter()
+        for future in as_completed(futures):
+            item, outputs, error = future.result()
+            if error is None:
+                manifest.add(item, outputs)
+                stats.exported += 1
+                stats.bytes_written += sum(os.path.getsize(os.path.join(output_dir, f)) for f in outputs)
+            else:
+                stats.failed += 1
+                logger.warning(f"Failed to export {item.key}: {error}")
+
+            remaining = stats.total - stats.done
+            eta = remaining / max(stats.rate(), 1e-9)
+            logger.info(f"[{stats.done}/{stats.total}] {item.key} - {stats.rate():.1f} items/s, ETA {eta:.0f}s.")
+
+            # Saving regularly, so that an interrupted run can be resumed.
+            if time.perf_counter() - last_save > 5:
+                manifest.save()
+                last_save = time.perf_counter()
+
+    manifest.save()
+    logger.info(
+        f"Export done in {stats.elapsed:.1f}s: {stats.exported} exported, {stats.skipped} skipped, "
+        f"{stats.failed} failed, {stats.bytes_written / 1e6:.1f} MB written ({stats.rate():.1f} items/s)."
+    )
+    return stats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wad", "-w", type=str, nargs="+",
+                        help="WAD files or folders containing WAD files", default=["WADs"])
+    parser.add_argument("--output", "-o", type=str,
+                        help="Output directory", default="output")
+    parser.add_argument("--assets", "-a", type=str, nargs="+",
+                        help="Asset kinds to export", default=ASSET_KINDS, choices=ASSET_KINDS)
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of worker processes (defaults to the number of CPUs)", default=None)
+    parser.add_argument("--force", action="store_true",
+                        help="Export everything again, ignoring the manifest")
+    parser.add_argument("--palette", "-p", type=str,
+                        help="Palette name for the maps", default="OMGIFOL")
+    parser.add_argument("--format", "-f", type=str,
+                        help="Output format for the maps", default="png", choices=["png", "svg"])
+    parser.add_argument("--scale", "-s", type=float,
+                        help="Scale of the maps", default=2.0)
+    parser.add_argument("--max_width", "-mw", type=int,
+                        help="Max width (px) of the maps", default=4096)
+    parser.add_argument("--no_midi", action="store_true",
+                        help="Do not convert MUS musics to MIDI")
+    parser.add_argument("--pc_speaker", action="store_true",
+                        help="Also export the PC speaker sounds, rendered to WAV")
+
+    args = parser.parse_args()
+
+    wad_paths = find_wads(args.wad)
+    if len(wad_paths) == 0:
+        raise ValueError(f"No WAD file found in {args.wad}")
+
+    export_params = {
+        "maps": {"palette": args.palette, "format": args.format, "scale": args.scale, "max_width": args.max_width},
+        "floors": {"max_width": args.max_width},
+        "sounds": {"pc_speaker": args.pc_speaker},
+        "musics": {"midi": not args.no_midi},
+    }
+    export_wads(wad_paths, args.output, kinds=args.assets, params=export_params,
+                workers=args.jobs, force=args.force)
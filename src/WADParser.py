@@ -1,10 +1,19 @@
 from src.map_parser import parse_map
-from src.mus2mid import MUSIC_FORMATS
+from src.mus2mid import MUS_ID, MUSIC_FORMATS, mus2mid
+from src.instrumentation import PhaseReport
+from src.memory import attributes_nbytes, estimate_nbytes, mapped_nbytes
+from src.pc_speaker import PCS_SAMPLERATE, decode_pc_speaker, is_pc_speaker, render_pc_speaker
 from src.palettes import DEFAULT_PALETTE
 from src.parser_utils import EXMY_REGEX, MAPXY_REGEX, MAPS_LUMPS, TEX_REGEX
+import io
+import mmap
 import os
 import csv
+import shutil
 import struct
+import tempfile
+import threading
+from typing import BinaryIO
 from loguru import logger
 import numpy as np
 import wave
@@ -15,51 +24,101 @@ https://www.gamers.org/dhs/helpdocs/dmsp1666.html
 
 """
 
+# Attributes of a parsed WAD, grouped by subsystem for the memory reports.
+MEMORY_SUBSYSTEMS = {
+    "buffer": ["bytes"],
+    "directory": ["lumps", "lump_names", "_lump_index", "_maps_lumps", "_misc_lumps"],
+    "palettes": ["palettes", "palette", "colormaps", "tinttab", "color_luts"],
+    "things": ["id2sprites"],
+    "maps": ["maps"],
+    "markers": ["flats", "sprites", "spritesheets"],
+    "textures": ["textures"],
+    "audio": ["musics", "sounds", "pc_sounds"],
+}
+
 
 class WAD_file:
     def __init__(self, byte_string: bytes):
         """This class is used to parse a WAD file and extract its lumps.
         It also provides methods to parse the levels and extract the flats and sprites."""
 
-        self._get_directory(byte_string)
+        # Bytes read from the WAD so far, by all threads and by each thread, for the instrumentation reports.
+        self.bytes_read = 0
+        self._thread_reads = threading.local()
+        self.report = PhaseReport("WAD_file", bytes_counter=self.thread_bytes_read)
+
+        with self.report.phase("directory") as counts:
+            self._get_directory(byte_string)
+            # Lumps are read by seeking in a shared file object: reads from several threads are serialized.
+            self._read_lock = threading.Lock()
 
-        self.lumps = self._get_lumps()
-        self.lump_names = [lump[0] for lump in self.lumps]
+            self.lumps = self._get_lumps()
+            self.lump_names = [lump[0] for lump in self.lumps]
+            # Index of the first lump of each name, so that lumps are found without searching the whole list.
+            self._lump_index = {}
+            for i, name in enumerate(self.lump_names):
+                self._lump_index.setdefault(name, i)
+            counts["lumps"] = len(self.lumps)
 
         self.game_type = "DOOM"
-        if "TINTTAB" in self.lump_names:
+        if "TINTTAB" in self._lump_index:
             self.game_type = "HERETIC"
-        if "BEHAVIOR" in self.lump_names:
+        if "BEHAVIOR" in self._lump_index:
             self.game_type = "HEXEN"
 
         logger.info(f"Found a {self.game_type} {self.wad_type}.")
 
-        self._maps_lumps, self._misc_lumps = self._parse_lumps()
+        with self.report.phase("lumps"):
+            self._maps_lumps, self._misc_lumps = self._parse_lumps()
+
+        with self.report.phase("palettes") as counts:
+            self.palettes = self._get_palettes()
+            self.palette = self.palettes[0]
+            self.colormaps = self._get_colormaps()
+            self.tinttab = self._get_tinttab()
+            # Every (palette, light level) combination precomputed: color_luts[palette, light, index] -> RGBA.
+            self.color_luts = self.palettes[:, self.colormaps]
+            counts.update(palettes=len(self.palettes), colormaps=len(self.colormaps))
 
-        self.palette = self._get_palette()
         self.maps = None
         if len(self._maps_lumps) > 0:
-            self.id2sprites = self._parse_things()
-            maps = {}
-            for map_name in self._maps_lumps.keys():
-                try:
-                    maps[map_name] = parse_map(self, map_name)
-                except:
-                    logger.warning(f"Error when parsing map {map_name}.")
-            self.maps = maps
-
-        self.flats = self._parse_by_markers("FLATS", "F_START", "F_END")
-        self.sprites = self._parse_by_markers("SPRITES", "S_START", "S_END")
-        self.spritesheets = self._get_spritesheets() if self.sprites else None
-
-        self.textures = self._gather_textures()
-        self.musics = self._gather_musics()
-        self.sounds = self._gather_sounds()
+            with self.report.phase("things"):
+                self.id2sprites = self._parse_things()
+            with self.report.phase("maps") as counts:
+                maps = {}
+                for map_name in self._maps_lumps.keys():
+                    try:
+                        maps[map_name] = parse_map(self, map_name)
+                    except:
+                        logger.warning(f"Error when parsing map {map_name}.")
+                self.maps = maps
+                counts.update(maps=len(maps), linedefs=sum(len(x.linedefs) for x in maps.values() if x is not None))
+
+        with self.report.phase("markers") as counts:
+            self.flats = self._parse_by_markers("FLATS", "F_START", "F_END")
+            self.sprites = self._parse_by_markers("SPRITES", "S_START", "S_END")
+            self.spritesheets = self._get_spritesheets() if self.sprites else None
+            counts.update(flats=len(self.flats or []), sprites=len(self.sprites or []))
+
+        with self.report.phase("textures") as counts:
+            self.textures = self._gather_textures()
+            counts["textures"] = len(self.textures or {})
+
+        with self.report.phase("audio") as counts:
+            self.musics = self._gather_musics()
+            self.sounds = self._gather_sounds()
+            self.pc_sounds = self._gather_pc_sounds()
+            counts.update(
+                musics=len(self.musics or []), sounds=len(self.sounds or []), pc_sounds=len(self.pc_sounds or [])
+            )
+
+        self.report.log(f"Parsed the {self.wad_type} in {self.report.total_seconds * 1000:.1f} ms.")
 
     def _get_directory(self, bytestring: bytes):
         """Get the directory of the WAD file."""
         wad_type, dir_size, dir_offset = struct.unpack(
             "<4sII", bytestring.read(12))
+        self._count_read(12)
         wad_type = wad_type.decode("ascii")
         if wad_type in ["IWAD", "PWAD"]:
             self.dir_size = dir_size
@@ -88,6 +147,7 @@ class WAD_file:
             offset, size, name = struct.unpack("<ii8s", lump_data)
             name = name.rstrip(b"\0").decode("ascii")
             lumps.append((name, offset, size))
+        self._count_read(8 + 16 * num_lumps)
 
         return lumps
 
@@ -123,36 +183,79 @@ class WAD_file:
         return maps, misc
 
     def _lump_data(self, offset: int, size: int) -> bytes:
-        self.bytes.seek(offset)
-        return self.bytes.read(size)
+        with self._read_lock:
+            self.bytes.seek(offset)
+            self._count_read(size)
+            return self.bytes.read(size)
+
+    def _count_read(self, size: int) -> None:
+        self.bytes_read += size
+        self._thread_reads.bytes_read = self.thread_bytes_read() + size
+
+    def thread_bytes_read(self) -> int:
+        """Bytes read from the WAD so far by the current thread."""
+        return getattr(self._thread_reads, "bytes_read", 0)
 
     def _lump_data_by_name(self, lump_name: str) -> bytes:
-        if lump_name not in self.lump_names:
+        if lump_name not in self._lump_index:
             raise ValueError(f"Unknown lump: {lump_name}.")
         else:
-            lump_id = self.lump_names.index(lump_name)
-            _, offset, size = self.lumps[lump_id]
+            _, offset, size = self.lumps[self._lump_index[lump_name]]
             return self._lump_data(offset, size)
 
-    def _get_palette(self) -> np.ndarray:
-        if "PLAYPAL" not in self.lump_names:
+    def _get_palettes(self) -> np.ndarray:
+        if "PLAYPAL" not in self._lump_index:
             logger.info(
                 f"No palette in this {self.wad_type}, loading the default one.")
             pal_b = DEFAULT_PALETTE
         else:
-            pal_b = self._lump_data_by_name("PLAYPAL")[:768]
+            pal_b = self._lump_data_by_name("PLAYPAL")
 
-        # 14 Palettes are packed all together by [R, G, B, R...] values.
-        # The first one is thus 768 bytes long.
-        pal_rgb = np.array(struct.unpack("768B", pal_b),
-                           dtype=np.uint8).reshape((256, 3))
+        # 14 Palettes are packed all together by [R, G, B, R...] values, each one being 768 bytes long.
+        # The first one is the normal palette, the next ones are the damage, bonus and radiation suit tints.
+        n_palettes = max(len(pal_b) // 768, 1)
+        pal_rgb = np.frombuffer(pal_b, dtype=np.uint8, count=n_palettes * 768).reshape((n_palettes, 256, 3))
 
         # We will output in RGBA format, so adding an alpha channel with full opacity (255)
-        pal_rgba = np.hstack((pal_rgb, np.ones((256, 1)) * 255))
+        pal_rgba = np.full((n_palettes, 256, 4), 255, dtype=np.uint8)
+        pal_rgba[:, :, :3] = pal_rgb
 
-        logger.info("Palette extracted.")
+        logger.info(f"{n_palettes} palettes extracted.")
         return pal_rgba
 
+    def _get_colormaps(self) -> np.ndarray:
+        """Light tables of the COLORMAP lump: 32 light levels from the brightest to the darkest,
+        then the invulnerability and the all-black tables. Identity table if there is none."""
+        if "COLORMAP" not in self._lump_index:
+            logger.info(f"No colormap in this {self.wad_type}.")
+            return np.arange(256, dtype=np.uint8)[np.newaxis]
+
+        lump = self._lump_data_by_name("COLORMAP")
+        colormaps = np.frombuffer(lump, dtype=np.uint8, count=len(lump) // 256 * 256).reshape((-1, 256))
+
+        logger.info(f"{len(colormaps)} light tables extracted.")
+        return colormaps
+
+    def _get_tinttab(self) -> np.ndarray | None:
+        """Heretic & Hexen translucency table: index [foreground, background] -> blended color."""
+        if "TINTTAB" not in self._lump_index:
+            return None
+
+        lump = self._lump_data_by_name("TINTTAB")
+        if len(lump) < 256 * 256:
+            logger.warning("TINTTAB lump is too small, ignoring it.")
+            return None
+
+        return np.frombuffer(lump, dtype=np.uint8, count=256 * 256).reshape((256, 256))
+
+    def get_lut(self, palette: int = 0, light: int = 0) -> np.ndarray:
+        """RGBA look-up table of shape (256, 4) for a palette (damage/bonus tints) and a COLORMAP light level."""
+        return self.color_luts[palette, light]
+
+    def to_rgba(self, indices: np.ndarray, palette: int = 0, light: int = 0) -> np.ndarray:
+        """Converts an array of palette indices to an RGBA uint8 image, at any palette and light level."""
+        return self.color_luts[palette, light][indices]
+
     def _parse_things(self) -> dict[str:str]:
         # Load the THINGS IDs to names mapping
         id2sprite = {}
@@ -170,9 +273,9 @@ class WAD_file:
         self, sequence_name: str = "FLATS", m_start: str = "F_START", m_end: str = "F_END"
     ) -> dict[str: tuple[int, int]]:
 
-        if (m_start in self.lump_names) & (m_end in self.lump_names):
-            start_idx = self.lump_names.index(m_start)
-            end_idx = self.lump_names.index(m_end)
+        if (m_start in self._lump_index) & (m_end in self._lump_index):
+            start_idx = self._lump_index[m_start]
+            end_idx = self._lump_index[m_end]
 
         else:
             logger.info(f"No {sequence_name} found in this WAD.")
@@ -222,45 +325,40 @@ class WAD_file:
             patches.append(patch_name)
         return patches
 
-    def _parse_textures(self, lump_name: str, patches: list) -> dict:
-        textures = {}
-
-        lump_id = self.lump_names.index(lump_name)
+    def _read_texture_definitions(self, lump_name: str, patches: list) -> list[tuple[str, int, int, list]]:
+        """(name, width, height, [(patch name, x, y), ...]) of every texture defined in a TEXTUREx lump."""
+        lump_id = self._lump_index[lump_name]
         _, lump_offset, size = self.lumps[lump_id]
 
-        self.bytes.seek(lump_offset)
-        texture1_data = self.bytes.read(size)
+        # The whole lump is read at once, and parsed from memory.
+        texture1_data = self._lump_data(lump_offset, size)
 
         numtextures = int.from_bytes(texture1_data[0:4], byteorder="little")
-        self.bytes.seek(lump_offset + 4)
-
-        textures_offsets = []
-        for i in range(numtextures):
-            offset = int.from_bytes(self.bytes.read(4), byteorder="little")
-            textures_offsets.append(offset)
+        textures_offsets = struct.unpack_from(f"<{numtextures}i", texture1_data, 4)
 
+        definitions = []
         for tx_offset in textures_offsets:
-            self.bytes.seek(lump_offset + tx_offset)
-            texture_name = self.bytes.read(8).decode("ascii").rstrip("\0")
-
-            mask, width, height, col_dir = struct.unpack(
-                "<ihhi", self.bytes.read(12))
+            texture_name = texture1_data[tx_offset: tx_offset + 8].decode("ascii").rstrip("\0")
 
-            patch_count = int.from_bytes(
-                self.bytes.read(2), byteorder="little")
-            map_patches = np.array(
-                [struct.unpack("<hhhhh", self.bytes.read(10)) for i in range(patch_count)])
+            mask, width, height, col_dir, patch_count = struct.unpack_from("<ihhih", texture1_data, tx_offset + 8)
+            map_patches = np.frombuffer(
+                texture1_data, dtype="<i2", count=5 * patch_count, offset=tx_offset + 22).reshape(-1, 5)
 
             orig_x = map_patches[:, 0]
             orig_y = map_patches[:, 1]
             patch_idxs = map_patches[:, 2]
 
-            patch_infos = [
-                (patches[patch_idxs[i]], int(orig_x[i]), int(orig_y[i]))
-                for i in range(patch_count)
-                # Only include patches that exist in the WAD
-                if patches[patch_idxs[i]] in self.lump_names
-            ]
+            patch_infos = [(patches[patch_idxs[i]], int(orig_x[i]), int(orig_y[i])) for i in range(patch_count)]
+            definitions.append((texture_name, width, height, patch_infos))
+
+        return definitions
+
+    def _parse_textures(self, lump_name: str, patches: list) -> dict:
+        textures = {}
+
+        for texture_name, width, height, patch_infos in self._read_texture_definitions(lump_name, patches):
+            # Only include patches that exist in the WAD
+            patch_infos = [x for x in patch_infos if x[0] in self._lump_index]
             # Some PWADs have textures that reference patches not present in the WAD. Skip them.
             if len(patch_infos) > 0:
                 textures[texture_name] = {
@@ -268,11 +366,21 @@ class WAD_file:
 
         return textures
 
+    def texture_definitions(self) -> list[tuple[str, str, int, int, list]]:
+        """(TEXTUREx lump, name, width, height, [(patch name, x, y), ...]) of every texture defined in this WAD,
+        including those whose patches are in another WAD (unlike self.textures)."""
+        tex_lumps = [lump for lump in self.lump_names if TEX_REGEX.match(lump)]
+        if (len(tex_lumps) == 0) | ("PNAMES" not in self._lump_index):
+            return []
+
+        patches = self._parse_patches()
+        return [(lump, *x) for lump in tex_lumps for x in self._read_texture_definitions(lump, patches)]
+
     def _gather_textures(self) -> dict:
         tex_lumps = [lump for lump in self.lump_names if TEX_REGEX.match(lump)]
         logger.info(f"Found {len(tex_lumps)} texture lumps.")
 
-        if (len(tex_lumps) == 0) | ("PNAMES" not in self.lump_names):
+        if (len(tex_lumps) == 0) | ("PNAMES" not in self._lump_index):
             logger.info(f"No textures found in this {self.wad_type}.")
             return None
 
@@ -299,23 +407,38 @@ class WAD_file:
 
         return music_lumps
 
-    def export_music(self, music_name: str) -> str:
-        if music_name not in self.lump_names:
+    def get_music_data(self, music_name: str, to_midi: bool = False) -> tuple[bytes, str]:
+        """Returns the data of a music lump and its file extension, in memory.
+        With to_midi, MUS musics are converted to MIDI."""
+        if music_name not in self._misc_lumps:
             raise ValueError(
                 f"Music {music_name} not found in this {self.wad_type}.")
 
-        offset, size = self._misc_lumps[music_name]
-
-        self.bytes.seek(offset)
-        header_id = struct.unpack("<4s", self.bytes.read(4))[0]
+        music_data = self._lump_data(*self._misc_lumps[music_name])
+        header_id = music_data[:4]
         if header_id not in MUSIC_FORMATS.keys():
             raise ValueError(f"Music format not recognised: {header_id}")
 
-        output_path = "output/" + music_name + MUSIC_FORMATS[header_id]
+        if to_midi and header_id == MUS_ID:
+            return mus2mid(music_data), ".mid"
+        return music_data, MUSIC_FORMATS[header_id]
+
+    def write_music(self, music_name: str, output: str | BinaryIO, to_midi: bool = False) -> str:
+        """Writes a music to a path or a file-like object. Returns its file extension."""
+        music_data, extension = self.get_music_data(music_name, to_midi=to_midi)
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(music_data)
+        else:
+            output.write(music_data)
+        return extension
+
+    def export_music(self, music_name: str, output_dir: str = "output") -> str:
+        music_data, extension = self.get_music_data(music_name)
 
-        self.bytes.seek(offset)
+        output_path = os.path.join(output_dir, music_name + extension)
         with open(output_path, "wb") as f:
-            f.write(self.bytes.read(size))
+            f.write(music_data)
         logger.info(f"Exported music {music_name} to {output_path}.")
 
         return output_path
@@ -328,25 +451,84 @@ class WAD_file:
         logger.info(f"Found {len(sounds)} sounds in this WAD.")
         return sounds if sounds else None
 
-    def export_sound(self, sound_name: str) -> str:
+    def _gather_pc_sounds(self):
+        # Still, they can be rendered on demand, see pc_speaker.py.
+        pc_sounds = [x for x in self.lump_names if x.startswith("DP")]
+        logger.info(f"Found {len(pc_sounds)} PC speaker sounds in this WAD.")
+        return pc_sounds if pc_sounds else None
+
+    def write_sound(self, sound_name: str, output: str | BinaryIO) -> None:
+        """Writes a sound as an 8-bit WAV to a path or a file-like object, which does not need to be seekable.
+        PC speaker sounds are rendered as square waves."""
         if sound_name not in self._misc_lumps.keys():
             raise ValueError(
                 f"Sound {sound_name} not found in this {self.wad_type}.")
 
-        lump_data = self._lump_data_by_name(sound_name)
-        sample_rate = struct.unpack_from("<H", lump_data, 2)[0]
-        sample_count = struct.unpack_from("<I", lump_data, 4)[0]
+        lump_data = self._lump_data(*self._misc_lumps[sound_name])
+        if is_pc_speaker(lump_data):
+            sample_rate = PCS_SAMPLERATE
+            tones = decode_pc_speaker(lump_data, sound_name)
+            samples = render_pc_speaker([tones], sample_rate)[0].astype(np.uint8).tobytes()
+        else:
+            sample_rate = struct.unpack_from("<H", lump_data, 2)[0]
+            sample_count = struct.unpack_from("<I", lump_data, 4)[0]
+            samples = lump_data[8: 8 + sample_count]  # removing the padding.
 
-        samples = lump_data[8: 8 + sample_count]  # removing the padding.
-        output_path = f"output/{sound_name}.wav"
-        with wave.open(output_path, "wb") as wav_file:
+        with wave.open(output, "wb") as wav_file:
             wav_file.setnchannels(1)
             wav_file.setsampwidth(1)  # 8-bit
             wav_file.setframerate(sample_rate)
+            # Known beforehand, so that the header never has to be rewritten.
+            wav_file.setnframes(len(samples))
             wav_file.writeframes(samples)
+
+    def get_sound_wav(self, sound_name: str) -> bytes:
+        """Returns a sound as the content of an 8-bit WAV file, in memory."""
+        buffer = io.BytesIO()
+        self.write_sound(sound_name, buffer)
+        return buffer.getvalue()
+
+    def export_sound(self, sound_name: str, output_dir: str = "output") -> str:
+        output_path = os.path.join(output_dir, f"{sound_name}.wav")
+        self.write_sound(sound_name, output_path)
         logger.info(f"Exported sound {sound_name} to {output_path}.")
         return output_path
 
+    def memory_report(self) -> dict:
+        """Estimated bytes retained by the parsed WAD, per subsystem (see MEMORY_SUBSYSTEMS) and per map attribute.
+        A memory-mapped WAD is backed by its file: it is not counted in "buffer" but reported as "mapped"."""
+        seen = set()
+        maps = {}
+        for map_name, parsed_map in list((self.maps or {}).items()):
+            sizes = {k: estimate_nbytes(v, seen) for k, v in list(vars(parsed_map).items())} if parsed_map else {}
+            maps[map_name] = {"total": sum(sizes.values()), **sizes}
+
+        subsystems = attributes_nbytes(self, MEMORY_SUBSYSTEMS, seen)
+        subsystems["maps"] += sum(x["total"] for x in maps.values())
+        return {
+            "total": sum(subsystems.values()),
+            "mapped": mapped_nbytes(self.bytes),
+            "subsystems": subsystems,
+            "maps": maps,
+        }
+
+    def cache_nbytes(self) -> int:
+        """Estimated bytes of the polylines cached in the parsed maps, counted as they are computed.
+        Unlike memory_report, it walks no data: cheap enough for every cache decision."""
+        return sum(x._polylines_nbytes for x in list((self.maps or {}).values()) if x)
+
+    def release_caches(self) -> int:
+        """Drops the polylines cached in the parsed maps, computed again when needed.
+        Returns the estimated number of bytes released."""
+        released = 0
+        for parsed_map in list((self.maps or {}).values()):
+            if parsed_map:
+                released += parsed_map._polylines_nbytes
+                parsed_map._polylines.clear()
+                parsed_map._polylines_nbytes = 0
+        logger.info(f"Released {released / 1e6:.1f} MB of map caches.")
+        return released
+
 
 def open_wad_file(wad_path: str) -> WAD_file:
     """Open a WAD file and return a WAD_file object."""
@@ -358,6 +540,34 @@ def open_wad_file(wad_path: str) -> WAD_file:
         return WAD_file(open(wad_path, "rb"))
 
 
+# WAD data larger than this is spooled to a temporary file and memory-mapped, instead of being kept in memory.
+SPOOL_THRESHOLD = 32 * 1024**2
+
+
+def spool_wad_data(source: bytes | BinaryIO, threshold: int = SPOOL_THRESHOLD) -> BinaryIO:
+    """Returns a file object to parse WAD data from, e.g. an upload.
+    Data larger than threshold is copied to an anonymous temporary file and memory-mapped: the OS then only
+    loads the lumps that are actually read, and can drop them from memory when needed."""
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if len(source) <= threshold:
+            return io.BytesIO(source)
+        source = io.BytesIO(source)
+
+    size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    if size <= threshold:
+        return io.BytesIO(source.read())
+
+    with tempfile.TemporaryFile() as f:
+        shutil.copyfileobj(source, f, length=1 << 20)
+        f.flush()
+        # The mapping stays valid once the file is closed.
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    logger.info(f"WAD data of {size / 1e6:.0f} MB spooled to a memory-mapped temporary file.")
+    return mapped
+
+
 def main():
     parsed_wad = open_wad_file("WADs/DOOM2.WAD")
 
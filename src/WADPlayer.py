@@ -1,16 +1,33 @@
+import hashlib
 import os
+import shutil
+import struct
 import time
 import threading
+import wave
+from typing import BinaryIO, Iterator
+
+import numpy as np
 from loguru import logger
 
+from src.midi_events import read_midi_events
+from src.opl_synth import OPLSynth
+from src.render_cache import RenderCache, render_key
+
 """
 Windows MIDI player and Linux/macOS MIDI to WAV converter using FluidSynth.
 On Windows, this uses the winmm.dll library to play MIDI files directly.
 On Linux/macOS, this uses the pyfluidsynth library to render MIDI files to WAV format.
+The MIDI events are sequenced here and sent to a FluidSynth synthesizer that is kept alive between renders,
+or to the built-in OPL synthesizer playing the GENMIDI instruments of the WAD.
 
 Many thanks to https://github.com/KurtDing for showing me a MIDI Windows implementation.
 """
 
+SAMPLE_RATE = 44100
+RELEASE_TIME = 2.0  # seconds rendered after the last MIDI event
+BLOCK_SIZE = 4096  # frames rendered at once when streaming
+
 
 class WinMIDIPlayer:
     def __init__(self, file_path: str):
@@ -69,25 +86,203 @@ class WinMIDIPlayer:
         self.stop_flag = True
 
 
+def write_wav(samples: np.ndarray, output: str | BinaryIO, samplerate: int = SAMPLE_RATE) -> None:
+    """Writes int16 samples of shape (n, channels) to a WAV file or file-like object."""
+    with wave.open(output, "wb") as wav_file:
+        wav_file.setnchannels(samples.shape[1])
+        wav_file.setsampwidth(2)  # 16-bit
+        wav_file.setframerate(samplerate)
+        wav_file.writeframes(np.ascontiguousarray(samples, dtype="<i2").tobytes())
+
+
+def wav_header(n_frames: int, n_channels: int = 2, samplerate: int = SAMPLE_RATE) -> bytes:
+    """Header of a 16-bit PCM WAV file, written before its samples are known."""
+    data_size = n_frames * n_channels * 2
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, n_channels, samplerate, samplerate * n_channels * 2, n_channels * 2, 16,
+        b"data", data_size,
+    )
+
+
+def write_ogg(samples: np.ndarray, output: str | BinaryIO, samplerate: int = SAMPLE_RATE) -> None:
+    """Writes int16 samples of shape (n, channels) to an OGG Vorbis file, using the optional soundfile package."""
+    try:
+        import soundfile
+    except ImportError as exc:
+        raise ImportError(
+            f"Failed to load soundfile: {exc}. OGG encoding requires it ('pip install soundfile')."
+        ) from exc
+    soundfile.write(output, samples, samplerate, format="OGG", subtype="VORBIS")
+
+
+AUDIO_WRITERS = {"wav": write_wav, "ogg": write_ogg}
+
+
 class MIDIWavConverter:
-    def __init__(self, file_path: str, soundfont_path: str = "media/gzdoom.sf2"):
+    def __init__(
+        self,
+        file_path: str | None = None,
+        soundfont_path: str = "media/gzdoom.sf2",
+        samplerate: int = SAMPLE_RATE,
+        gain: float = 0.2,
+        cache: RenderCache | None = None,
+        genmidi: bytes | None = None,
+    ):
+        """Renders MIDI files or data to audio with FluidSynth.
+        The synthesizer and its SoundFont are loaded once, on the first render, and reused for the next ones.
+        With a RenderCache, WAV renders are stored on disk and cache hits never start FluidSynth.
+        Given the data of a GENMIDI lump, the built-in OPL synthesizer is used instead, with no SoundFont."""
         self.file_path = file_path
         self.soundfont_path = soundfont_path
+        self.samplerate = samplerate
+        self.gain = gain
+        self.cache = cache
+        self.genmidi = genmidi
 
-        try:
-            import fluidsynth as _fs
-        except ImportError as exc:
-            raise ImportError(
-                f"Failed to load FluidSynth: {exc}. "
-                "Ensure pyfluidsynth is installed ('pip install pyfluidsynth') "
-                "and the FluidSynth native library is available "
-                "('sudo apt-get install libfluidsynth-dev' on Debian/Ubuntu)."
-            ) from exc
-
-        if not os.path.isfile(soundfont_path):
+        if genmidi is None and not os.path.isfile(soundfont_path):
             raise FileNotFoundError(f"SoundFont not found: {soundfont_path}")
 
-        self._fs = _fs
+        self._synth = None
+
+    def _get_synth(self):
+        if self._synth is None and self.genmidi is not None:
+            self._synth = OPLSynth(self.genmidi, samplerate=self.samplerate, gain=self.gain)
+            logger.info("OPL synthesizer loaded with the GENMIDI instruments.")
+
+        if self._synth is None:
+            try:
+                import fluidsynth
+            except ImportError as exc:
+                raise ImportError(
+                    f"Failed to load FluidSynth: {exc}. "
+                    "Ensure pyfluidsynth is installed ('pip install pyfluidsynth') "
+                    "and the FluidSynth native library is available "
+                    "('sudo apt-get install libfluidsynth-dev' on Debian/Ubuntu)."
+                ) from exc
+
+            synth = fluidsynth.Synth(gain=self.gain, samplerate=self.samplerate)
+            synth.setting("synth.lock-memory", 0)
+            synth.sfload(self.soundfont_path, update_midi_preset=1)
+            self._synth = synth
+            logger.info(f"SoundFont loaded: {self.soundfont_path}")
+        return self._synth
+
+    def _reset(self) -> None:
+        """Silences the synthesizer and resets its channels between two tracks."""
+        synth = self._get_synth()
+        for channel in range(16):
+            synth.cc(channel, 120, 0)  # All sound off
+            synth.cc(channel, 121, 0)  # Reset all controllers
+            synth.program_change(channel, 0)
+
+    def _send_event(self, status: int, data1: int, data2: int) -> None:
+        synth = self._synth
+        channel = status & 0x0F
+        event = status & 0xF0
+        if event == 0x80:
+            synth.noteoff(channel, data1)
+        elif event == 0x90:
+            synth.noteon(channel, data1, data2)
+        elif event == 0xB0:
+            synth.cc(channel, data1, data2)
+        elif event == 0xC0:
+            synth.program_change(channel, data1)
+        elif event == 0xE0:
+            synth.pitch_bend(channel, (data1 | (data2 << 7)) - 8192)
+
+    def _sequence(self, midi_data: bytes, release_time: float) -> tuple[list, list[int], int]:
+        """Parses MIDI data into its events, the sample position of each event and the total number of frames."""
+        events = read_midi_events(midi_data)
+        positions = [int(round(time * self.samplerate)) for time, _, _, _ in events]
+        n_frames = (positions[-1] if positions else 0) + int(release_time * self.samplerate)
+        return events, positions, n_frames
+
+    def _stream_events(
+        self, events: list, positions: list[int], n_frames: int, block_size: int
+    ) -> Iterator[np.ndarray]:
+        self._reset()
+        synth = self._synth
+
+        event_idx = 0
+        for block_start in range(0, n_frames, block_size):
+            block_end = min(block_start + block_size, n_frames)
+
+            # Events of this block are sent at their exact sample position.
+            parts = []
+            rendered = block_start
+            while event_idx < len(events) and positions[event_idx] < block_end:
+                if positions[event_idx] > rendered:
+                    parts.append(synth.get_samples(positions[event_idx] - rendered))
+                    rendered = positions[event_idx]
+                self._send_event(*events[event_idx][1:])
+                event_idx += 1
+            if block_end > rendered:
+                parts.append(synth.get_samples(block_end - rendered))
+
+            yield np.concatenate(parts).astype(np.int16).reshape((-1, 2))
+
+    def stream(
+        self, midi_data: bytes, block_size: int = BLOCK_SIZE, release_time: float = RELEASE_TIME
+    ) -> Iterator[np.ndarray]:
+        """Renders MIDI data block by block, yielding stereo int16 samples of shape (block_size, 2).
+        Only one block is held in memory at a time. The synthesizer is shared: run one stream at a time per converter.
+
+        Parameters
+        ----------
+        midi_data : bytes
+            Content of a Standard MIDI File.
+        block_size : int
+            Number of frames of each block. The last one is shorter.
+        release_time : float
+            Seconds rendered after the last event, to let the notes fade out.
+        """
+        yield from self._stream_events(*self._sequence(midi_data, release_time), block_size)
+
+    def stream_wav(
+        self, midi_data: bytes, block_size: int = BLOCK_SIZE, release_time: float = RELEASE_TIME
+    ) -> Iterator[bytes]:
+        """Same as stream, but yields a WAV file: its header first, then the PCM data of each block.
+        The length of the track is known from its events, so the header is complete from the start."""
+        events, positions, n_frames = self._sequence(midi_data, release_time)
+        yield wav_header(n_frames, 2, self.samplerate)
+        for samples in self._stream_events(events, positions, n_frames, block_size):
+            yield samples.astype("<i2").tobytes()
+
+    def render(self, midi_data: bytes, release_time: float = RELEASE_TIME) -> np.ndarray:
+        """Renders MIDI data to stereo int16 samples of shape (n, 2), sequencing the events on the reused synthesizer.
+
+        Parameters
+        ----------
+        midi_data : bytes
+            Content of a Standard MIDI File.
+        release_time : float
+            Seconds rendered after the last event, to let the notes fade out.
+        """
+        return np.concatenate(list(self.stream(midi_data, release_time=release_time)))
+
+    def render_key(self, midi_data: bytes, release_time: float = RELEASE_TIME) -> str:
+        """Cache key of a render, from the MIDI data, the SoundFont (or GENMIDI) and the synthesizer settings."""
+        settings = {"samplerate": self.samplerate, "gain": self.gain, "release_time": release_time, "format": "wav"}
+        if self.genmidi is not None:
+            settings["genmidi"] = hashlib.sha1(self.genmidi).hexdigest()
+            return render_key(midi_data, None, settings)
+        return render_key(midi_data, self.soundfont_path, settings)
+
+    def render_wav(self, midi_data: bytes, release_time: float = RELEASE_TIME) -> str:
+        """Renders MIDI data to a WAV file of the cache and returns its path.
+        A render already in the cache is returned right away."""
+
+        if self.cache is None:
+            raise ValueError("render_wav needs a RenderCache.")
+
+        key = self.render_key(midi_data, release_time)
+        cached_path = self.cache.get(key)
+        if cached_path is not None:
+            return cached_path
+
+        return self.cache.put(key, self.stream_wav(midi_data, release_time=release_time))
 
     def to_wav(self, output_path: str | None = None) -> str:
         """Render the MIDI file to a WAV file using FluidSynth.
@@ -95,28 +290,39 @@ class MIDIWavConverter:
         Parameters
         ----------
         output_path : str, optional
-            Destination WAV path. Defaults to the MIDI path with a .wav extension.
+            Destination WAV path. Defaults to the MIDI path with a .wav extension,
+            or to the cached file when the converter has a RenderCache.
 
         Returns
         -------
         str
-            Absolute path to the rendered WAV file.
+            Path to the rendered WAV file.
         """
 
+        with open(self.file_path, "rb") as f:
+            midi_data = f.read()
+
+        if self.cache is not None:
+            cached_path = self.render_wav(midi_data)
+            if output_path is None:
+                return cached_path
+            shutil.copyfile(cached_path, output_path)
+            return output_path
+
         if output_path is None:
             output_path = os.path.splitext(self.file_path)[0] + ".wav"
 
         logger.info(
             f"Rendering MIDI file to WAV: {self.file_path} to {output_path}")
 
-        fs = self._fs.Synth()
-        fs.setting("audio.driver", "file")
-        fs.setting("audio.file.name", output_path)
-        fs.setting("audio.file.type", "wav")
-        fs.setting("synth.lock-memory", 0)
-        fs.sfload(self.soundfont_path)
-        fs.midi2audio(self.file_path, output_path)
-        fs.delete()
+        with open(output_path, "wb") as f:
+            f.writelines(self.stream_wav(midi_data))
 
         logger.info(f"WAV written to: {output_path}")
         return output_path
+
+    def close(self) -> None:
+        """Releases the synthesizer."""
+        if self._synth is not None:
+            self._synth.delete()
+            self._synth = None
@@ -3,12 +3,18 @@ import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 import numpy as np
 import argparse
+import io
 import struct
 import re
 
 from loguru import logger
 
 from src.WADParser import WAD_file, open_wad_file
+from src.floor_renderer import render_floors
+from src.instrumentation import PhaseReport, instrumented
+from src.map_payload import encode_map_geometry
+from src.map_raster import MapRaster, rasterize_map
+from src.memory import LRUCache
 from src.palettes import MAP_CMAPS
 
 """Main class to display WAD files.
@@ -16,7 +22,7 @@ This class is used to display the content of a WAD file. It can display flats, t
 
 CLI use:
 
-python WADViewer.py -w <path to WAD_file> -m <map pattern> -f <output_format> -p <palette_name> -s <scale> -mw <max_width>
+python WADViewer.py -w <path to WAD_file> -m <map pattern> -f <output_format> -p <palette_name> -s <scale> -mw <max_width> [--floors]
 
 Or use 
 python Wadviever.py -h 
@@ -24,6 +30,13 @@ python Wadviever.py -h
 to get help on the command line arguments.
 """
 
+# Rasters kept by a viewer: each holds the coverage of every layer, up to max_width pixels wide.
+MAX_MAP_RASTERS = 8
+# Memory budget of the gallery thumbnails of a viewer, shared by all the sessions.
+MAX_THUMBNAIL_BYTES = 64 * 1024**2
+# Memory budget of the binary map geometries of a viewer.
+MAX_MAP_PAYLOAD_BYTES = 32 * 1024**2
+
 
 class WadViewer:
     def __init__(self, wad: WAD_file):
@@ -31,8 +44,21 @@ class WadViewer:
             raise TypeError(
                 f"WadViewer expects a WAD_file object, got {type(wad)}.")
         self.wad = wad
-
-    def get_flat_data(self, offset: int, size: int) -> np.ndarray:
+        # Time and bytes read of each method, see src/instrumentation.py.
+        self.report = PhaseReport("WadViewer", bytes_counter=wad.thread_bytes_read)
+        # Palette-independent rasters of the maps, keyed by (map_name, scale, max_width). Only the last used are kept.
+        self._map_rasters = LRUCache(max_items=MAX_MAP_RASTERS)
+        # Palette indices of the flats, used to texture the floors, and their size.
+        self._flat_indices = None
+        self._flat_indices_nbytes = 0
+        # PNG thumbnails of the galleries, keyed by (kind, name, max_size). Only the last used are kept.
+        self._thumbnails = LRUCache(max_bytes=MAX_THUMBNAIL_BYTES)
+        # Binary geometry of the maps for the client-side viewer, keyed by map name. Only the last used are kept.
+        self._map_payloads = LRUCache(max_bytes=MAX_MAP_PAYLOAD_BYTES)
+
+    @instrumented()
+    def get_flat_indices(self, offset: int, size: int) -> np.ndarray:
+        """Palette indices of a flat, as a uint8 array."""
         if size == 320 * 200:
             shape = (200, 320)
 
@@ -43,15 +69,17 @@ class WadViewer:
             logger.debug(size)
             raise NotImplementedError("This flat has an unknown size.")
 
-        self.wad.bytes.seek(offset)
-        flat = self.wad.bytes.read(size)
+        flat = self.wad._lump_data(offset, size)
+
+        return np.frombuffer(flat, dtype=np.uint8).reshape(shape)
 
-        indices = np.array(struct.unpack(
-            f"{size}B", flat), dtype=np.uint8).reshape(shape)
-        rgb_image = self.wad.palette[indices]
+    def get_flat_data(self, offset: int, size: int, palette: int = 0, light: int = 0) -> np.ndarray:
+        indices = self.get_flat_indices(offset, size)
+        rgb_image = self.wad.to_rgba(indices, palette=palette, light=light)
 
         return rgb_image
 
+    @instrumented()
     def draw_flat(self, flat_name: str, ax: mpl.axes.Axes | None = None) -> plt.figure:
 
         if flat_name not in self.wad._misc_lumps.keys():
@@ -74,6 +102,7 @@ class WadViewer:
             fig.tight_layout(pad=1.2)
             return fig
 
+    @instrumented()
     def draw_map(
         self,
         map_name: str,
@@ -84,8 +113,12 @@ class WadViewer:
         show_secrets: bool = False,
         show_specials: bool = True,
         show_things: bool = False,
+        show_floors: bool = False,
+        simplify: float = 0.5,
         **kwargs,
     ) -> plt.figure:
+        """Plots a map. Connected lines are drawn as polylines, and details smaller than simplify pixels are dropped
+        (0 keeps the exact geometry). With show_floors, the sectors are filled with their textured floors."""
         if map_name not in self.wad.maps.keys():
             raise ValueError(f"Map {map_name} not found in this WAD.")
 
@@ -119,6 +152,11 @@ class WadViewer:
 
             output_fig = True
 
+        # Size of a pixel in map units, to drop the details that would not be visible anyway.
+        tolerance = 0.0
+        if simplify > 0:
+            tolerance = simplify * map_data.map_dims[0] / ax.get_window_extent().width
+
         cmap = MAP_CMAPS[palette]
 
         bckgrd_color = [x / 255 for x in cmap["background"]]
@@ -129,20 +167,29 @@ class WadViewer:
         linewidth_secondary = 0.2 + 0.2 * scale
         things_size = 2 * scale
 
-        twosided_args = {"colors": twosided_color, "linewidths": linewidth_secondary, "capstyle": "round"} | supp_args[
-            "twosided"
-        ]
+        twosided_args = {
+            "colors": twosided_color,
+            "linewidths": linewidth_secondary,
+            "capstyle": "round",
+            "joinstyle": "round",
+        } | supp_args["twosided"]
         block_args = {"colors": block_color, "linewidths": linewidth_primary,
-                      "capstyle": "round"} | supp_args["block"]
+                      "capstyle": "round", "joinstyle": "round"} | supp_args["block"]
 
         ax.set_facecolor(bckgrd_color)
         if output_fig:
             fig.patch.set_facecolor(bckgrd_color)
 
-        twosided = LineCollection(map_data.twosided, **twosided_args)
+        if show_floors:
+            # One floor pixel per figure pixel.
+            floor_width = int(np.ceil(ax.get_window_extent().width))
+            floor_img, extent = self.get_floor_data(map_name, max_width=floor_width)
+            ax.imshow(floor_img, extent=extent, interpolation="nearest")
+
+        twosided = LineCollection(map_data.polylines("twosided", tolerance), **twosided_args)
         ax.add_collection(twosided)
 
-        bloc_lines = LineCollection(map_data.block, **block_args)
+        bloc_lines = LineCollection(map_data.polylines("block", tolerance), **block_args)
         ax.add_collection(bloc_lines)
 
         # secial and secret lines are drawn on top of regular lines.
@@ -150,7 +197,7 @@ class WadViewer:
             special_color = [x / 255 for x in cmap["special"]]
             special_args = {"colors": special_color,
                             "linewidths": linewidth_primary} | supp_args["special"]
-            special_lines = LineCollection(map_data.special, **special_args)
+            special_lines = LineCollection(map_data.polylines("special", tolerance), **special_args)
             ax.add_collection(special_lines)
 
         if show_secrets:
@@ -158,7 +205,7 @@ class WadViewer:
                 secret_color = [x / 255 for x in cmap["secret"]]
                 secret_args = {"colors": secret_color,
                                "linewidths": linewidth_primary} | supp_args["secret"]
-                secret_lines = LineCollection(map_data.secret, **secret_args)
+                secret_lines = LineCollection(map_data.polylines("secret", tolerance), **secret_args)
                 ax.add_collection(secret_lines)
 
         if show_things:
@@ -178,7 +225,88 @@ class WadViewer:
             fig.tight_layout(pad=0.2)
             return fig
 
-    def get_tex_data(self, tex_name: str) -> np.ndarray:
+    @instrumented()
+    def get_map_raster(self, map_name: str, scale: float = 2.0, max_width: int = 4096) -> MapRaster:
+        if map_name not in self.wad.maps.keys():
+            raise ValueError(f"Map {map_name} not found in this WAD.")
+
+        key = (map_name, scale, max_width)
+        raster = self._map_rasters.get(key)
+        if raster is None:
+            raster = self._map_rasters.put(key, rasterize_map(self.wad.maps[map_name], scale=scale, max_width=max_width))
+        return raster
+
+    @instrumented()
+    def get_map_payload(self, map_name: str) -> bytes:
+        """Binary geometry of a map, drawn by the client-side viewer. See map_payload.py."""
+        if map_name not in self.wad.maps.keys():
+            raise ValueError(f"Map {map_name} not found in this WAD.")
+
+        payload = self._map_payloads.get(map_name)
+        if payload is None:
+            payload = self._map_payloads.put(map_name, encode_map_geometry(self.wad.maps[map_name]))
+        return payload
+
+    @instrumented()
+    def render_map(
+        self,
+        map_name: str,
+        palette: str = "OMGIFOL",
+        max_width: int = 4096,
+        scale: float = 2.0,
+        show_secrets: bool = False,
+        show_specials: bool = True,
+        show_things: bool = False,
+    ) -> np.ndarray:
+        """Same as draw_map, but returns an RGB image recolored from a cached raster of the map.
+        Only the first call for a given map, scale and max_width draws the geometry:
+        changing the palette or the displayed layers afterwards is a simple look-up table operation."""
+
+        raster = self.get_map_raster(map_name, scale=scale, max_width=max_width)
+
+        visible_layers = ["twosided", "block"]
+        if show_specials:
+            visible_layers.append("special")
+        if show_secrets:
+            visible_layers.append("secret")
+        if show_things:
+            visible_layers.append("things")
+
+        return raster.recolor(MAP_CMAPS[palette], tuple(visible_layers))
+
+    @instrumented()
+    def get_floor_data(
+        self, map_name: str, max_width: int = 2048, plane: str = "floor", palette: int = 0
+    ) -> tuple[np.ndarray, tuple[float, float, float, float]]:
+        """Renders the floors (or ceilings) of a map with their flats and light levels.
+        Returns an RGBA image and its extent in map units, to be plotted under the map lines."""
+
+        if map_name not in self.wad.maps.keys():
+            raise ValueError(f"Map {map_name} not found in this WAD.")
+
+        map_data = self.wad.maps[map_name]
+        if map_data.sectors is None or map_data.sidedefs is None:
+            raise ValueError(f"Map {map_name} has no sectors.")
+
+        if self._flat_indices is None:
+            # Built aside, then published at once: other sessions never see it half filled.
+            flat_indices = {}
+            for flat_name in self.wad.flats or []:
+                offset, size = self.wad._misc_lumps[flat_name]
+                if size == 320 * 200:
+                    continue
+                try:
+                    flat_indices[flat_name] = self.get_flat_indices(offset, size)
+                except NotImplementedError:
+                    logger.warning(f"Flat {flat_name} has an unknown size, it will not be drawn.")
+            self._flat_indices_nbytes = sum(x.nbytes for x in flat_indices.values())
+            self._flat_indices = flat_indices
+
+        resolution = max(map_data.map_dims) / max_width
+        return render_floors(map_data, self._flat_indices, self.wad.color_luts[palette], resolution, plane=plane)
+
+    @instrumented()
+    def get_tex_data(self, tex_name: str, palette: int = 0, light: int = 0) -> np.ndarray:
         def paste_array(original: np.ndarray, paste: np.ndarray, alpha: np.ndarray, x: int, y: int):
             """
             Pastes a 2D numpy array into another 2D numpy array at the specified (x, y) position.
@@ -218,12 +346,12 @@ class WadViewer:
 
         for patch_name, x, y in texture_data["patches"]:
 
-            if patch_name not in self.wad.lump_names:
+            if patch_name not in self.wad._lump_index:
                 logger.warning(
                     f"Unknown patch '{patch_name}' in texture '{tex_name}'.")
                 continue
 
-            idx = self.wad.lump_names.index(patch_name)
+            idx = self.wad._lump_index[patch_name]
 
             _, offset, size = self.wad.lumps[idx]
             img, alpha, _, _ = self.get_patch_data(offset, size)
@@ -233,12 +361,13 @@ class WadViewer:
 
         alphamap = alphamap.T[:, :, np.newaxis]
 
-        rgb_img = self.wad.palette[pixmap.T]
+        rgb_img = self.wad.to_rgba(pixmap.T, palette=palette, light=light)
 
         rgba_img = rgb_img * alphamap
 
         return rgba_img
 
+    @instrumented()
     def draw_tex(self, tex_name: str, ax: mpl.axes.Axes | None = None) -> plt.figure:
 
         if tex_name not in self.wad.textures.keys():
@@ -260,42 +389,40 @@ class WadViewer:
             fig.tight_layout(pad=1.2)
             return fig
 
+    @instrumented()
     def get_patch_data(self, offset: int, size: int) -> np.ndarray:
         # See https://doomwiki.org/wiki/Picture_format for documentation
 
-        self.wad.bytes.seek(offset)
+        # The whole lump is read at once, the WAD file being shared with other threads.
+        patch_data = self.wad._lump_data(offset, size)
 
-        width, height, left_offset, top_offset = struct.unpack(
-            "<2H2h", self.wad.bytes.read(8))
+        width, height, left_offset, top_offset = struct.unpack_from("<2H2h", patch_data)
 
-        column_offsets = [struct.unpack("<I", self.wad.bytes.read(4))[
-            0] for _ in range(width)]
+        column_offsets = struct.unpack_from(f"<{width}I", patch_data, 8)
 
         image_data = np.zeros((width, height), dtype=np.uint8)
         image_alpha = np.zeros((width, height), dtype=np.uint8)
 
         for i in range(width):
 
-            inner_offset = column_offsets[i] + offset
-            self.wad.bytes.seek(inner_offset)  # Move to column start
+            pos = column_offsets[i]  # Move to column start
 
             while True:
-                row_start = struct.unpack("<B", self.wad.bytes.read(1))[
-                    0]  # Read row start
+                row_start = patch_data[pos]  # Read row start
                 if row_start == 0xFF:
                     break  # End of column
 
-                pixel_count = ord(self.wad.bytes.read(1))
-                _ = self.wad.bytes.read(1)  # Skip unused byte
-
-                pixels = list(self.wad.bytes.read(pixel_count))
-                _ = self.wad.bytes.read(1)  # Skip column termination byte
+                pixel_count = patch_data[pos + 1]
+                # Skip unused byte
+                pixels = np.frombuffer(patch_data, dtype=np.uint8, count=pixel_count, offset=pos + 3)
+                pos += pixel_count + 4  # Skip column termination byte
 
                 image_data[i, row_start: row_start + pixel_count] = pixels
                 image_alpha[i, row_start: row_start + pixel_count] = 1
 
         return image_data, image_alpha, left_offset, top_offset
 
+    @instrumented()
     def draw_patch(self, patch_name: str, ax: mpl.axes.Axes | None = None) -> plt.figure:
 
         if patch_name not in self.wad._misc_lumps.keys():
@@ -311,7 +438,7 @@ class WadViewer:
         img_data, alpha, left, top = self.get_patch_data(offset, size)
 
         alpha = alpha.T[:, :, np.newaxis] * np.ones((1, 1, 4))
-        rgb_img = self.wad.palette[img_data.T]
+        rgb_img = self.wad.to_rgba(img_data.T)
         rgba_img = rgb_img * alpha
 
         ax.imshow(rgba_img / 255, interpolation="nearest", aspect=1.2)
@@ -320,6 +447,66 @@ class WadViewer:
             fig.tight_layout(pad=1.2)
             return fig
 
+    @instrumented()
+    def get_image_data(self, kind: str, name: str) -> np.ndarray:
+        """RGBA image of a flat, texture or sprite."""
+        if kind == "flats":
+            return self.get_flat_data(*self.wad._misc_lumps[name])
+        if kind == "textures":
+            return self.get_tex_data(name)
+        if kind == "sprites":
+            img, alpha, _, _ = self.get_patch_data(*self.wad._misc_lumps[name])
+            rgba_img = self.wad.to_rgba(img.T)
+            rgba_img[:, :, 3] = alpha.T * 255
+            return rgba_img
+        raise ValueError(f"Unknown image kind: {kind}")
+
+    @instrumented()
+    def get_thumbnail(self, kind: str, name: str, max_size: int = 128) -> bytes:
+        """PNG thumbnail of a flat, texture or sprite, at most max_size pixels wide and high.
+        Thumbnails are cached, so that each asset is rendered and encoded once for all the gallery pages."""
+        key = (kind, name, max_size)
+        thumbnail = self._thumbnails.get(key)
+        if thumbnail is None:
+            rgba_img = self.get_image_data(kind, name)
+            # Nearest-neighbour reduction, keeping the pixel art sharp.
+            step = -(-max(rgba_img.shape[:2]) // max_size)
+            buffer = io.BytesIO()
+            plt.imsave(buffer, np.clip(rgba_img[::step, ::step], 0, 255).astype(np.uint8), format="png")
+            thumbnail = self._thumbnails.put(key, buffer.getvalue())
+        return thumbnail
+
+    def memory_report(self) -> dict:
+        """Estimated bytes retained by the viewer caches, with the memory report of its WAD."""
+        caches = self._cache_sizes()
+        wad_report = self.wad.memory_report()
+        return {"total": wad_report["total"] + sum(caches.values()), "caches": caches, "wad": wad_report}
+
+    def _cache_sizes(self) -> dict[str, int]:
+        # Sizes counted as the caches are filled: nothing is walked.
+        return {
+            "map_rasters": self._map_rasters.nbytes,
+            "flat_indices": self._flat_indices_nbytes,
+            "thumbnails": self._thumbnails.nbytes,
+            "map_payloads": self._map_payloads.nbytes,
+        }
+
+    def cache_nbytes(self) -> int:
+        """Estimated bytes of the viewer caches and of the caches of its WAD, counted as they are filled.
+        Unlike memory_report, it walks no data: cheap enough for every cache decision."""
+        return sum(self._cache_sizes().values()) + self.wad.cache_nbytes()
+
+    def release_caches(self) -> int:
+        """Drops the decoded caches of the viewer and of its WAD, computed again when needed.
+        Returns the estimated number of bytes released."""
+        released = sum(self._cache_sizes().values())
+        self._map_rasters.clear()
+        self._flat_indices = None
+        self._flat_indices_nbytes = 0
+        self._thumbnails.clear()
+        self._map_payloads.clear()
+        return released + self.wad.release_caches()
+
 
 if __name__ == "__main__":
 
@@ -336,6 +523,8 @@ if __name__ == "__main__":
                         help="Scale of the map", default=2.0)
     parser.add_argument("--max_width", "-mw", type=int,
                         help="Max width (px) of the map", default=4096)
+    parser.add_argument("--floors", action="store_true",
+                        help="Fill the sectors with their floor flats")
 
     args = parser.parse_args()
     wad = open_wad_file(args.wad)
@@ -347,6 +536,6 @@ if __name__ == "__main__":
 
     for map_name in maps_to_draw:
         fig = viewer.draw_map(map_name, palette=args.palette,
-                              scale=args.scale, max_width=args.max_width)
+                              scale=args.scale, max_width=args.max_width, show_floors=args.floors)
         fig.savefig(
             f"output/{args.wad.split('/')[-1]}_{map_name}.{args.format}", bbox_inches="tight", dpi=150)
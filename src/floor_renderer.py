@@ -0,0 +1,164 @@
+import numpy as np
+from loguru import logger
+
+from src.map_parser import ParsedMap
+
+"""Top-down rendering of the sector floors (or ceilings), textured with their flats and shaded by their light level.
+Sectors are rasterized with a scanline algorithm over the linedefs, fully vectorized with NumPy:
+every linedef crossing a scanline gives the sector found on its right (+x) side,
+and each pixel takes the sector of the closest crossing on its left."""
+
+
+def rasterize_sectors(parsed_map: ParsedMap, resolution: float) -> tuple[np.ndarray, tuple[float, float, float, float]]:
+    """Computes the sector index of each pixel of the map, -1 outside of any sector.
+
+    Parameters
+    ----------
+    parsed_map : ParsedMap
+        Map with its vertices, linedefs and sidedefs.
+    resolution : float
+        Size of a pixel, in map units.
+
+    Returns
+    -------
+    np.ndarray
+        int32 array of shape (height, width) of sector indices. The first row is the top (max y) of the map.
+    tuple
+        Extent (left, right, bottom, top) of the image in map units, as expected by matplotlib imshow.
+    """
+
+    x_min, x_max, y_min, y_max = parsed_map.map_lims
+    width = max(int(np.ceil((x_max - x_min) / resolution)), 1)
+    height = max(int(np.ceil((y_max - y_min) / resolution)), 1)
+    extent = (x_min, x_min + width * resolution, y_max - height * resolution, y_max)
+
+    vertices = parsed_map.vertices.astype(np.float64)
+    linedefs = parsed_map.linedefs
+    sidedef_sectors = parsed_map.sidedefs["sector"].astype(np.int32)
+
+    def side_sector(sidedef: np.ndarray) -> np.ndarray:
+        valid = (sidedef >= 0) & (sidedef < len(sidedef_sectors))
+        return np.where(valid, sidedef_sectors[np.clip(sidedef, 0, len(sidedef_sectors) - 1)], -1)
+
+    x1, y1 = vertices[linedefs[:, 0]].T
+    x2, y2 = vertices[linedefs[:, 1]].T
+
+    # The front side of a linedef is on its right. Going towards +x, we enter the right side of upward lines.
+    right_sector = np.where(y2 > y1, side_sector(linedefs[:, 2]), side_sector(linedefs[:, 3]))
+
+    # Scanlines go through the pixel centers. A line covers the rows whose center is in [y_low, y_high[.
+    y_low, y_high = np.minimum(y1, y2), np.maximum(y1, y2)
+    row_start = np.floor((y_max - y_high) / resolution - 0.5).astype(np.int64) + 1
+    row_end = np.floor((y_max - y_low) / resolution - 0.5).astype(np.int64)
+    row_start = np.clip(row_start, 0, height)
+    row_end = np.clip(row_end, -1, height - 1)
+    counts = np.maximum(row_end - row_start + 1, 0)
+
+    # One entry per (line, row) crossing.
+    line_idx = np.repeat(np.arange(len(linedefs)), counts)
+    rows = row_start[line_idx] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    y = y_max - (rows + 0.5) * resolution
+    x = x1[line_idx] + (y - y1[line_idx]) * (x2 - x1)[line_idx] / (y2 - y1)[line_idx]
+
+    # First pixel whose center is on the right of the crossing.
+    cols = np.clip(np.ceil((x - x_min) / resolution - 0.5).astype(np.int64), 0, None)
+    inside = cols < width
+    rows, cols, x, sectors = rows[inside], cols[inside], x[inside], right_sector[line_idx[inside]]
+
+    # When several crossings fall before the same pixel, the closest one (largest x) wins.
+    order = np.lexsort((x, cols, rows))
+    rows, cols, sectors = rows[order], cols[order], sectors[order]
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, sectors = rows[last], cols[last], sectors[last]
+
+    crossing_sector = np.full((height, width), -1, dtype=np.int32)
+    crossing_sector[rows, cols] = sectors
+    last_crossing = np.full((height, width), -1, dtype=np.int32)
+    last_crossing[rows, cols] = cols
+    np.maximum.accumulate(last_crossing, axis=1, out=last_crossing)
+
+    sector_map = np.take_along_axis(crossing_sector, np.maximum(last_crossing, 0), axis=1)
+    sector_map[last_crossing < 0] = -1
+
+    return sector_map, extent
+
+
+def render_floors(
+    parsed_map: ParsedMap,
+    flats: dict[str, np.ndarray],
+    light_luts: np.ndarray,
+    resolution: float,
+    plane: str = "floor",
+) -> tuple[np.ndarray, tuple[float, float, float, float]]:
+    """Renders the floors (or ceilings) of a map, textured with their flats and lit with the COLORMAP light levels.
+
+    Parameters
+    ----------
+    parsed_map : ParsedMap
+        Map to render.
+    flats : dict[str, np.ndarray]
+        Palette indices of the flats, as uint8 arrays of shape (height, 64).
+    light_luts : np.ndarray
+        RGBA look-up tables of shape (n, 256, 4) for each COLORMAP light level, the first one being the brightest.
+    resolution : float
+        Size of a pixel, in map units.
+    plane : str
+        "floor" or "ceiling".
+
+    Returns
+    -------
+    np.ndarray
+        RGBA uint8 image, transparent outside of the sectors or where the flat is unknown.
+    tuple
+        Extent (left, right, bottom, top) of the image in map units.
+    """
+
+    if plane not in ["floor", "ceiling"]:
+        raise ValueError(f"Unknown plane: {plane}.")
+
+    sector_map, extent = rasterize_sectors(parsed_map, resolution)
+    sectors = parsed_map.sectors
+    sector_map[sector_map >= len(sectors)] = -1
+
+    # Flats of each sector, as indices in a stack of all the used flats. Missing flats are left transparent.
+    flat_names = [x.decode("ascii", errors="ignore").rstrip("\0").upper() for x in sectors[plane]]
+    used_flats = sorted(set(x for x in flat_names if x in flats))
+    flat_idx = np.array([used_flats.index(x) if x in flats else -1 for x in flat_names] + [-1], dtype=np.int32)
+
+    # Flats are 64 pixels wide, but a few of them are taller. They are stacked with padding, along with their height.
+    stack_height = max([flats[x].shape[0] for x in used_flats], default=64)
+    flat_stack = np.zeros((len(used_flats) + 1, stack_height, 64), dtype=np.uint8)
+    flat_heights = np.full(len(used_flats) + 1, 64, dtype=np.int32)
+    for i, name in enumerate(used_flats):
+        flat_stack[i, : flats[name].shape[0]] = flats[name]
+        flat_heights[i] = flats[name].shape[0]
+
+    # The light level is turned into a COLORMAP index: 255 is the brightest one, each step of 8 is one table darker.
+    light_idx = np.clip((255 - sectors["light"].astype(np.int32)) // 8, 0, min(31, len(light_luts) - 1))
+    light_idx = np.append(light_idx, 0).astype(np.int32)
+
+    # -1 (no sector) indexes the extra entry appended to flat_idx and light_idx.
+    pixel_flat = flat_idx[sector_map]
+    pixel_light = light_idx[sector_map]
+
+    # Flats are aligned on the world grid, with the y axis going down.
+    height, width = sector_map.shape
+    left, _, _, top = extent
+    world_x = np.floor(left + (np.arange(width) + 0.5) * resolution).astype(np.int32)
+    world_y = np.floor(top - (np.arange(height) + 0.5) * resolution).astype(np.int32)
+    tex_u = world_x & 63
+
+    # Linear indices in the flat stack, computed in int32 to keep the memory traffic low on large images.
+    texel_idx = pixel_flat * np.int32(stack_height * 64) + tex_u[np.newaxis, :]
+    if np.all(flat_heights == 64):
+        texel_idx += (((-world_y) & 63) * 64)[:, np.newaxis]
+    else:
+        texel_idx += ((-world_y[:, np.newaxis]) % flat_heights[pixel_flat].astype(np.int32)) * 64
+
+    indices = flat_stack.ravel()[texel_idx]
+    rgba_img = light_luts.reshape((-1, 4))[pixel_light * np.int32(256) + indices]
+    rgba_img[pixel_flat < 0] = 0
+
+    logger.info(f"Rendered {plane}s of map {parsed_map.map_name} ({width}x{height} px).")
+    return rgba_img, extent
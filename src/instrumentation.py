@@ -0,0 +1,180 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+from loguru import logger
+
+"""Instrumentation of the parser and the viewers: the wall time, bytes read and object counts of each phase of the work
+are collected into a PhaseReport, kept on the instrumented object (WAD_file.report, WadViewer.report, Mus2Mid.report).
+
+Profiling is off by default. It is turned on with enable_profiling(), or with the PYWAD_PROFILE environment variable
+(e.g. PYWAD_PROFILE=cprofile,tracemalloc):
+    cprofile: each top-level phase runs under cProfile, see PhaseReport.profile_stats(). Each thread has its own
+        profiler. Phases whose profiler cannot be enabled (e.g. on Python >= 3.12, while another thread profiles)
+        are not profiled.
+    tracemalloc: the peak memory allocated by each phase is recorded. The peak is process-wide: phases running
+        concurrently in other threads are counted in it too.
+
+Reports and spans are logged with their data bound to the record (extra["report"] or extra["span"]).
+add_json_sink() adds a loguru sink writing them as JSON lines, to find slow WADs in production logs."""
+
+PROFILERS = ["cprofile", "tracemalloc"]
+_profiling = {x for x in os.environ.get("PYWAD_PROFILE", "").lower().split(",") if x in PROFILERS}
+# Outermost calls of instrumented methods slower than this are logged as spans, the others only go to the report.
+SPAN_LOG_SECONDS = 0.01
+# Profiling is only done in the outermost phase of each thread: cProfile cannot be nested.
+_local = threading.local()
+
+
+def enable_profiling(cprofile: bool = False, memory: bool = False) -> None:
+    """Turns the profilers on or off, for the phases started afterwards."""
+    _profiling.clear()
+    if cprofile:
+        _profiling.add("cprofile")
+    if memory:
+        _profiling.add("tracemalloc")
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+@dataclass
+class PhaseStats:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes_read: int = 0
+    counts: dict[str, int] = field(default_factory=dict)
+    peak_bytes: int | None = None
+
+
+class PhaseReport:
+    def __init__(self, owner: str, bytes_counter=None):
+        """Statistics of the phases of an object, in the order they first ran. bytes_counter returns the number
+        of bytes read so far by the object in the current thread, if it keeps count."""
+        self.owner = owner
+        self.phases = {}
+        # Wall time of the outermost phases: nested phases are also counted in their parent.
+        self.total_seconds = 0.0
+        self._bytes_counter = bytes_counter
+        # cProfile profilers, one per thread.
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, **counts):
+        """Times a phase. Counts given here, or set on the yielded dict, are added to the phase statistics."""
+        depth = getattr(_local, "depth", 0)
+        _local.depth = depth + 1
+        memory = depth == 0 and "tracemalloc" in _profiling and tracemalloc.is_tracing()
+        profile = None
+        start = time.perf_counter()
+        try:
+            if memory:
+                tracemalloc.reset_peak()
+            if depth == 0 and "cprofile" in _profiling:
+                profile = self._thread_profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Another profiler is active (Python >= 3.12 allows only one at a time): this phase is not profiled.
+                    profile = None
+            bytes_start = self._bytes_counter() if self._bytes_counter else 0
+            start = time.perf_counter()
+            yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            _local.depth = depth
+            bytes_read = self._bytes_counter() - bytes_start if self._bytes_counter else 0
+            peak = tracemalloc.get_traced_memory()[1] if memory else None
+            self._record(name, seconds, bytes_read, counts, peak, outermost=depth == 0)
+
+    def _thread_profile(self) -> cProfile.Profile:
+        with self._lock:
+            return self._profiles.setdefault(threading.get_ident(), cProfile.Profile())
+
+    def _record(
+        self, name: str, seconds: float, bytes_read: int, counts: dict, peak: int | None, outermost: bool
+    ) -> None:
+        with self._lock:
+            if outermost:
+                self.total_seconds += seconds
+            stats = self.phases.setdefault(name, PhaseStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bytes_read += bytes_read
+            for key, value in counts.items():
+                stats.counts[key] = stats.counts.get(key, 0) + value
+            if peak is not None:
+                stats.peak_bytes = max(stats.peak_bytes or 0, peak)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases = {name: asdict(stats) for name, stats in self.phases.items()}
+            return {"owner": self.owner, "total_seconds": self.total_seconds, "phases": phases}
+
+    def summary(self) -> str:
+        """One line per phase, slowest first."""
+        lines = [f"{self.owner}: {self.total_seconds * 1000:.1f} ms"]
+        for name, stats in sorted(self.phases.items(), key=lambda x: -x[1].seconds):
+            counts = ", ".join(f"{k}={v}" for k, v in stats.counts.items())
+            if stats.peak_bytes is not None:
+                counts = f"peak {stats.peak_bytes / 1e6:.2f} MB  {counts}"
+            lines.append(f"  {name:<16} {stats.seconds * 1000:9.1f} ms  {stats.calls:>5} calls  "
+                         f"{stats.bytes_read / 1e6:8.2f} MB read  {counts}")
+        return "\n".join(lines)
+
+    def profile_stats(self, sort: str = "cumulative", limit: int = 30) -> str | None:
+        """cProfile statistics of all the profiled phases, of every thread, or None if none was profiled."""
+        with self._lock:
+            profiles = list(self._profiles.values())
+        profiles = [x for x in profiles if x.getstats()]
+        if not profiles:
+            return None
+        output = io.StringIO()
+        pstats.Stats(*profiles, stream=output).sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def log(self, message: str | None = None) -> None:
+        logger.bind(report=self.to_dict()).info(
+            message or f"{self.owner} done in {self.total_seconds * 1000:.1f} ms.")
+
+
+def instrumented(name: str | None = None):
+    """Method decorator recording each call as a phase of self.report. Slow outermost calls are also logged as spans,
+    at debug level."""
+
+    def decorator(method):
+        phase_name = name or method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            # Nested calls (e.g. the patches of a texture) are counted in the report, but not logged.
+            outermost = getattr(_local, "depth", 0) == 0
+            start = time.perf_counter()
+            with self.report.phase(phase_name):
+                result = method(self, *args, **kwargs)
+            seconds = time.perf_counter() - start
+            if outermost and seconds >= SPAN_LOG_SECONDS:
+                logger.bind(span={"owner": self.report.owner, "phase": phase_name, "seconds": seconds}).debug(
+                    f"{self.report.owner}.{phase_name} done in {seconds * 1000:.1f} ms.")
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def add_json_sink(sink=sys.stderr, level: str = "DEBUG") -> int:
+    """Adds a loguru sink writing the reports and spans as JSON lines. Returns its id, for logger.remove()."""
+    return logger.add(
+        sink, level=level, serialize=True, filter=lambda record: "report" in record["extra"] or "span" in record["extra"]
+    )
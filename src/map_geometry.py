@@ -0,0 +1,135 @@
+import numpy as np
+
+"""Geometry pass on the map lines: connected segments are chained into polylines, collinear runs are merged and,
+at small scales, details smaller than a pixel are dropped.
+Drawing a few long polylines instead of one path per linedef makes the plots faster and the SVG files much smaller."""
+
+
+def chain_segments(segments: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Chains segments of shape (n, 2, 2) sharing an end point into polylines.
+
+    Returns the points of all polylines concatenated in an (m, 2) array,
+    and the start index of each polyline in this array."""
+
+    if segments is None or len(segments) == 0:
+        return np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+
+    vertices, inverse = np.unique(segments.reshape(-1, 2), axis=0, return_inverse=True)
+    edges = inverse.reshape(-1, 2)
+
+    # Incidence lists of each vertex, in CSR form.
+    ends = edges.ravel()
+    order = np.argsort(ends, kind="stable")
+    indptr = np.searchsorted(ends[order], np.arange(len(vertices) + 1)).tolist()
+    incident_edges = (order // 2).tolist()
+    degree = np.diff(indptr)
+
+    edge_list = edges.tolist()
+    used = [False] * len(edge_list)
+    cursor = indptr[:-1]
+
+    def next_edge(v: int) -> int:
+        while cursor[v] < indptr[v + 1]:
+            e = incident_edges[cursor[v]]
+            cursor[v] += 1
+            if not used[e]:
+                return e
+        return -1
+
+    # Chains start from the dead ends and junctions first, closed loops are handled at the end.
+    start_vertices = np.concatenate((np.where(degree % 2 == 1)[0], np.where((degree > 0) & (degree % 2 == 0))[0]))
+
+    chains = []
+    for start in start_vertices.tolist():
+        e = next_edge(start)
+        while e >= 0:
+            chain = [start]
+            v = start
+            while e >= 0:
+                used[e] = True
+                a, b = edge_list[e]
+                v = b if a == v else a
+                chain.append(v)
+                e = next_edge(v)
+            chains.append(chain)
+            e = next_edge(start)
+
+    lengths = np.array([len(x) for x in chains])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = vertices[np.concatenate(chains)]
+
+    return points, starts
+
+
+def _boundaries(n_points: int, starts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Masks of the first and last points of each polyline."""
+    is_first = np.zeros(n_points, dtype=bool)
+    is_first[starts] = True
+    is_last = np.zeros(n_points, dtype=bool)
+    is_last[np.concatenate((starts[1:], [n_points])) - 1] = True
+    return is_first, is_last
+
+
+def _select(points: np.ndarray, starts: np.ndarray, keep: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Keeps a subset of points, updating the polyline start indices. First points of polylines must be kept."""
+    new_idx = np.cumsum(keep) - 1
+    return points[keep], new_idx[starts]
+
+
+def merge_collinear(points: np.ndarray, starts: np.ndarray, eps: float = 1e-6) -> tuple[np.ndarray, np.ndarray]:
+    """Removes the inner points of polylines lying on a straight run."""
+
+    if len(points) < 3:
+        return points, starts
+
+    is_first, is_last = _boundaries(len(points), starts)
+
+    v1 = points[1:-1] - points[:-2]
+    v2 = points[2:] - points[1:-1]
+    cross = v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]
+    dot = (v1 * v2).sum(axis=1)
+    norms = np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)
+    straight = (np.abs(cross) <= eps * norms) & (dot > 0)
+
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:-1] = ~straight
+    keep |= is_first | is_last
+
+    return _select(points, starts, keep)
+
+
+def simplify(points: np.ndarray, starts: np.ndarray, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+    """Drops the details smaller than tolerance (in map units, typically the size of a pixel):
+    consecutive points falling in the same tolerance-sized cell are merged, and polylines smaller than a cell are
+    removed."""
+
+    if tolerance <= 0 or len(points) == 0:
+        return points, starts
+
+    is_first, is_last = _boundaries(len(points), starts)
+
+    cells = np.floor(points / tolerance)
+    moved = np.ones(len(points), dtype=bool)
+    moved[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+    keep = moved | is_first | is_last
+
+    # Polylines whose extent is smaller than the tolerance are dropped altogether.
+    extent = np.maximum.reduceat(points, starts) - np.minimum.reduceat(points, starts)
+    visible = (extent >= tolerance).any(axis=1)
+    lengths = np.diff(np.concatenate((starts, [len(points)])))
+    keep &= np.repeat(visible, lengths)
+
+    return _select(points, starts[visible], keep)
+
+
+def get_polylines(segments: np.ndarray, tolerance: float = 0.0) -> list[np.ndarray]:
+    """Full geometry pass: chaining, simplification at the given tolerance and merging of collinear points.
+    Returns a list of (k, 2) arrays, which can be given directly to a matplotlib LineCollection."""
+
+    points, starts = chain_segments(segments)
+    points, starts = simplify(points, starts, tolerance)
+    points, starts = merge_collinear(points, starts)
+
+    if len(points) == 0:
+        return []
+    return np.split(points, starts[1:])
@@ -3,11 +3,30 @@ import re
 import numpy as np
 from loguru import logger
 from typing import Union
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from src.map_geometry import get_polylines
 
 """Utility functions to parse map lumps from a WAD file. Can parse both old Doom format and UDMF format maps."""
 
 
+# Binary layouts of the SIDEDEFS and SECTORS lumps, identical in Doom and Hexen formats.
+SIDEDEF_DTYPE = np.dtype(
+    [("x_offset", "<i2"), ("y_offset", "<i2"), ("upper", "S8"), ("lower", "S8"), ("middle", "S8"), ("sector", "<u2")]
+)
+SECTOR_DTYPE = np.dtype(
+    [
+        ("floor_height", "<i2"),
+        ("ceiling_height", "<i2"),
+        ("floor", "S8"),
+        ("ceiling", "S8"),
+        ("light", "<i2"),
+        ("special", "<i2"),
+        ("tag", "<i2"),
+    ]
+)
+
+
 @dataclass
 class ParsedMap:
     map_lims: tuple[float, float, float, float] = None
@@ -18,6 +37,29 @@ class ParsedMap:
     special: np.array = None
     secret: np.array = None
     things: dict[str, list[float, float]] = None
+    vertices: np.array = None
+    # Linedefs as an (n, 4) array of [start vertex, end vertex, front sidedef, back sidedef], -1 when there is no side.
+    linedefs: np.array = None
+    sidedefs: np.array = None  # Structured array, see SIDEDEF_DTYPE
+    sectors: np.array = None  # Structured array, see SECTOR_DTYPE
+    # Polylines computed by get_polylines, keyed by (category, tolerance).
+    _polylines: dict = field(default_factory=dict, repr=False)
+    # Estimated size of the cached polylines, counted as they are computed.
+    _polylines_nbytes: int = field(default=0, repr=False)
+
+    def polylines(self, category: str, tolerance: float = 0.0) -> list[np.array]:
+        """Lines of a category (block, twosided, special or secret) chained into polylines.
+        Details smaller than tolerance, in map units, are dropped."""
+
+        key = (category, tolerance)
+        polylines = self._polylines.get(key)
+        if polylines is None:
+            computed = get_polylines(getattr(self, category), tolerance)
+            # Maps are shared by threads: only the first polylines stored for a key are counted.
+            polylines = self._polylines.setdefault(key, computed)
+            if polylines is computed:
+                self._polylines_nbytes += sum(x.nbytes for x in computed)
+        return polylines
 
 
 def filter_flags_by_bit(flags: np.array, bit_position: int, value=1) -> np.array:
@@ -31,6 +73,12 @@ def filter_flags_by_bit(flags: np.array, bit_position: int, value=1) -> np.array
     return np.where(mask)[0]
 
 
+def read_records(lump: bytes, dtype: np.dtype) -> np.array:
+    """Decodes a lump made of fixed-size records into a structured array, without copy."""
+    n_records = len(lump) // dtype.itemsize
+    return np.frombuffer(lump, dtype=dtype, count=n_records)
+
+
 def get_map_dims(vertices: np.array, parsed_map: ParsedMap) -> ParsedMap:
 
     map_lims = (vertices[:, 0].min(), vertices[:, 0].max(),
@@ -80,6 +128,17 @@ def parse_old_format(wad, parsed_map: ParsedMap, game_type: str = "DOOM") -> Par
     linecoords = [[int(k), int(v)]
                   for k, v in zip(linedefs[:, 0], linedefs[:, 1])]
 
+    # Sides of the linedefs, needed to know the sectors around each line.
+    # The last two fields of the linedefs are the front & back sidedefs, 0xFFFF meaning no side.
+    sides = linedefs[:, -2:].astype(np.int32)
+    sides[sides == 0xFFFF] = -1
+    parsed_map.vertices = vertices
+    parsed_map.linedefs = np.column_stack((linedefs[:, :2], sides)).astype(np.int32)
+    if "SIDEDEFS" in map_dict.keys():
+        parsed_map.sidedefs = read_records(wad._lump_data(*map_dict["SIDEDEFS"]), SIDEDEF_DTYPE)
+    if "SECTORS" in map_dict.keys():
+        parsed_map.sectors = read_records(wad._lump_data(*map_dict["SECTORS"]), SECTOR_DTYPE)
+
     lines = vertices[linecoords]
     flags = linedefs[:, 2]
     specials = linedefs[:, 3]
@@ -130,6 +189,24 @@ def parse_value(value: str) -> Union[str, float, bool]:
         return value  # fallback
 
 
+def udmf_records(rows: list[tuple], dtype: np.dtype) -> np.array:
+    """Builds a structured array with the same fields as the binary formats from UDMF blocks.
+    UDMF has no 16-bit limits and texture names can be longer than 8 characters, so the fields are widened."""
+
+    fields = []
+    for i, name in enumerate(dtype.names):
+        field_type = dtype.fields[name][0]
+        if field_type.kind == "S":
+            width = max([len(str(row[i])) for row in rows], default=8)
+            field_type = np.dtype(f"S{max(width, 8)}")
+        else:
+            field_type = np.dtype("<i4")
+        fields.append((name, field_type))
+
+    rows = [tuple(str(x).encode("utf8") if isinstance(x, str) else int(x) for x in row) for row in rows]
+    return np.array(rows, dtype=np.dtype(fields))
+
+
 def parse_udmf_format(wad, parsed_map: ParsedMap) -> ParsedMap:
     # See https://github.com/ZDoom/gzdoom/blob/master/specs/udmf.txt
     # Thanks ChatGPT for the regexes.
@@ -138,6 +215,10 @@ def parse_udmf_format(wad, parsed_map: ParsedMap) -> ParsedMap:
     blocking = []
     twosided = []
     special = []
+    secret = []
+    linedefs = []
+    sidedefs = []
+    sectors = []
     things_dict = {"all_things": {"x": [], "y": []}}
 
     map_dict = wad._maps_lumps[parsed_map.map_name]
@@ -173,6 +254,34 @@ def parse_udmf_format(wad, parsed_map: ParsedMap) -> ParsedMap:
                 twosided.append([v1, v2])
             if "special" in props.keys():
                 special.append([v1, v2])
+            if "secret" in props.keys():
+                secret.append([v1, v2])
+            linedefs.append([v1, v2, props.get("sidefront", -1), props.get("sideback", -1)])
+
+        elif block_type == "sidedef":
+            sidedefs.append(
+                (
+                    props.get("offsetx", 0),
+                    props.get("offsety", 0),
+                    props.get("texturetop", "-"),
+                    props.get("texturebottom", "-"),
+                    props.get("texturemiddle", "-"),
+                    props.get("sector", 0),
+                )
+            )
+
+        elif block_type == "sector":
+            sectors.append(
+                (
+                    props.get("heightfloor", 0),
+                    props.get("heightceiling", 0),
+                    props.get("texturefloor", "-"),
+                    props.get("textureceiling", "-"),
+                    props.get("lightlevel", 160),
+                    props.get("special", 0),
+                    props.get("id", 0),
+                )
+            )
 
         elif block_type == "thing":
             x = props.pop("x", 0.0)
@@ -202,6 +311,13 @@ def parse_udmf_format(wad, parsed_map: ParsedMap) -> ParsedMap:
     parsed_map.block = verts[blocking]
     parsed_map.twosided = verts[twosided]
     parsed_map.special = verts[special]
+    # Secret lines are rare, the map may have none.
+    parsed_map.secret = verts[np.array(secret, dtype=int).reshape(-1, 2)]
+
+    parsed_map.vertices = verts
+    parsed_map.linedefs = np.array(linedefs, dtype=np.int32).reshape(-1, 4)
+    parsed_map.sidedefs = udmf_records(sidedefs, SIDEDEF_DTYPE)
+    parsed_map.sectors = udmf_records(sectors, SECTOR_DTYPE)
 
     return parsed_map
 
@@ -0,0 +1,104 @@
+import base64
+import json
+import os
+import struct
+
+import numpy as np
+
+from src.map_parser import ParsedMap
+from src.map_raster import MAP_LAYERS
+from src.palettes import MAP_CMAPS
+
+"""Compact binary encoding of the map geometry, drawn in the browser by a canvas viewer (map_viewer.html).
+The map is sent once: pan, zoom, palette and layer changes are then handled client-side, without any server work.
+
+Layout, little-endian, every block aligned on 4 bytes so that the browser reads it with typed arrays:
+    header: id, version, index size (2 or 4 bytes), scale, center x, center y, number of vertices,
+            number of segments of each line layer (MAP_LAYERS order), number of things
+    vertices: int16 (n, 2), quantized as (x - center) * scale
+    indices: uint16 or uint32 (n, 2) vertex indices of the segments, layer after layer
+    things: int16 (n, 2), quantized like the vertices"""
+
+MAP_PAYLOAD_ID = b"WMAP"
+MAP_PAYLOAD_VERSION = 1
+LINE_LAYERS = [x for x in MAP_LAYERS if x != "things"]
+PAYLOAD_HEADER = struct.Struct(f"<4sHHfffI{len(LINE_LAYERS)}II")
+
+VIEWER_TEMPLATE = os.path.join(os.path.dirname(__file__), "map_viewer.html")
+
+
+def encode_map_geometry(parsed_map: ParsedMap) -> bytes:
+    """Encodes the lines of each layer and the things of a map into a binary payload."""
+
+    segments = [getattr(parsed_map, layer) for layer in LINE_LAYERS]
+    segments = [np.zeros((0, 2, 2)) if x is None or len(x) == 0 else np.asarray(x, dtype=np.float64)
+                for x in segments]
+    things = parsed_map.things["all_things"] if parsed_map.things else {"x": [], "y": []}
+    things = np.column_stack((things["x"], things["y"])).astype(np.float64).reshape(-1, 2)
+
+    # Doom maps fit in int16 as they are. Larger (UDMF) maps are scaled down to fit.
+    # The extent covers the things too: some lie outside of the map lines.
+    x_min, x_max, y_min, y_max = parsed_map.map_lims
+    center = np.array([round((x_min + x_max) / 2), round((y_min + y_max) / 2)], dtype=np.float64)
+    points = np.concatenate([x.reshape(-1, 2) for x in segments])
+    all_points = np.concatenate((points, things))
+    half_extent = np.abs(all_points - center).max() if len(all_points) else 0.0
+    scale = min(1.0, 32767 / half_extent) if half_extent > 0 else 1.0
+
+    quantized = quantize(points, center, scale)
+    vertices, inverse = np.unique(quantized, axis=0, return_inverse=True)
+    index_dtype = np.uint16 if len(vertices) <= 0xFFFF else np.uint32
+
+    header = PAYLOAD_HEADER.pack(
+        MAP_PAYLOAD_ID, MAP_PAYLOAD_VERSION, np.dtype(index_dtype).itemsize, scale, *center, len(vertices),
+        *[len(x) for x in segments], len(things),
+    )
+    return b"".join([
+        header,
+        vertices.astype("<i2").tobytes(),
+        inverse.reshape(-1).astype(np.dtype(index_dtype).newbyteorder("<")).tobytes(),
+        quantize(things, center, scale).astype("<i2").tobytes(),
+    ])
+
+
+def quantize(points: np.ndarray, center: np.ndarray, scale: float) -> np.ndarray:
+    """Points as int16 coordinates around center. Clipped, so that rounding never wraps around."""
+    return np.clip(np.rint((points - center) * scale), -32768, 32767).astype(np.int16)
+
+
+def decode_map_geometry(payload: bytes) -> dict[str, np.ndarray]:
+    """Decodes a payload back into segments of shape (n, 2, 2) per layer and things of shape (n, 2), in map units."""
+
+    map_id, _, index_size, scale, center_x, center_y, n_vertices, *counts, n_things = PAYLOAD_HEADER.unpack_from(payload)
+    if map_id != MAP_PAYLOAD_ID:
+        raise ValueError(f"Not a map payload: {map_id}")
+    center = np.array([center_x, center_y])
+
+    offset = PAYLOAD_HEADER.size
+    vertices = np.frombuffer(payload, dtype="<i2", count=2 * n_vertices, offset=offset).reshape(-1, 2)
+    offset += vertices.nbytes
+    indices = np.frombuffer(payload, dtype=f"<u{index_size}", count=2 * sum(counts), offset=offset)
+    offset += indices.nbytes
+    things = np.frombuffer(payload, dtype="<i2", count=2 * n_things, offset=offset).reshape(-1, 2)
+
+    points = vertices / scale + center
+    bounds = np.cumsum([0] + counts) * 2
+    result = {
+        layer: points[indices[start:end]].reshape(-1, 2, 2)
+        for layer, start, end in zip(LINE_LAYERS, bounds[:-1], bounds[1:])
+    }
+    result["things"] = things / scale + center
+    return result
+
+
+def map_viewer_html(payload: bytes, palette: str = "OMGIFOL", height: int = 600) -> str:
+    """HTML of the canvas viewer of a map payload, to be embedded in the app."""
+    with open(VIEWER_TEMPLATE, "r", encoding="utf-8") as f:
+        template = f.read()
+    return (
+        template.replace("__PAYLOAD__", base64.b64encode(payload).decode("ascii"))
+        .replace("__PALETTES__", json.dumps(MAP_CMAPS))
+        .replace("__PALETTE__", json.dumps(palette))
+        .replace("__LAYERS__", json.dumps(LINE_LAYERS))
+        .replace("__HEIGHT__", str(height))
+    )
@@ -0,0 +1,128 @@
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+import numpy as np
+from dataclasses import dataclass, field
+from loguru import logger
+
+from src.map_parser import ParsedMap
+
+"""Palette-independent rasterization of the maps.
+Each category of lines (and the things) is rasterized once into a coverage layer, with anti-aliasing.
+Changing the palette or toggling the secrets/specials/things is then only a look-up table recoloring of these layers,
+without drawing the geometry again."""
+
+# Drawing order, from bottom to top, same as WadViewer.draw_map.
+MAP_LAYERS = ["twosided", "block", "special", "secret", "things"]
+
+
+@dataclass
+class MapRaster:
+    map_name: str = None
+    # Coverage of each layer of MAP_LAYERS, uint8 array of shape (n_layers, height, width).
+    coverage: np.ndarray = None
+    # (labels, coverage) images cached for each combination of visible layers.
+    _labels: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.coverage.shape[1:]
+
+    def get_labels(self, visible_layers: tuple[str, ...]) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the label image (0 for background, i + 1 for the i-th visible layer) of the top-most visible layer
+        covering each pixel, and its coverage."""
+
+        visible_layers = tuple(x for x in MAP_LAYERS if x in visible_layers)
+        if visible_layers not in self._labels:
+            layer_idxs = [MAP_LAYERS.index(x) for x in visible_layers]
+            height, width = self.shape
+
+            if len(layer_idxs) == 0:
+                labels = np.zeros((height, width), dtype=np.uint8)
+                coverage = np.zeros((height, width), dtype=np.uint8)
+            else:
+                cov = self.coverage[layer_idxs]
+                # argmax on the reversed stack gives the top-most layer with some coverage.
+                top = len(layer_idxs) - 1 - np.argmax(cov[::-1] > 0, axis=0)
+                coverage = np.take_along_axis(cov, top[np.newaxis], axis=0)[0]
+                labels = np.where(coverage > 0, top + 1, 0).astype(np.uint8)
+
+            self._labels[visible_layers] = (labels, coverage)
+
+        return self._labels[visible_layers]
+
+    def recolor(self, cmap: dict[str, list[int]], visible_layers: tuple[str, ...]) -> np.ndarray:
+        """Colors the raster with one of the MAP_CMAPS color schemes. Returns an RGB uint8 image."""
+
+        visible_layers = tuple(x for x in MAP_LAYERS if x in visible_layers)
+        labels, coverage = self.get_labels(visible_layers)
+
+        # Look-up table of shape (n_labels, 256, 3): background color blended with the label color by the coverage.
+        background = np.array(cmap["background"], dtype=np.float32)
+        colors = np.array([cmap["background"]] + [cmap[x] for x in visible_layers], dtype=np.float32)
+        alpha = np.arange(256, dtype=np.float32)[np.newaxis, :, np.newaxis] / 255
+        lut = np.rint(background * (1 - alpha) + colors[:, np.newaxis, :] * alpha).astype(np.uint8)
+
+        return lut[labels, coverage]
+
+
+def get_figure_size(parsed_map: ParsedMap, scale: float, max_width: int, dpi: int) -> tuple[float, float]:
+    # Same sizing as WadViewer.draw_map: 1000 doom units fit in 1 inch of the figure.
+    width, height = parsed_map.map_dims
+    fig_width = min((width / 1000) * scale, max_width / dpi)
+    return fig_width, fig_width * height / width
+
+
+def rasterize_map(
+    parsed_map: ParsedMap, scale: float = 2.0, max_width: int = 4096, dpi: int = 150, simplify: float = 0.5
+) -> MapRaster:
+    """Rasterizes every layer of a map, with the same sizes and line widths than WadViewer.draw_map."""
+
+    # Agg canvas used directly, without pyplot: nothing to close and safe to use from worker threads.
+    fig = Figure(figsize=get_figure_size(parsed_map, scale, max_width, dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_facecolor("none")
+    ax.axis("off")
+
+    x_min, x_max, y_min, y_max = parsed_map.map_lims
+    # A small margin so that the line caps are not cut at the borders.
+    margin = 0.01 * max(parsed_map.map_dims)
+    ax.set_xlim(x_min - margin, x_max + margin)
+    ax.set_ylim(y_min - margin, y_max + margin)
+    ax.set_aspect("equal", adjustable="datalim")
+    tolerance = simplify * parsed_map.map_dims[0] / ax.get_window_extent().width if simplify > 0 else 0.0
+
+    linewidth_primary = 0.4 + 0.2 * scale
+    linewidth_secondary = 0.2 + 0.2 * scale
+    layer_args = {
+        "twosided": {"linewidths": linewidth_secondary, "capstyle": "round", "joinstyle": "round"},
+        "block": {"linewidths": linewidth_primary, "capstyle": "round", "joinstyle": "round"},
+        "special": {"linewidths": linewidth_primary},
+        "secret": {"linewidths": linewidth_primary},
+    }
+
+    layers = []
+    for layer in MAP_LAYERS:
+        if layer == "things":
+            things = parsed_map.things["all_things"]
+            artist = ax.scatter(things["x"], things["y"], color="white", s=2 * scale, marker="+")
+        else:
+            lines = parsed_map.polylines(layer, tolerance)
+            if len(lines) == 0:
+                layers.append(None)
+                continue
+            artist = ax.add_collection(LineCollection(lines, colors="white", **layer_args[layer]))
+
+        fig.canvas.draw()
+        # Layers are drawn white on a transparent background: the alpha channel is the coverage.
+        layers.append(np.asarray(fig.canvas.buffer_rgba())[:, :, 3].copy())
+        artist.remove()
+
+    # The things layer is always drawn, even when empty.
+    shape = layers[-1].shape
+    coverage = np.stack([x if x is not None else np.zeros(shape, dtype=np.uint8) for x in layers])
+
+    logger.info(f"Rasterized map {parsed_map.map_name} ({shape[1]}x{shape[0]} px).")
+    return MapRaster(map_name=parsed_map.map_name, coverage=coverage)
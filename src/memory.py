@@ -0,0 +1,98 @@
+import io
+import mmap
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""Memory accounting of the parsed WADs and their caches: arrays are counted by their nbytes, Python containers
+and objects are sized deeply. Objects reachable from several places are counted once, where they are found first."""
+
+
+def estimate_nbytes(obj, _seen: set | None = None) -> int:
+    """Rough memory size of an object: its arrays and bytes, found through its attributes, dicts and lists."""
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        # Views are counted through the array they are a view of.
+        return estimate_nbytes(obj.base, seen) if isinstance(obj.base, np.ndarray) else obj.nbytes
+    if isinstance(obj, (bytes, bytearray, str)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, io.BytesIO):
+        return obj.getbuffer().nbytes
+    if isinstance(obj, LRUCache):
+        # Caches count their values as they are stored.
+        return sys.getsizeof(obj) + obj.nbytes
+    # Containers are copied before being walked: other threads can fill the caches meanwhile.
+    if isinstance(obj, dict):
+        items = list(obj.items())
+        return sys.getsizeof(obj) + sum(estimate_nbytes(k, seen) + estimate_nbytes(v, seen) for k, v in items)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_nbytes(x, seen) for x in list(obj))
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + estimate_nbytes(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
+def attributes_nbytes(obj, groups: dict[str, list[str]], seen: set | None = None) -> dict[str, int]:
+    """Sizes of groups of attributes of an object. The remaining attributes are counted in "other"."""
+    seen = set() if seen is None else seen
+    sizes = {group: sum(estimate_nbytes(getattr(obj, x, None), seen) for x in names) for group, names in groups.items()}
+    sizes["other"] = estimate_nbytes(obj, seen)
+    return sizes
+
+
+def mapped_nbytes(file_obj) -> int:
+    """Size of a memory-mapped file object. Its pages are backed by the file: they are not counted as retained."""
+    return len(file_obj) if isinstance(file_obj, mmap.mmap) else 0
+
+
+class LRUCache:
+    def __init__(self, max_items: int | None = None, max_bytes: int | None = None):
+        """Cache keeping the most recently used values, at most max_items of them and / or max_bytes in total
+        (values measured by estimate_nbytes when they are stored). The last stored value is always kept."""
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._values = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        return key in self._values
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._values:
+                return default
+            self._values.move_to_end(key)
+            return self._values[key]
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used ones if needed, and returns it."""
+        size = estimate_nbytes(value)
+        with self._lock:
+            self.nbytes += size - self._sizes.get(key, 0)
+            self._values[key] = value
+            self._values.move_to_end(key)
+            self._sizes[key] = size
+            while len(self._values) > 1 and (
+                (self.max_items is not None and len(self._values) > self.max_items)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                old_key, _ = self._values.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self._sizes.clear()
+            self.nbytes = 0
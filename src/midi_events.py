@@ -0,0 +1,170 @@
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+from src.mus2mid import MIDI_ID
+
+"""Minimal Standard MIDI File reader, used to drive a synthesizer directly from the MIDI events
+and to decode them into NumPy event arrays.
+See https://www.music.mcgill.ca/~ich/classes/mumt306/StandardMIDIfileformat.html"""
+
+DEFAULT_TEMPO = 500000  # microseconds per quarter note
+META_EVENT = 0xFF
+META_TEMPO = 0x51
+SYSEX_EVENTS = (0xF0, 0xF7)
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("tick", "<i8"),
+        ("time", "<f8"),  # seconds
+        ("channel", "u1"),  # MIDI channel
+        ("type", "u1"),  # MIDI event type, e.g. 0x90 for a note on
+        ("data1", "u1"),
+        ("data2", "u1"),
+    ]
+)
+
+
+@dataclass
+class MusicEvents:
+    format: str  # "mus" or "midi"
+    events: np.ndarray  # EVENT_DTYPE, sorted by tick
+    tempos: np.ndarray  # (n, 2) int64 array of (tick, microseconds per quarter note)
+    duration: float  # seconds, up to the end of the score
+
+
+def read_varlen(data: bytes, pos: int) -> tuple[int, int]:
+    """Reads a variable-length quantity. Returns the value and the position after it."""
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def channel_data_length(status: int) -> int:
+    """Number of data bytes of a channel event: program change and channel pressure have only one."""
+    return 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+
+
+def read_track(data: bytes, pos: int, end: int, track_idx: int, events: list, tempos: list) -> int:
+    """Reads the events of one MTrk chunk, as (tick, track, status, data1, data2) and tempo changes (tick, tempo).
+    Returns the tick of the end of the track."""
+
+    tick = 0
+    running_status = 0
+    while pos < end:
+        delta, pos = read_varlen(data, pos)
+        tick += delta
+
+        status = data[pos]
+        if status & 0x80:
+            pos += 1
+        else:
+            # Running status: the previous status byte is reused and this byte is already data.
+            status = running_status
+
+        if status == META_EVENT:
+            meta_type = data[pos]
+            length, pos = read_varlen(data, pos + 1)
+            if meta_type == META_TEMPO and length == 3:
+                tempos.append((tick, int.from_bytes(data[pos: pos + 3], "big")))
+            pos += length
+
+        elif status in SYSEX_EVENTS:
+            length, pos = read_varlen(data, pos)
+            pos += length
+
+        elif status & 0x80:
+            running_status = status
+            n_data = channel_data_length(status)
+            data1 = data[pos]
+            data2 = data[pos + 1] if n_data == 2 else 0
+            pos += n_data
+            events.append((tick, track_idx, status, data1, data2))
+
+        else:
+            raise ValueError("Invalid MIDI data: data byte without any running status.")
+
+    return tick
+
+
+def ticks_to_seconds(ticks: np.ndarray, tempos: np.ndarray, division: int) -> np.ndarray:
+    """Converts MIDI ticks to seconds, given the (tick, tempo) changes sorted by tick."""
+    if division & 0x8000:
+        # SMPTE time: frames per second and ticks per frame, no tempo involved.
+        fps = 256 - (division >> 8)
+        return ticks / (fps * (division & 0xFF))
+
+    tempo_ticks = np.concatenate([[0], tempos[:, 0]])
+    tempo_values = np.concatenate([[DEFAULT_TEMPO], tempos[:, 1]])
+    # Time at the start of each tempo segment.
+    segment_times = np.concatenate([[0.0], np.cumsum(np.diff(tempo_ticks) * tempo_values[:-1] / (division * 1e6))])
+
+    segment = np.searchsorted(tempo_ticks, ticks, side="right") - 1
+    return segment_times[segment] + (ticks - tempo_ticks[segment]) * tempo_values[segment] / (division * 1e6)
+
+
+def decode_midi(midi_data: bytes) -> MusicEvents:
+    """Decodes the channel events of a Standard MIDI File, with their time in seconds once the tempo changes applied."""
+
+    if midi_data[:4] != MIDI_ID:
+        raise ValueError(f"Unsupported file format: {midi_data[:4]}")
+
+    header_len, _, n_tracks, division = struct.unpack_from(">IHHH", midi_data, 4)
+
+    events = []
+    tempos = []
+    end_tick = 0
+    pos = 8 + header_len
+    for track_idx in range(n_tracks):
+        if pos + 8 > len(midi_data):
+            break
+        chunk_id, chunk_len = struct.unpack_from(">4sI", midi_data, pos)
+        pos += 8
+        # Some files have a wrong track length, the chunk is then read until the end of the data.
+        end = min(pos + chunk_len, len(midi_data))
+        if chunk_id == b"MTrk":
+            try:
+                end_tick = max(end_tick, read_track(midi_data, pos, end, track_idx, events, tempos))
+            except IndexError:
+                pass
+        pos = end
+
+    table = np.array(events, dtype=np.int64).reshape((-1, 5))
+    # Events of the same tick keep their track order.
+    table = table[np.lexsort((table[:, 1], table[:, 0]))]
+    tempos = np.array(sorted(tempos), dtype=np.int64).reshape((-1, 2))
+
+    result = np.empty(len(table), dtype=EVENT_DTYPE)
+    result["tick"] = table[:, 0]
+    result["time"] = ticks_to_seconds(table[:, 0], tempos, division)
+    result["channel"] = table[:, 2] & 0x0F
+    result["type"] = table[:, 2] & 0xF0
+    result["data1"] = table[:, 3]
+    result["data2"] = table[:, 4]
+
+    duration = float(ticks_to_seconds(np.array([end_tick]), tempos, division)[0])
+    return MusicEvents("midi", result, tempos, duration)
+
+
+def read_midi_events(midi_data: bytes) -> list[tuple[float, int, int, int]]:
+    """Parses a Standard MIDI File into its channel events, sorted by time.
+
+    Returns
+    -------
+    list[tuple[float, int, int, int]]
+        (time in seconds, status, data1, data2) for every channel event, with the tempo changes applied.
+    """
+    events = decode_midi(midi_data).events
+    return list(
+        zip(
+            events["time"].tolist(),
+            (events["type"] | events["channel"]).tolist(),
+            events["data1"].tolist(),
+            events["data2"].tolist(),
+        )
+    )
@@ -4,11 +4,14 @@ from enum import IntEnum
 from typing import BinaryIO
 from loguru import logger
 
+from src.instrumentation import PhaseReport
+
 
 """
 Translation to Python and slight adaptation of mus2mid.c by Ben Ryves, 2006. 
 See https://svn.prboom.org/repos/tags/prboom-plus-2.5.0.1/src/mus2mid.c
 Added MIDI management by simply saving the MIDI lump to a .mid.
+The conversion works in memory (bytes -> bytes) and keeps its state per call, so it is reentrant and thread-safe.
 Many thanks to https://github.com/KurtDing for his help on MUS conversion to MIDI in Labview.
 
 """
@@ -56,181 +59,200 @@ class MusHeader:
     instrumentcount: int
 
 
-# MIDI header
+# MIDI header, the track size (bytes 18-21) is filled at the end of the conversion.
 midiheader = MIDI_ID + struct.pack(">IHHH", 6, 0, 1, 0x46) + b"MTrk" + struct.pack(">I", 0)
+TRACK_SIZE_OFFSET = 18
 
-# Global state
-channelvelocities = [127] * NUM_CHANNELS
-controller_map = [0x00, 0x20, 0x01, 0x07, 0x0A, 0x0B, 0x5B, 0x5D, 0x40, 0x43, 0x78, 0x7B, 0x7E, 0x7F, 0x79]
-channel_map = [-1] * NUM_CHANNELS
+controller_map = (0x00, 0x20, 0x01, 0x07, 0x0A, 0x0B, 0x5B, 0x5D, 0x40, 0x43, 0x78, 0x7B, 0x7E, 0x7F, 0x79)
 
 
-class Mus2Mid:
-    def __init__(self, mus_path: str) -> None:
+def read_mus_header(mus_data: bytes) -> MusHeader:
+    """Reads and returns a MUS file header."""
+    if len(mus_data) < 16:
+        raise ValueError("MUS data is too short to hold a header.")
+    MUS_header, score_len, score_start, channels, sec_channels, instrCnt, _ = struct.unpack_from("<4sHHHHHH", mus_data)
+    return MusHeader(MUS_header, score_len, score_start, channels, sec_channels, instrCnt)
 
-        with open(mus_path, "rb") as musinput:
-            header_id = struct.unpack("<4s", musinput.read(4))[0]
 
-            if header_id != MUS_ID:
-                raise ValueError(f"Unsupported file format: {header_id}")
-            else:
-                self.mus_path = mus_path
-                self.id = header_id
-                logger.info(f"File format detected: {header_id}")
+class _MusConverter:
+    """State of a single MUS to MIDI conversion. A new one is used for every conversion,
+    so that conversions never share their channel allocations or velocities."""
 
-    def read_mus_header(self, musfile: BinaryIO) -> MusHeader:
-        """Reads and returns a MUS file header."""
-        MUS_header, score_len, score_start, channels, sec_channels, instrCnt, _ = struct.unpack(
-            "<4sHHHHHH", musfile.read(16)
-        )
-        return MusHeader(MUS_header, score_len, score_start, channels, sec_channels, instrCnt)
+    def __init__(self):
+        self.channelvelocities = [127] * NUM_CHANNELS
+        self.channel_map = [-1] * NUM_CHANNELS
+        self.queuedtime = 0
+        self.output = bytearray(midiheader)
 
-    def write_time(self, time: int, midioutput: BinaryIO) -> None:
+    def write_time(self, time: int) -> None:
         """Writes variable-length encoded time to the MIDI output."""
 
-        buffer = []
-        while time > 0x7F:
-            buffer.insert(0, (time & 0x7F) | 0x80)
+        buffer = [time & 0x7F]
+        time >>= 7
+        while time > 0:
+            buffer.append((time & 0x7F) | 0x80)
             time >>= 7
-        buffer.append(time & 0x7F)
-
-        for byte in buffer:
-            if midioutput.write(struct.pack("B", byte)) != 1:
-                raise ValueError(f"Failed to write byte {byte} to MIDI output.")
-            self.tracksize += 1
+        self.output += bytes(reversed(buffer))
 
         self.queuedtime = 0
 
-    def write_midi_event(self, event: int, data: list[int], midioutput: BinaryIO) -> None:
+    def write_midi_event(self, event: int, *data: int) -> None:
         """Writes a complete MIDI event."""
 
-        self.write_time(self.queuedtime, midioutput)
-
-        midioutput.write(struct.pack("B", event))
-        for value in data:
-            midioutput.write(struct.pack("B", value & 0x7F))
-        self.tracksize += 1 + len(data)
+        self.write_time(self.queuedtime)
+        self.output.append(event)
+        self.output += bytes(value & 0x7F for value in data)
 
-    def write_end_track(self, midioutput: BinaryIO) -> None:
+    def write_end_track(self) -> None:
         """Writes end of track event."""
-        self.write_time(self.queuedtime, midioutput)
-
-        midioutput.write(b"\xff\x2f\x00")
-
-        self.tracksize += 3
+        self.write_time(self.queuedtime)
+        self.output += b"\xff\x2f\x00"
 
-    @staticmethod
-    def allocate_midi_channel() -> int:
+    def allocate_midi_channel(self) -> int:
         """Allocates a new MIDI channel."""
-        max_channel = max(channel_map)
+        max_channel = max(self.channel_map)
         result = max_channel + 1
         if result == MIDI_PERCUSSION_CHAN:
             result += 1
         return result
 
-    @staticmethod
-    def allocate_midi_channel() -> int:
-        """Allocates a new MIDI channel."""
-        max_channel = max(channel_map)
-        result = max_channel + 1
-        if result == MIDI_PERCUSSION_CHAN:
-            result += 1
-        return result
-
-    def get_midi_channel(self, mus_channel: int, midioutput: BinaryIO) -> int:
+    def get_midi_channel(self, mus_channel: int) -> int:
         """Returns the MIDI channel mapped to a MUS channel."""
         if mus_channel == MUS_PERCUSSION_CHAN:
             return MIDI_PERCUSSION_CHAN
-        if channel_map[mus_channel] == -1:
-            channel_map[mus_channel] = self.allocate_midi_channel()
-            self.write_midi_event(Midievent.CHANGECONTROLLER | channel_map[mus_channel], [0x7B, 0], midioutput)
-        return channel_map[mus_channel]
-
-    def mus2mid(self, musinput: BinaryIO, midioutput: BinaryIO) -> None:
-        """Converts a MUS file to MIDI format."""
+        if self.channel_map[mus_channel] == -1:
+            self.channel_map[mus_channel] = self.allocate_midi_channel()
+            self.write_midi_event(Midievent.CHANGECONTROLLER | self.channel_map[mus_channel], 0x7B, 0)
+        return self.channel_map[mus_channel]
 
-        musfileheader = self.read_mus_header(musinput)
+    def convert(self, mus_data: bytes) -> bytes:
+        """Converts MUS data to MIDI format."""
 
-        musinput.seek(musfileheader.scorestart)
-        midioutput.write(midiheader)
+        musfileheader = read_mus_header(mus_data)
+        if musfileheader.id != MUS_ID:
+            raise ValueError(f"Unsupported file format: {musfileheader.id}")
 
-        self.queuedtime = 0
-        self.tracksize = 0
+        data = memoryview(mus_data)
+        pos = musfileheader.scorestart
         hitscoreend = False
 
-        while not hitscoreend:
+        try:
             while not hitscoreend:
-                eventdescriptor = musinput.read(1)
-                if not eventdescriptor:
-                    raise ValueError("No Event descriptor")
-                eventdescriptor = eventdescriptor[0]
-
-                channel = self.get_midi_channel(eventdescriptor & 0x0F, midioutput)
-                event = eventdescriptor & 0x70
-
-                if event == Musevent.RELEASEKEY:
-                    key = musinput.read(1)[0]
-                    self.write_midi_event(Midievent.RELEASEKEY | channel, [key, 0], midioutput)
-
-                elif event == Musevent.PRESSKEY:
-                    key = musinput.read(1)[0]
-                    if key & 0x80:
-                        channelvelocities[channel] = musinput.read(1)[0] & 0x7F
-                    self.write_midi_event(
-                        Midievent.PRESSKEY | channel, [key & 0x7F, channelvelocities[channel]], midioutput
-                    )
-
-                elif event == Musevent.PITCHWHEEL:
-                    key = musinput.read(1)[0]
-                    self.write_midi_event(
-                        Midievent.PITCHWHEEL | channel, [key * 64 & 0x7F, (key * 64) >> 7], midioutput
-                    )
-
-                elif event == Musevent.SYSTEMEVENT:
-                    controllernumber = musinput.read(1)[0]
-                    if 10 <= controllernumber <= 14:
-                        self.write_midi_event(
-                            Midievent.CHANGECONTROLLER | channel, [controller_map[controllernumber], 0], midioutput
-                        )
-
-                elif event == Musevent.CHANGECONTROLLER:
-                    controllernumber, controllervalue = musinput.read(2)
-                    if controllernumber == 0:
-                        self.write_midi_event(Midievent.CHANGEPATCH | channel, [controllervalue], midioutput)
-                    elif 1 <= controllernumber <= 9:
-                        self.write_midi_event(
-                            Midievent.CHANGECONTROLLER | channel,
-                            [controller_map[controllernumber], controllervalue],
-                            midioutput,
-                        )
-                elif event == Musevent.SCOREEND:
-                    hitscoreend = True
-
-                if eventdescriptor & 0x80:
-                    break
-
-            if not hitscoreend:
-                timedelay = 0
-                while True:
-                    working = musinput.read(1)[0]
-                    timedelay = (timedelay << 7) | (working & 0x7F)
-                    if not (working & 0x80):
+                while not hitscoreend:
+                    eventdescriptor = data[pos]
+                    pos += 1
+
+                    channel = self.get_midi_channel(eventdescriptor & 0x0F)
+                    event = eventdescriptor & 0x70
+
+                    if event == Musevent.RELEASEKEY:
+                        key = data[pos]
+                        pos += 1
+                        self.write_midi_event(Midievent.RELEASEKEY | channel, key, 0)
+
+                    elif event == Musevent.PRESSKEY:
+                        key = data[pos]
+                        pos += 1
+                        if key & 0x80:
+                            self.channelvelocities[channel] = data[pos] & 0x7F
+                            pos += 1
+                        self.write_midi_event(Midievent.PRESSKEY | channel, key & 0x7F, self.channelvelocities[channel])
+
+                    elif event == Musevent.PITCHWHEEL:
+                        key = data[pos]
+                        pos += 1
+                        self.write_midi_event(Midievent.PITCHWHEEL | channel, key * 64 & 0x7F, (key * 64) >> 7)
+
+                    elif event == Musevent.SYSTEMEVENT:
+                        controllernumber = data[pos]
+                        pos += 1
+                        if 10 <= controllernumber <= 14:
+                            self.write_midi_event(
+                                Midievent.CHANGECONTROLLER | channel, controller_map[controllernumber], 0
+                            )
+
+                    elif event == Musevent.CHANGECONTROLLER:
+                        controllernumber, controllervalue = data[pos], data[pos + 1]
+                        pos += 2
+                        if controllernumber == 0:
+                            self.write_midi_event(Midievent.CHANGEPATCH | channel, controllervalue)
+                        elif 1 <= controllernumber <= 9:
+                            self.write_midi_event(
+                                Midievent.CHANGECONTROLLER | channel, controller_map[controllernumber], controllervalue
+                            )
+
+                    elif event == Musevent.SCOREEND:
+                        hitscoreend = True
+
+                    if eventdescriptor & 0x80:
                         break
-                self.queuedtime += timedelay
 
-        self.write_end_track(midioutput)
+                if not hitscoreend:
+                    timedelay = 0
+                    while True:
+                        working = data[pos]
+                        pos += 1
+                        timedelay = (timedelay << 7) | (working & 0x7F)
+                        if not (working & 0x80):
+                            break
+                    self.queuedtime += timedelay
+
+        except IndexError:
+            raise ValueError("MUS data ended before the end of the score.")
+
+        self.write_end_track()
+
+        # Track size, big-endian as everything else in a MIDI file.
+        tracksize = len(self.output) - len(midiheader)
+        self.output[TRACK_SIZE_OFFSET: TRACK_SIZE_OFFSET + 4] = struct.pack(">I", tracksize)
+
+        return bytes(self.output)
+
+
+def mus2mid(mus_data: bytes) -> bytes:
+    """Converts MUS data to MIDI data, entirely in memory.
+    Every call has its own state, so conversions can run concurrently from several threads."""
+    return _MusConverter().convert(mus_data)
+
+
+class Mus2Mid:
+    def __init__(self, mus_path: str) -> None:
+        self.report = PhaseReport("Mus2Mid")
+
+        with open(mus_path, "rb") as musinput:
+            header_id = struct.unpack("<4s", musinput.read(4))[0]
+
+            if header_id != MUS_ID:
+                raise ValueError(f"Unsupported file format: {header_id}")
+            else:
+                self.mus_path = mus_path
+                self.id = header_id
+                logger.info(f"File format detected: {header_id}")
+
+    def read_mus_header(self, musfile: BinaryIO) -> MusHeader:
+        """Reads and returns a MUS file header."""
+        return read_mus_header(musfile.read(16))
 
-        # Write track size
-        midioutput.seek(18)
-        midioutput.write(struct.pack("<I", self.tracksize))
+    def mus2mid(self, musinput: BinaryIO, midioutput: BinaryIO) -> None:
+        """Converts a MUS file to MIDI format."""
+        midioutput.write(mus2mid(musinput.read()))
 
-    def to_midi(self) -> None:
+    def to_midi(self) -> str:
         output_path = self.mus_path[:-4] + ".mid"
 
         if self.id == MUS_ID:
-            with open(self.mus_path, "rb") as musinput, open(output_path, "wb") as midioutput:
-                self.mus2mid(musinput, midioutput)
-                logger.info(f"Exported MUS {self.mus_path} as a MIDI file to {output_path}.")
+            with self.report.phase("read") as counts:
+                with open(self.mus_path, "rb") as musinput:
+                    mus_data = musinput.read()
+                counts["bytes"] = len(mus_data)
+            with self.report.phase("convert"):
+                midi_data = mus2mid(mus_data)
+            with self.report.phase("write") as counts:
+                with open(output_path, "wb") as midioutput:
+                    midioutput.write(midi_data)
+                counts["bytes"] = len(midi_data)
+            logger.bind(report=self.report.to_dict()).info(
+                f"Exported MUS {self.mus_path} as a MIDI file to {output_path}.")
             return output_path
         else:
             raise ValueError(f"Unsupported file format: {self.id}")
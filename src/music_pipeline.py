@@ -0,0 +1,223 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from loguru import logger
+
+from src.WADParser import WAD_file, open_wad_file
+from src.WADPlayer import AUDIO_WRITERS, SAMPLE_RATE, MIDIWavConverter
+from src.mus2mid import MIDI_ID, MUS_ID, MUSIC_FORMATS, mus2mid
+from src.parser_utils import find_wads, wad_stem
+from src.render_cache import file_digest
+
+"""Batch rendering of every music of one or many WADs to WAV or OGG.
+Each worker process loads the SoundFont once and reuses its synthesizer for all the tracks it renders.
+Outputs are named after the hash of the music data and render settings, so a track shared by several WADs
+(or already rendered by a previous run) is rendered only once. An index.json maps each WAD music to its file.
+
+CLI use:
+
+python -m src.music_pipeline -w <WAD files or folders> -o <output dir> -j <workers> -f <wav|ogg>
+
+Add -g <IWAD> to render with the OPL synthesizer and the GENMIDI instruments of that WAD, without FluidSynth.
+"""
+
+INDEX_NAME = "index.json"
+
+# Converter of each worker process, created by the pool initializer.
+_WORKER_CONVERTER = None
+
+
+def _init_worker(soundfont_path: str, samplerate: int, genmidi: bytes | None = None) -> None:
+    global _WORKER_CONVERTER
+    _WORKER_CONVERTER = MIDIWavConverter(soundfont_path=soundfont_path, samplerate=samplerate, genmidi=genmidi)
+    # Loading the SoundFont right away, once for all the tracks of this worker.
+    _WORKER_CONVERTER._get_synth()
+
+
+def _render_worker(music_data: bytes, output_path: str, fmt: str) -> float:
+    """Renders MUS or MIDI data to an audio file. Returns the duration of the track, in seconds."""
+    converter = _WORKER_CONVERTER
+    # Converted here, so that a corrupt MUS lump fails its own render only.
+    midi_data = mus2mid(music_data) if music_data[:4] == MUS_ID else music_data
+    # Written under a temporary name, so that an interrupted render never looks finished.
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        if fmt == "wav":
+            # WAV files are streamed block by block, whatever the length of the track.
+            n_bytes = sum(f.write(chunk) for chunk in converter.stream_wav(midi_data))
+            n_frames = (n_bytes - 44) // 4
+        else:
+            samples = converter.render(midi_data)
+            AUDIO_WRITERS[fmt](samples, f, converter.samplerate)
+            n_frames = len(samples)
+    os.replace(tmp_path, output_path)
+    return n_frames / converter.samplerate
+
+
+def music_digest(music_data: bytes, settings: dict) -> str:
+    hasher = hashlib.sha1(music_data)
+    hasher.update(json.dumps(settings, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def read_genmidi_lump(path: str) -> bytes:
+    """GENMIDI lump of a WAD, or content of a GENMIDI lump file."""
+    with open(path, "rb") as f:
+        header = f.read(4)
+    if header in [b"IWAD", b"PWAD"]:
+        wad = open_wad_file(path)
+        if "GENMIDI" not in wad._misc_lumps:
+            raise ValueError(f"No GENMIDI lump in {path}.")
+        return wad._lump_data(*wad._misc_lumps["GENMIDI"])
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def render_musics(
+    wads: list[WAD_file | str],
+    output_dir: str,
+    fmt: str = "wav",
+    workers: int | None = None,
+    soundfont_path: str = "media/gzdoom.sf2",
+    samplerate: int = SAMPLE_RATE,
+    genmidi: bytes | None = None,
+) -> dict[str, str]:
+    """Converts and renders every music of the given WADs: MUS -> MIDI -> WAV/OGG.
+    OGG and MP3 musics are already audio and are copied as they are.
+
+    Parameters
+    ----------
+    wads : list[WAD_file | str]
+        Parsed WADs or paths to WAD files.
+    output_dir : str
+        Directory of the rendered files and of the index.
+    fmt : str
+        Audio format of the rendered MIDI musics, "wav" or "ogg".
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    soundfont_path : str
+        SoundFont used by FluidSynth.
+    samplerate : int
+        Sample rate of the rendered files.
+    genmidi : bytes, optional
+        GENMIDI lump. If given, musics are rendered by the built-in OPL synthesizer instead of FluidSynth.
+
+    Returns
+    -------
+    dict[str, str]
+        Path of the audio file of each music, keyed by "<WAD name>/<music name>".
+    """
+
+    if fmt not in AUDIO_WRITERS:
+        raise ValueError(f"Unsupported audio format: {fmt}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    if genmidi is None:
+        settings = {"soundfont": file_digest(soundfont_path), "samplerate": samplerate}
+    else:
+        settings = {"genmidi": hashlib.sha1(genmidi).hexdigest(), "samplerate": samplerate}
+
+    # Gathering the tracks of every WAD, each unique content being rendered only once.
+    outputs = {}
+    to_render = {}
+    for wad in wads:
+        if isinstance(wad, str):
+            wad_name = wad_stem(wad)
+            wad = open_wad_file(wad)
+        else:
+            wad_name = wad_stem(getattr(wad.bytes, "name", "WAD"))
+
+        for music_name in wad.musics or []:
+            music_data = wad._lump_data(*wad._misc_lumps[music_name])
+            header_id = music_data[:4]
+            if header_id not in MUSIC_FORMATS:
+                logger.warning(f"Music format of {wad_name}/{music_name} not recognised: {header_id}")
+                continue
+
+            digest = music_digest(music_data, settings)
+            if header_id in [MUS_ID, MIDI_ID]:
+                output_path = os.path.join(output_dir, f"{digest}.{fmt}")
+                if not os.path.isfile(output_path):
+                    to_render[output_path] = music_data
+            else:
+                output_path = os.path.join(output_dir, digest + MUSIC_FORMATS[header_id])
+                if not os.path.isfile(output_path):
+                    with open(output_path, "wb") as f:
+                        f.write(music_data)
+
+            outputs[f"{wad_name}/{music_name}"] = output_path
+
+    logger.info(
+        f"{len(outputs)} musics found, {len(to_render)} to render with {workers or os.cpu_count()} workers.")
+
+    start_time = time.perf_counter()
+    audio_time = 0.0
+    if to_render:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(soundfont_path, samplerate, genmidi)
+        ) as pool:
+            futures = {
+                pool.submit(_render_worker, music_data, output_path, fmt): output_path
+                for output_path, music_data in to_render.items()
+            }
+
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    audio_time += future.result()
+                    logger.info(f"[{i + 1}/{len(futures)}] Rendered {futures[future]}.")
+                except Exception as exc:
+                    logger.warning(f"[{i + 1}/{len(futures)}] Failed to render {futures[future]}: {exc}")
+                    outputs = {k: v for k, v in outputs.items() if v != futures[future]}
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(
+        f"Rendered {len(to_render)} musics ({audio_time:.0f}s of audio) in {elapsed:.1f}s, "
+        f"{audio_time / max(elapsed, 1e-9):.1f}x real time."
+    )
+
+    # The index is merged with the one of previous runs.
+    index_path = os.path.join(output_dir, INDEX_NAME)
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    index.update({k: os.path.relpath(v, output_dir) for k, v in outputs.items()})
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+    return outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wad", "-w", type=str, nargs="+",
+                        help="WAD files or folders containing WAD files", default=["WADs"])
+    parser.add_argument("--output", "-o", type=str,
+                        help="Output directory", default="output/musics")
+    parser.add_argument("--format", "-f", type=str,
+                        help="Audio format", default="wav", choices=list(AUDIO_WRITERS.keys()))
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of worker processes (defaults to the number of CPUs)", default=None)
+    parser.add_argument("--soundfont", "-sf", type=str,
+                        help="SoundFont used to render the MIDI musics", default="media/gzdoom.sf2")
+    parser.add_argument("--samplerate", "-sr", type=int,
+                        help="Sample rate of the rendered musics", default=SAMPLE_RATE)
+    parser.add_argument("--genmidi", "-g", type=str,
+                        help="WAD or lump file with the GENMIDI instruments, to render with the OPL synthesizer",
+                        default=None)
+
+    args = parser.parse_args()
+
+    wad_paths = find_wads(args.wad)
+    if len(wad_paths) == 0:
+        raise ValueError(f"No WAD file found in {args.wad}")
+
+    genmidi = read_genmidi_lump(args.genmidi) if args.genmidi else None
+
+    render_musics(wad_paths, args.output, fmt=args.format, workers=args.jobs,
+                  soundfont_path=args.soundfont, samplerate=args.samplerate, genmidi=genmidi)
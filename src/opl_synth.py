@@ -0,0 +1,349 @@
+import numpy as np
+from loguru import logger
+
+"""Software FM synthesizer playing MIDI events with the OPL2/OPL3 instruments of the GENMIDI lump,
+as DOOM did on AdLib and Sound Blaster cards. It needs no native library nor SoundFont.
+The voices are rendered together with NumPy, as arrays of shape (voices, samples).
+
+This is an approximation of the OPL chip, not a cycle-exact emulation: envelopes are linear in dB
+with the attack, decay and release times of the YM3812 datasheet, operator feedback uses precomputed
+steady-state waveforms, and tremolo, vibrato, key scaling and the OPL3 extra waveforms are ignored.
+It offers the subset of the pyfluidsynth Synth methods used by MIDIWavConverter, so both can be swapped."""
+
+GENMIDI_HEADER = b"#OPL_II#"
+N_INSTRUMENTS = 175  # 128 melodic instruments, then 47 percussions for the keys 35 to 81
+FIRST_PERCUSSION_KEY = 35
+PERCUSSION_CHANNEL = 9
+
+GENMIDI_OP_DTYPE = np.dtype(
+    [
+        ("tremolo", "u1"),  # AM, vibrato, sustain, KSR and frequency multiplier (register 0x20)
+        ("attack", "u1"),  # attack and decay rates (0x60)
+        ("sustain", "u1"),  # sustain level and release rate (0x80)
+        ("waveform", "u1"),  # (0xE0)
+        ("scale", "u1"),  # key scale level (0x40, upper bits)
+        ("level", "u1"),  # output level (0x40, lower bits)
+    ]
+)
+GENMIDI_VOICE_DTYPE = np.dtype(
+    [
+        ("modulator", GENMIDI_OP_DTYPE),
+        ("feedback", "u1"),  # feedback and connection (0xC0)
+        ("carrier", GENMIDI_OP_DTYPE),
+        ("unused", "u1"),
+        ("base_note_offset", "<i2"),
+    ]
+)
+GENMIDI_INSTR_DTYPE = np.dtype(
+    [
+        ("flags", "<u2"),
+        ("fine_tuning", "u1"),
+        ("fixed_note", "u1"),
+        ("voices", GENMIDI_VOICE_DTYPE, (2,)),
+    ]
+)
+FLAG_FIXED_PITCH = 0x01
+FLAG_DOUBLE_VOICE = 0x04
+
+FREQ_MULTIPLIERS = np.array([0.5, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 12, 12, 15, 15])
+
+# Times of the YM3812 datasheet for rate 1, halved at each rate step. Rate 0 never ends, attack rate 15 is instant.
+ATTACK_TIME = 2.82624  # seconds, from silence to full level
+DECAY_TIME = 39.28064  # seconds, from full level to -96 dB
+SILENCE_DB = 96.0
+
+# Full-scale modulator output shifts the carrier phase by 2 cycles (4 pi), as on the chip.
+MODULATION_DEPTH = 2.0
+WAVE_SIZE = 1024
+
+
+def read_genmidi(lump: bytes) -> np.ndarray:
+    """Reads the 175 instruments of a GENMIDI lump, as a GENMIDI_INSTR_DTYPE array."""
+    if lump[:8] != GENMIDI_HEADER:
+        raise ValueError(f"Unsupported GENMIDI format: {lump[:8]}")
+    if len(lump) < 8 + N_INSTRUMENTS * GENMIDI_INSTR_DTYPE.itemsize:
+        raise ValueError("GENMIDI lump is too short.")
+    return np.frombuffer(lump, dtype=GENMIDI_INSTR_DTYPE, count=N_INSTRUMENTS, offset=8)
+
+
+def _make_waveforms() -> np.ndarray:
+    """The 4 OPL2 waveforms, sampled over one cycle: sine, half sine, absolute sine and quarter sine pulses."""
+    phase = np.arange(WAVE_SIZE) / WAVE_SIZE
+    sine = np.sin(2 * np.pi * phase)
+    return np.stack([sine, np.maximum(sine, 0), np.abs(sine), np.where(phase % 0.5 < 0.25, np.abs(sine), 0)])
+
+
+def _make_feedback_waveforms(waveforms: np.ndarray, n_iterations: int = 64) -> np.ndarray:
+    """Steady-state waveforms of an operator modulated by the average of its two last outputs,
+    for the 8 feedback levels (0, pi/16 ... 4 pi). Shape (8, 4, WAVE_SIZE).
+    They are found by iterating over whole cycles, which converges for all but the noisiest levels."""
+    beta = np.concatenate([[0.0], 2.0 ** np.arange(7) / 32])[:, np.newaxis, np.newaxis]  # in cycles
+    phase_idx = np.arange(WAVE_SIZE)
+    wave_idx = np.arange(len(waveforms))[:, np.newaxis]
+
+    output = np.broadcast_to(waveforms, (8,) + waveforms.shape).copy()
+    for _ in range(n_iterations):
+        shift = beta * (np.roll(output, 1, axis=-1) + np.roll(output, 2, axis=-1)) / 2
+        idx = (phase_idx + np.floor(shift * WAVE_SIZE).astype(np.int64)) & (WAVE_SIZE - 1)
+        output = waveforms[wave_idx, idx]
+    return output
+
+
+_FEEDBACK_WAVEFORMS = None
+
+
+def get_feedback_waveforms() -> np.ndarray:
+    """Flat table of the waveforms of every feedback level, computed once per process."""
+    global _FEEDBACK_WAVEFORMS
+    if _FEEDBACK_WAVEFORMS is None:
+        _FEEDBACK_WAVEFORMS = _make_feedback_waveforms(_make_waveforms()).ravel()
+    return _FEEDBACK_WAVEFORMS
+
+
+def rate_to_db_per_second(rate: np.ndarray, full_time: float) -> np.ndarray:
+    """Envelope speed of 4-bit OPL rates, in dB per second. Rate 0 is 0, the highest rates are instantaneous."""
+    rate = np.asarray(rate, dtype=np.float64)
+    with np.errstate(divide="ignore"):
+        speed = np.where(rate > 0, SILENCE_DB / (full_time * 2.0 ** (1 - rate)), 0.0)
+    return speed
+
+
+def envelope(
+    stage: np.ndarray,
+    att: np.ndarray,
+    attack: np.ndarray,
+    decay: np.ndarray,
+    sustain_level: np.ndarray,
+    release: np.ndarray,
+    sustained: np.ndarray,
+    times: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Attenuation in dB of envelopes over a block, with the stage changes that happen within it.
+
+    Parameters
+    ----------
+    stage : np.ndarray
+        Stage at the start of the block: 0 attack, 1 decay, 2 sustain, 3 release.
+    att : np.ndarray
+        Attenuation at the start of the block, in dB.
+    attack, decay, release : np.ndarray
+        Speeds of the stages, in dB per second.
+    sustain_level : np.ndarray
+        Attenuation of the sustain stage, in dB.
+    sustained : np.ndarray
+        Whether the sound is held at the sustain level until key off, or keeps fading at the release speed.
+    times : np.ndarray
+        Times of the samples since the start of the block, in seconds.
+
+    Returns
+    -------
+    np.ndarray
+        Attenuation of shape stage.shape + times.shape.
+    np.ndarray
+        Stage at the end of the block.
+    """
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Times at which the attack and decay stages end, counted from the start of the block.
+        attack_end = np.where(stage == 0, np.where(att > 0, att / attack, 0.0), 0.0)
+        decay_start = np.where(stage == 0, 0.0, att)
+        decay_end = np.where(
+            stage <= 1, attack_end + np.where(sustain_level > decay_start, (sustain_level - decay_start) / decay, 0.0), 0.0
+        )
+        sustain_start = np.where(stage == 2, att, sustain_level)
+        sustain_speed = np.where(sustained, 0.0, release)
+
+        e = np.expand_dims
+        t = times
+        result = np.where(
+            t < e(attack_end, -1),
+            e(att, -1) - e(attack, -1) * t,
+            np.where(
+                t < e(decay_end, -1),
+                e(decay_start, -1) + e(decay, -1) * (t - e(attack_end, -1)),
+                e(sustain_start, -1) + e(sustain_speed, -1) * (t - e(decay_end, -1)),
+            ),
+        )
+        result = np.where(e(stage, -1) == 3, e(att, -1) + e(release, -1) * t, result)
+
+    end = times[-1]
+    new_stage = np.where(stage == 3, 3, np.where(end < attack_end, 0, np.where(end < decay_end, 1, 2)))
+    return np.clip(np.nan_to_num(result, nan=SILENCE_DB), 0.0, SILENCE_DB), new_stage
+
+
+class OPLSynth:
+    def __init__(self, genmidi: bytes, samplerate: int = 44100, gain: float = 0.2, max_voices: int = 18):
+        """FM synthesizer using the instruments of a GENMIDI lump. 18 voices by default, as an OPL3 chip."""
+        self.instruments = read_genmidi(genmidi)
+        self.samplerate = samplerate
+        self.gain = gain
+        self.max_voices = max_voices
+        self.waveforms = get_feedback_waveforms()
+
+        self.programs = np.zeros(16, dtype=np.int64)
+        self.volumes = np.full(16, 100, dtype=np.int64)
+        self.bends = np.zeros(16)  # semitones
+
+        v = max_voices
+        self.active = np.zeros(v, dtype=bool)
+        self.released = np.zeros(v, dtype=bool)
+        self.order = np.zeros(v, dtype=np.int64)
+        self.channel = np.zeros(v, dtype=np.int64)
+        self.key = np.zeros(v, dtype=np.int64)
+        self.velocity = np.zeros(v)
+        self.freq = np.zeros(v)  # Hz, before pitch bend
+        self.feedback = np.zeros(v, dtype=np.int64)
+        self.additive = np.zeros(v, dtype=bool)
+        # Operator parameters and state, [:, 0] for the modulator and [:, 1] for the carrier.
+        self.mult = np.ones((v, 2))
+        self.level = np.zeros((v, 2))  # dB
+        self.attack = np.zeros((v, 2))
+        self.decay = np.zeros((v, 2))
+        self.sustain_level = np.zeros((v, 2))
+        self.release = np.zeros((v, 2))
+        self.sustained = np.zeros((v, 2), dtype=bool)
+        self.wave = np.zeros((v, 2), dtype=np.int64)
+        self.stage = np.full((v, 2), 3, dtype=np.int64)
+        self.att = np.full((v, 2), SILENCE_DB)
+        self.phase = np.zeros((v, 2))  # cycles
+        self._counter = 0
+
+    def _allocate_voice(self) -> int:
+        """First free voice, or else the oldest released one, or else the oldest one."""
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            return int(free[0])
+        released = np.flatnonzero(self.released)
+        candidates = released if len(released) else np.arange(self.max_voices)
+        return int(candidates[np.argmin(self.order[candidates])])
+
+    def _set_voice(self, idx: int, channel: int, key: int, velocity: int, instrument: np.void, voice_idx: int) -> None:
+        voice = instrument["voices"][voice_idx]
+        ops = [voice["modulator"], voice["carrier"]]
+
+        note = int(instrument["fixed_note"]) if instrument["flags"] & FLAG_FIXED_PITCH else key
+        note = min(max(note + int(voice["base_note_offset"]), 0), 127)
+        # The second voice is detuned by the fine tuning, in 1/32 of semitone.
+        detune = (int(instrument["fine_tuning"]) // 2 - 64) / 32 if voice_idx == 1 else 0.0
+
+        self.active[idx] = True
+        self.released[idx] = False
+        self.order[idx] = self._counter
+        self._counter += 1
+        self.channel[idx] = channel
+        self.key[idx] = key
+        self.velocity[idx] = velocity
+        self.freq[idx] = 440.0 * 2.0 ** ((note - 69 + detune) / 12)
+        self.feedback[idx] = (voice["feedback"] >> 1) & 7
+        self.additive[idx] = bool(voice["feedback"] & 1)
+
+        for i, op in enumerate(ops):
+            self.mult[idx, i] = FREQ_MULTIPLIERS[op["tremolo"] & 0x0F]
+            self.sustained[idx, i] = bool(op["tremolo"] & 0x20)
+            self.level[idx, i] = (op["level"] & 0x3F) * 0.75
+            self.attack[idx, i] = np.inf if op["attack"] >> 4 == 15 else rate_to_db_per_second(op["attack"] >> 4, ATTACK_TIME)
+            self.decay[idx, i] = rate_to_db_per_second(op["attack"] & 0x0F, DECAY_TIME)
+            sustain_level = op["sustain"] >> 4
+            self.sustain_level[idx, i] = SILENCE_DB if sustain_level == 15 else sustain_level * 3.0
+            self.release[idx, i] = rate_to_db_per_second(op["sustain"] & 0x0F, DECAY_TIME)
+            self.wave[idx, i] = op["waveform"] & 3
+        self.stage[idx] = 0
+        self.att[idx] = SILENCE_DB
+        self.phase[idx] = 0.0
+
+    def noteon(self, channel: int, key: int, velocity: int) -> None:
+        if velocity == 0:
+            self.noteoff(channel, key)
+            return
+
+        if channel == PERCUSSION_CHANNEL:
+            instrument_idx = 128 + key - FIRST_PERCUSSION_KEY
+            if not 128 <= instrument_idx < N_INSTRUMENTS:
+                return
+        else:
+            instrument_idx = self.programs[channel]
+
+        instrument = self.instruments[instrument_idx]
+        n_voices = 2 if instrument["flags"] & FLAG_DOUBLE_VOICE else 1
+        for voice_idx in range(n_voices):
+            self._set_voice(self._allocate_voice(), channel, key, velocity, instrument, voice_idx)
+
+    def noteoff(self, channel: int, key: int) -> None:
+        voices = self.active & ~self.released & (self.channel == channel) & (self.key == key)
+        self.released[voices] = True
+        self.stage[voices] = 3
+
+    def cc(self, channel: int, controller: int, value: int) -> None:
+        on_channel = self.active & (self.channel == channel)
+        if controller == 7:  # Volume
+            self.volumes[channel] = value
+        elif controller == 120:  # All sound off
+            self.active[on_channel] = False
+        elif controller == 121:  # Reset all controllers
+            self.bends[channel] = 0.0
+        elif controller == 123:  # All notes off
+            self.released[on_channel] = True
+            self.stage[on_channel] = 3
+
+    def program_change(self, channel: int, program: int) -> None:
+        self.programs[channel] = program
+
+    def pitch_bend(self, channel: int, value: int) -> None:
+        """Pitch bend from -8192 to 8191, over +/- 2 semitones as in DOOM."""
+        self.bends[channel] = value / 8192 * 2
+
+    def get_samples(self, n_samples: int) -> np.ndarray:
+        """Renders the next samples, as interleaved stereo int16 like pyfluidsynth."""
+
+        voices = np.flatnonzero(self.active)
+        if n_samples <= 0 or len(voices) == 0:
+            return np.zeros(2 * max(n_samples, 0), dtype=np.int16)
+
+        samples = np.arange(n_samples)
+        times = (samples + 1) / self.samplerate
+
+        # Phase of both operators of each voice, in cycles: shape (voices, 2, samples).
+        freq = self.freq[voices] * 2.0 ** (self.bends[self.channel[voices]] / 12)
+        increment = (freq[:, np.newaxis] * self.mult[voices]) / self.samplerate
+        phase = self.phase[voices][:, :, np.newaxis] + increment[:, :, np.newaxis] * samples
+
+        att, stage = envelope(
+            self.stage[voices],
+            self.att[voices],
+            self.attack[voices],
+            self.decay[voices],
+            self.sustain_level[voices],
+            self.release[voices],
+            self.sustained[voices],
+            times,
+        )
+        amplitude = np.exp2((att + self.level[voices][:, :, np.newaxis]) * (-np.log2(10) / 20))
+
+        # Modulator, with its feedback waveform.
+        table = (self.feedback[voices] * 4 + self.wave[voices, 0]) * WAVE_SIZE
+        idx = (phase[:, 0] * WAVE_SIZE).astype(np.int64) & (WAVE_SIZE - 1)
+        modulator = amplitude[:, 0] * self.waveforms[table[:, np.newaxis] + idx]
+
+        # Carrier, phase modulated by the modulator unless both are simply added.
+        additive = self.additive[voices][:, np.newaxis]
+        carrier_phase = phase[:, 1] + np.where(additive, 0.0, MODULATION_DEPTH * modulator)
+        idx = (carrier_phase * WAVE_SIZE).astype(np.int64) & (WAVE_SIZE - 1)
+        carrier = amplitude[:, 1] * self.waveforms[(self.wave[voices, 1] * WAVE_SIZE)[:, np.newaxis] + idx]
+
+        output = np.where(additive, modulator + carrier, carrier)
+        volume = self.velocity[voices] * self.volumes[self.channel[voices]] / 127**2
+        mix = (volume @ output) * (self.gain * 32767)
+
+        # Voice states at the end of the block.
+        self.phase[voices] = (phase[:, :, -1] + increment) % 1.0
+        self.att[voices] = att[:, :, -1]
+        self.stage[voices] = stage
+        silent = (att[:, 1, -1] >= SILENCE_DB) & ((stage[:, 1] == 3) | ~self.sustained[voices, 1])
+        self.active[voices[silent]] = False
+
+        mix = np.clip(mix, -32768, 32767).astype(np.int16)
+        return np.repeat(mix, 2)
+
+    def delete(self) -> None:
+        self.active[:] = False
+        logger.info("OPL synthesizer released.")
@@ -1,5 +1,8 @@
+import os
 import re
 
+from loguru import logger
+
 
 EXMY_REGEX = re.compile(r"^E(?P<episode>[0-9])M(?P<number>[0-9])$")
 MAPXY_REGEX = re.compile(r"^MAP(?P<number>[0-9]{2}[A-Z]?)$")
@@ -23,3 +26,22 @@ MAPS_LUMPS = [
     "SCRIPTS",
     "ENDMAP",
 ]
+
+
+def wad_stem(wad_path: str) -> str:
+    """Name of a WAD file, without its folder and extension."""
+    return os.path.splitext(os.path.basename(wad_path))[0]
+
+
+def find_wads(paths: list[str]) -> list[str]:
+    """Expand a list of files and folders into a sorted list of WAD files."""
+    wads = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                wads += [os.path.join(root, f) for f in files if f.lower().endswith(".wad")]
+        elif os.path.isfile(path):
+            wads.append(path)
+        else:
+            logger.warning(f"No file detected at {path}.")
+    return sorted(set(wads))
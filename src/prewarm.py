@@ -0,0 +1,149 @@
+import sys
+import threading
+import time
+
+from loguru import logger
+
+from src.WADPlayer import MIDIWavConverter
+from src.WADViewer import WadViewer
+from src.render_cache import RenderCache
+
+"""Background prewarming of a parsed WAD: map payloads, gallery thumbnails and music renders are computed
+ahead of time, in a worker thread, into the caches the app pages read from (the viewer caches and the render cache).
+Tasks are run in priority order: what each page shows first, then the rest. A job can be cancelled between two tasks,
+and started again from where it stopped. Sessions sharing a job acquire and release it: it is cancelled when the last
+one leaves."""
+
+# Number of thumbnails on the first page of a gallery.
+GALLERY_PAGE = 48
+
+
+def prewarm_tasks(viewer: WadViewer, render_musics: bool = True) -> list[tuple[str, str]]:
+    """(kind, name) of everything to prewarm, in priority order."""
+    wad = viewer.wad
+    maps = sorted(wad.maps.keys()) if wad.maps else []
+    galleries = {
+        "textures": list(wad.textures.keys()) if wad.textures else [],
+        "flats": wad.flats or [],
+        "sprites": [name for sheet in sorted(wad.spritesheets) for name in wad.spritesheets[sheet]]
+        if wad.spritesheets else [],
+    }
+    # Musics are played by the MCI player on Windows, there is nothing to render.
+    musics = (wad.musics or []) if render_musics and sys.platform != "win32" else []
+
+    first = [("maps", x) for x in maps[:1]]
+    first += [(kind, x) for kind, names in galleries.items() for x in names[:GALLERY_PAGE]]
+    first += [("musics", x) for x in musics[:1]]
+    rest = [("maps", x) for x in maps[1:]]
+    rest += [(kind, x) for kind, names in galleries.items() for x in names[GALLERY_PAGE:]]
+    rest += [("musics", x) for x in musics[1:]]
+    return first + rest
+
+
+class PrewarmJob:
+    def __init__(self, viewer: WadViewer, tasks: list[tuple[str, str]] | None = None):
+        """Prewarms the caches of a viewer, and of the render cache for the musics, in a daemon thread."""
+        self.viewer = viewer
+        self.tasks = prewarm_tasks(viewer) if tasks is None else tasks
+        self.done = 0
+        self.failed = 0
+        self.current = None
+        self._cancelled = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._converter = None
+        self._skip_musics = False
+        # Number of sessions using the job.
+        self._sessions = 0
+
+    @property
+    def total(self) -> int:
+        return len(self.tasks)
+
+    @property
+    def finished(self) -> bool:
+        return self.done >= self.total
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        """Starts the job, or resumes it if it was cancelled. A thread still finishing its task after a cancellation
+        goes on with the next tasks."""
+        with self._lock:
+            self._cancelled.clear()
+            if self.running or self.finished:
+                return
+            self._thread = threading.Thread(target=self._run, name="prewarm", daemon=True)
+            self._thread.start()
+
+    def cancel(self) -> None:
+        """Stops the job after the current task."""
+        self._cancelled.set()
+
+    def acquire(self) -> None:
+        """Registers a session using the job, and starts it."""
+        with self._lock:
+            self._sessions += 1
+        self.start()
+
+    def release(self) -> None:
+        """Unregisters a session. The job is cancelled when no session uses it anymore."""
+        with self._lock:
+            self._sessions = max(self._sessions - 1, 0)
+            if self._sessions == 0:
+                self.cancel()
+
+    def _run(self) -> None:
+        start_time = time.perf_counter()
+        while True:
+            # Stopping is decided under the lock, so that start() either sees this thread going on or finished.
+            with self._lock:
+                if self.done >= self.total or self._cancelled.is_set():
+                    # The synthesizer is released before a new thread can be started, which would load its own.
+                    if self._converter is not None:
+                        self._converter.close()
+                        self._converter = None
+                    self._thread = None
+                    self.current = None
+                    break
+            kind, name = self.tasks[self.done]
+            self.current = f"{kind}/{name}"
+            try:
+                self._prewarm(kind, name)
+            except Exception as exc:
+                self.failed += 1
+                logger.warning(f"Prewarm: failed on {self.current}: {exc}")
+            self.done += 1
+
+        state = "cancelled" if self._cancelled.is_set() else "done"
+        logger.info(f"Prewarm {state}: {self.done}/{self.total} tasks in {time.perf_counter() - start_time:.1f}s.")
+
+    def _prewarm(self, kind: str, name: str) -> None:
+        if kind == "maps":
+            # The maps page shows the interactive viewer by default: rasters are only drawn if it is turned off.
+            self.viewer.get_map_payload(name)
+        elif kind in ["textures", "flats", "sprites"]:
+            self.viewer.get_thumbnail(kind, name)
+        elif kind == "musics":
+            self._render_music(name)
+        else:
+            raise ValueError(f"Unknown prewarm kind: {kind}")
+
+    def _render_music(self, name: str) -> None:
+        if self._skip_musics:
+            return
+        music_data, extension = self.viewer.wad.get_music_data(name, to_midi=True)
+        if extension != ".mid":
+            return
+
+        # Same settings as the musics page, so that it finds the render in the cache.
+        try:
+            if self._converter is None:
+                self._converter = MIDIWavConverter(cache=RenderCache())
+            self._converter.render_wav(music_data)
+        except (ImportError, FileNotFoundError) as exc:
+            # No FluidSynth or no SoundFont: no music can be rendered.
+            logger.info(f"Prewarm: musics are not rendered ({exc}).")
+            self._skip_musics = True
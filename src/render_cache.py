@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Iterable
+
+from loguru import logger
+
+"""Size-bounded disk cache of rendered audio files, addressed by the hash of what produced them.
+Files are evicted least recently used first: a cache hit refreshes the modification time of its file.
+The cache lives in the temporary directory of the system, unless PYWAD_AUDIO_CACHE points elsewhere."""
+
+DEFAULT_CACHE_DIR = os.environ.get("PYWAD_AUDIO_CACHE", os.path.join(tempfile.gettempdir(), "pywad_audio_cache"))
+
+# SoundFonts are large, their hash is computed once per file version: (path, size, mtime) -> digest.
+_FILE_DIGESTS = {}
+
+
+def file_digest(path: str) -> str:
+    """SHA-1 of a file, memoized as long as the file size and modification time are unchanged."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_DIGESTS:
+        hasher = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+        _FILE_DIGESTS[key] = hasher.hexdigest()
+    return _FILE_DIGESTS[key]
+
+
+def render_key(data: bytes, soundfont_path: str | None, settings: dict) -> str:
+    """Cache key of a render: hash of the input data, of the SoundFont (if any) and of the synthesizer settings."""
+    hasher = hashlib.sha1(data)
+    if soundfont_path is not None:
+        hasher.update(file_digest(soundfont_path).encode())
+    hasher.update(json.dumps(settings, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+class RenderCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 512 * 1024**2):
+        """Disk store of rendered files, limited to max_bytes in total."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: str, ext: str = ".wav") -> str:
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key: str, ext: str = ".wav") -> str | None:
+        """Path of the cached file, or None if it is not in the cache."""
+        path = self.path(key, ext)
+        try:
+            # Marks the file as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        logger.info(f"Render cache hit: {path}")
+        return path
+
+    def put(self, key: str, data: bytes | Iterable[bytes], ext: str = ".wav") -> str:
+        """Stores data in the cache and returns its path, evicting the oldest files if needed.
+        Data can be given in chunks, e.g. from a streaming render, so that it is never held in memory at once."""
+        path = self.path(key, ext)
+        # Written under a temporary name, unique to this writer, so that a reader never sees a partial file
+        # and concurrent writers of a same key (threads or processes) do not clash.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    f.write(data)
+                else:
+                    f.writelines(data)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str | None = None) -> None:
+        """Removes the least recently used files until the cache fits in max_bytes."""
+        # Files can be removed meanwhile by other threads or processes sharing the cache.
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        keep = os.path.abspath(keep) if keep is not None else None
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if os.path.abspath(path) == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted from the render cache: {path}")
+            except FileNotFoundError:
+                pass
+
+    def size(self) -> int:
+        """Total size of the cached files, in bytes."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                os.remove(entry.path)
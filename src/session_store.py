@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+"""Per-session stores of exported assets (sounds, musics...), so that concurrent users of the app never share files.
+Each store keeps its assets in memory, within a byte quota, evicting the least recently used ones first.
+Large assets, or assets that must be files (e.g. for the Windows MIDI player), can be spilled to a temporary
+directory of the session, within a quota of their own. Stores left idle longer than their time-to-live are dropped
+with their directory, by a background thread."""
+
+
+class SessionStore:
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024**2,
+        spill: bool = False,
+        spill_threshold: int = 4 * 1024**2,
+        max_spill_bytes: int = 256 * 1024**2,
+    ):
+        """Assets of one session, at most max_bytes in memory. With spill, assets larger than spill_threshold
+        are written to a temporary directory instead, at most max_spill_bytes of them."""
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.spill_threshold = spill_threshold
+        self.max_spill_bytes = max_spill_bytes
+        self.last_access = time.monotonic()
+        self._memory = OrderedDict()
+        self._files = OrderedDict()
+        # Running totals of the sizes of the assets, in memory and on disk.
+        self._memory_bytes = 0
+        self._file_sizes = {}
+        self._file_bytes = 0
+        self._spill_dir = None
+        self._lock = threading.Lock()
+
+    def _touch(self) -> None:
+        self.last_access = time.monotonic()
+
+    def get(self, key: str) -> bytes | None:
+        """Content of an asset, or None if it is not (or no longer) in the store."""
+        self._touch()
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            path = self._files.get(key)
+            if path is not None:
+                self._files.move_to_end(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, key: str, data: bytes) -> None:
+        self._touch()
+        if self.spill and len(data) > self.spill_threshold:
+            self.put_file(key, data)
+            return
+        with self._lock:
+            self._remove_file(key)
+            self._memory_bytes += len(data) - len(self._memory.get(key, b""))
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            self._evict()
+
+    def put_file(self, key: str, data: bytes, suffix: str = "") -> str:
+        """Stores an asset as a file of the session directory, and returns its path."""
+        self._touch()
+        with self._lock:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix="pywad_session_")
+            self._remove_memory(key)
+            self._remove_file(key)
+            fd, path = tempfile.mkstemp(suffix=suffix, dir=self._spill_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            self._files[key] = path
+            self._file_sizes[key] = len(data)
+            self._file_bytes += len(data)
+            self._evict_files()
+        return path
+
+    def path(self, key: str) -> str | None:
+        """Path of an asset stored as a file, or None."""
+        self._touch()
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+            return self._files.get(key)
+
+    def get_or_create(self, key: str, create, as_file: bool = False, suffix: str = ""):
+        """Content of an asset (or its path, as_file), created by create() if it is not in the store."""
+        if as_file:
+            path = self.path(key)
+            return path if path is not None else self.put_file(key, create(), suffix=suffix)
+        data = self.get(key)
+        if data is None:
+            data = create()
+            self.put(key, data)
+        return data
+
+    def discard(self, key: str) -> None:
+        """Drops an asset, in memory or on disk, if it is in the store."""
+        with self._lock:
+            self._remove_memory(key)
+            self._remove_file(key)
+
+    def _remove_memory(self, key: str) -> None:
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_bytes -= len(data)
+
+    def _remove_file(self, key: str) -> None:
+        path = self._files.pop(key, None)
+        if path is not None:
+            self._file_bytes -= self._file_sizes.pop(key)
+            try:
+                os.remove(path)
+            except OSError:
+                # The Windows MIDI player can still hold the file, the directory is removed with the session.
+                pass
+
+    def _evict(self) -> None:
+        # The last stored asset is always kept, even if it is larger than the quota on its own.
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            key, data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+            logger.debug(f"Evicted from the session store: {key}")
+
+    def _evict_files(self) -> None:
+        # As in memory, the last stored file is always kept.
+        while self._file_bytes > self.max_spill_bytes and len(self._files) > 1:
+            key = next(iter(self._files))
+            self._remove_file(key)
+            logger.debug(f"Evicted from the session directory: {key}")
+
+    def size(self) -> int:
+        """Size of the assets held in memory, in bytes."""
+        return self._memory_bytes
+
+    def spilled_size(self) -> int:
+        """Size of the assets spilled to the session directory, in bytes."""
+        return self._file_bytes
+
+    def close(self) -> None:
+        """Drops every asset and the temporary directory of the session."""
+        with self._lock:
+            self._memory.clear()
+            self._files.clear()
+            self._file_sizes.clear()
+            self._memory_bytes = 0
+            self._file_bytes = 0
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+
+class SessionStores:
+    def __init__(self, ttl: float = 3600, sweep_interval: float = 60, **store_kwargs):
+        """Stores of all the sessions of the app process. Stores idle for more than ttl seconds are closed,
+        by a daemon thread sweeping them every sweep_interval seconds: sessions that never come back are dropped too."""
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.store_kwargs = store_kwargs
+        self._stores = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="session-store-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Session store sweep failed: {e}")
+
+    def get(self, session_id: str) -> SessionStore:
+        """Store of a session, created on first use. Expired stores of other sessions are dropped on the way."""
+        self.sweep()
+        with self._lock:
+            if session_id not in self._stores:
+                self._stores[session_id] = SessionStore(**self.store_kwargs)
+            store = self._stores[session_id]
+            store._touch()
+            return store
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, store in self._stores.items() if now - store.last_access > self.ttl]
+            for session_id in expired:
+                self._stores.pop(session_id).close()
+        if expired:
+            logger.info(f"Dropped {len(expired)} idle session stores.")
+
+    def size(self) -> int:
+        """Memory held by all the stores, in bytes."""
+        with self._lock:
+            return sum(store.size() for store in self._stores.values())
+
+    def close(self) -> None:
+        """Stops the sweeping thread and closes every store."""
+        self._stopped.set()
+        with self._lock:
+            stores = list(self._stores.values())
+            self._stores.clear()
+        for store in stores:
+            store.close()
@@ -0,0 +1,252 @@
+import argparse
+import os
+import struct
+from typing import BinaryIO
+
+import numpy as np
+from loguru import logger
+
+from src.WADParser import WAD_file
+from src.pc_speaker import PCS_SAMPLERATE, decode_pc_speaker, is_pc_speaker, render_pc_speaker
+
+"""Batch decoding of the DMX sound lumps of a WAD into NumPy arrays, resampled and packed into a single sound bank.
+See https://doomwiki.org/wiki/Sound
+
+DMX sounds are 8-bit unsigned PCM, with a header giving their format (3), sample rate and number of samples.
+The samples are normally padded with 16 copies of the first and last sample, which are removed here.
+PC speaker sounds (format 0) can be decoded along, they are rendered to square waves by pc_speaker.py."""
+
+DMX_HEADER = struct.Struct("<HHI")
+DMX_FORMAT = 3
+DMX_PADDING = 16
+SAMPLE_RATES = [11025, 22050, 44100, 48000]
+SAMPLE_DTYPES = ["uint8", "int16", "float32"]
+
+BANK_ID = b"DSBK"
+# Bank header: id, version, sample rate, dtype index, number of sounds. Then one (name, offset, length) per sound.
+BANK_HEADER = struct.Struct("<4sHIHI")
+BANK_ENTRY = struct.Struct("<8sQQ")
+
+
+def decode_dmx(lump: bytes, name: str = "") -> tuple[int, np.ndarray]:
+    """Validates a DMX sound lump and returns its sample rate and its uint8 samples, without the padding."""
+
+    if len(lump) < DMX_HEADER.size:
+        raise ValueError(f"Sound {name} is too short to hold a header.")
+    sound_format, sample_rate, sample_count = DMX_HEADER.unpack_from(lump)
+    if sound_format != DMX_FORMAT:
+        raise ValueError(f"Sound {name} is not a DMX sound (format {sound_format}).")
+    if sample_rate == 0:
+        raise ValueError(f"Sound {name} has a sample rate of 0.")
+    if sample_count > len(lump) - DMX_HEADER.size:
+        logger.warning(f"Sound {name} is truncated: {sample_count} samples announced, "
+                       f"{len(lump) - DMX_HEADER.size} found.")
+        sample_count = len(lump) - DMX_HEADER.size
+
+    samples = np.frombuffer(lump, dtype=np.uint8, count=sample_count, offset=DMX_HEADER.size)
+
+    # The padding repeats the first and last samples. It is only removed when it is really there.
+    if sample_count > 2 * DMX_PADDING:
+        head, tail = samples[:DMX_PADDING], samples[-DMX_PADDING:]
+        if np.all(head == samples[DMX_PADDING]) and np.all(tail == samples[-DMX_PADDING - 1]):
+            samples = samples[DMX_PADDING:-DMX_PADDING]
+
+    return sample_rate, samples
+
+
+def convert_samples(samples: np.ndarray, dtype: str) -> np.ndarray:
+    """Converts samples on the unsigned 8-bit scale (128 being silence), decoded or resampled,
+    to uint8, int16 or float32 in [-1, 1[."""
+    if dtype == "uint8":
+        return np.clip(np.round(samples), 0, 255).astype(np.uint8)
+    if dtype == "int16":
+        return np.clip(np.round((samples.astype(np.float32) - 128) * 256), -32768, 32767).astype(np.int16)
+    if dtype == "float32":
+        return (samples.astype(np.float32) - 128) / 128
+    raise ValueError(f"Unsupported sample type: {dtype}. Use one of {SAMPLE_DTYPES}.")
+
+
+def resample_batch(sounds: list[np.ndarray], rates: list[int], target_rate: int) -> list[np.ndarray]:
+    """Resamples many sounds at once by linear interpolation, with a single gather over all of them.
+
+    Parameters
+    ----------
+    sounds : list[np.ndarray]
+        1D arrays of samples.
+    rates : list[int]
+        Sample rate of each sound.
+    target_rate : int
+        Sample rate of the results.
+    """
+
+    if len(sounds) == 0:
+        return []
+
+    lengths = np.array([len(x) for x in sounds], dtype=np.int64)
+    rates = np.asarray(rates, dtype=np.float64)
+    out_lengths = np.where(lengths > 0, np.ceil(lengths * target_rate / rates).astype(np.int64), 0)
+
+    # Position of every output sample in the concatenation of all the sounds.
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    out_starts = np.concatenate([[0], np.cumsum(out_lengths)[:-1]])
+    sound_idx = np.repeat(np.arange(len(sounds)), out_lengths)
+    k = np.arange(out_lengths.sum()) - out_starts[sound_idx]
+    position = k * (rates[sound_idx] / target_rate)
+
+    # Each sound is interpolated between its own samples only: the last one is held.
+    left = np.floor(position).astype(np.int64)
+    frac = position - left
+    last = lengths[sound_idx] - 1
+    left = np.minimum(left, last)
+    right = np.minimum(left + 1, last)
+
+    data = np.concatenate(sounds).astype(np.float64)
+    base = starts[sound_idx]
+    resampled = data[base + left] * (1 - frac) + data[base + right] * frac
+
+    return np.split(resampled, np.cumsum(out_lengths)[:-1])
+
+
+def read_lumps(wad: WAD_file, names: list[str]) -> dict[str, bytes]:
+    """Reads lumps by name, in the order they are stored in the WAD, so that the file is read sequentially."""
+    entries = sorted((wad._misc_lumps[name][0], name) for name in names)
+    return {name: wad._lump_data(*wad._misc_lumps[name]) for _, name in entries}
+
+
+def decode_sounds(
+    wad: WAD_file,
+    names: list[str] | None = None,
+    samplerate: int | None = None,
+    dtype: str = "float32",
+    pc_speaker: bool = False,
+) -> tuple[dict[str, np.ndarray], dict[str, int]]:
+    """Decodes the DMX sounds of a WAD in one pass, optionally resampled to a common sample rate.
+    PC speaker sounds are all rendered in a single call, directly at the target sample rate.
+
+    Parameters
+    ----------
+    wad : WAD_file
+        WAD to read.
+    names : list[str], optional
+        Sound lumps to decode. Defaults to all the DS* sounds of the WAD.
+    samplerate : int, optional
+        Sample rate of the results, e.g. 22050, 44100 or 48000. Sounds keep their own rate if None.
+    dtype : str
+        "uint8", "int16" or "float32".
+    pc_speaker : bool
+        Also decode the DP* PC speaker sounds, when names is not given.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Samples of each sound, skipping the invalid ones.
+    dict[str, int]
+        Sample rate of each sound.
+    """
+
+    if dtype not in SAMPLE_DTYPES:
+        raise ValueError(f"Unsupported sample type: {dtype}. Use one of {SAMPLE_DTYPES}.")
+
+    if names is None:
+        names = (wad.sounds or []) + ((wad.pc_sounds or []) if pc_speaker else [])
+
+    decoded = {}
+    rates = {}
+    tones = {}
+    for name, lump in read_lumps(wad, names).items():
+        try:
+            if is_pc_speaker(lump):
+                tones[name] = decode_pc_speaker(lump, name)
+            else:
+                rates[name], decoded[name] = decode_dmx(lump, name)
+        except ValueError as exc:
+            logger.warning(exc)
+
+    if samplerate is not None:
+        to_resample = [name for name in decoded if rates[name] != samplerate]
+        resampled = resample_batch([decoded[x] for x in to_resample], [rates[x] for x in to_resample], samplerate)
+        decoded.update(zip(to_resample, resampled))
+        rates = {name: samplerate for name in rates}
+
+    pc_rate = samplerate or PCS_SAMPLERATE
+    decoded.update(zip(tones.keys(), render_pc_speaker(list(tones.values()), pc_rate)))
+    rates.update({name: pc_rate for name in tones})
+
+    sounds = {name: convert_samples(samples, dtype) for name, samples in decoded.items()}
+
+    logger.info(f"Decoded {len(sounds)} sounds.")
+    return sounds, rates
+
+
+def pack_sound_bank(sounds: dict[str, np.ndarray], output: str | BinaryIO, samplerate: int) -> None:
+    """Writes sounds of a common sample rate and type as a single bank, loaded back with one read.
+
+    A path ending with .npz is saved with NumPy: names, offsets, lengths, samplerate and the concatenated data.
+    Otherwise, a binary bank is written: header, table of (name, offset, length) and the concatenated PCM data."""
+
+    names = list(sounds.keys())
+    lengths = np.array([len(sounds[x]) for x in names], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    data = np.concatenate([sounds[x] for x in names]) if names else np.zeros(0, dtype=np.float32)
+    if data.dtype.name not in SAMPLE_DTYPES:
+        raise ValueError(f"Unsupported sample type: {data.dtype}.")
+
+    if isinstance(output, str) and output.endswith(".npz"):
+        np.savez(output, names=np.array(names), offsets=offsets, lengths=lengths,
+                 samplerate=samplerate, data=data)
+        return
+
+    header = BANK_HEADER.pack(BANK_ID, 1, samplerate, SAMPLE_DTYPES.index(data.dtype.name), len(names))
+    table = b"".join(BANK_ENTRY.pack(name.encode("ascii"), offset, length)
+                     for name, offset, length in zip(names, offsets.tolist(), lengths.tolist()))
+    chunks = [header, table, data.astype(data.dtype.newbyteorder("<")).tobytes()]
+    if isinstance(output, str):
+        with open(output, "wb") as f:
+            f.writelines(chunks)
+    else:
+        output.writelines(chunks)
+
+
+def load_sound_bank(path: str) -> tuple[dict[str, np.ndarray], int]:
+    """Loads a bank written by pack_sound_bank. The sounds are views on the data, read at once."""
+
+    if path.endswith(".npz"):
+        with np.load(path) as bank:
+            data, samplerate = bank["data"], int(bank["samplerate"])
+            names, offsets, lengths = bank["names"].tolist(), bank["offsets"].tolist(), bank["lengths"].tolist()
+    else:
+        with open(path, "rb") as f:
+            content = f.read()
+        bank_id, _, samplerate, dtype_idx, n_sounds = BANK_HEADER.unpack_from(content)
+        if bank_id != BANK_ID:
+            raise ValueError(f"Not a sound bank: {bank_id}")
+        table = [BANK_ENTRY.unpack_from(content, BANK_HEADER.size + i * BANK_ENTRY.size) for i in range(n_sounds)]
+        names = [x[0].rstrip(b"\0").decode("ascii") for x in table]
+        offsets, lengths = [x[1] for x in table], [x[2] for x in table]
+        data_start = BANK_HEADER.size + n_sounds * BANK_ENTRY.size
+        data = np.frombuffer(content, dtype=np.dtype(SAMPLE_DTYPES[dtype_idx]).newbyteorder("<"), offset=data_start)
+
+    return {name: data[o: o + n] for name, o, n in zip(names, offsets, lengths)}, samplerate
+
+
+if __name__ == "__main__":
+    from src.WADParser import open_wad_file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wad", "-w", type=str, help="Path to the WAD file", required=True)
+    parser.add_argument("--output", "-o", type=str, help="Sound bank, .npz or binary", default="output/sounds.bank")
+    parser.add_argument("--samplerate", "-sr", type=int, help="Sample rate of the bank", default=44100,
+                        choices=SAMPLE_RATES)
+    parser.add_argument("--dtype", "-t", type=str, help="Sample type", default="int16", choices=SAMPLE_DTYPES)
+    parser.add_argument("--pc_speaker", action="store_true", help="Also render the PC speaker sounds")
+
+    args = parser.parse_args()
+
+    wad = open_wad_file(args.wad)
+    sounds, _ = decode_sounds(wad, samplerate=args.samplerate, dtype=args.dtype, pc_speaker=args.pc_speaker)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    pack_sound_bank(sounds, args.output, args.samplerate)
+    logger.info(f"Packed {len(sounds)} sounds into {args.output}.")
+    for name, samples in sounds.items():
+        logger.info(f"{name}: {len(samples)} samples.")
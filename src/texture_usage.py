@@ -0,0 +1,129 @@
+import argparse
+import json
+from dataclasses import dataclass
+
+import numpy as np
+from loguru import logger
+
+from src.WADParser import WAD_file, open_wad_file
+
+"""Which textures and flats each map uses, from the upper / lower / middle textures of its sidedefs and the floor /
+ceiling flats of its sectors. The names of every map of a WAD are interned in one pass (np.unique), and counted
+per map with np.bincount. Useful to ship trimmed resource packs, or to render only the referenced assets.
+
+CLI use:
+
+python -m src.texture_usage -w <WAD file> -o <output JSON>
+"""
+
+# Names meaning "no texture".
+NO_TEXTURE = [b"-", b""]
+
+
+@dataclass
+class AssetUsage:
+    maps: list[str]
+    names: list[str]
+    # counts[i, j]: number of sidedef slots (or sector planes) of maps[i] using names[j].
+    counts: np.ndarray
+    # Column of each name in counts.
+    index: dict[str, int]
+
+    def maps_using(self, name: str) -> dict[str, int]:
+        """Maps using an asset, with the number of references in each."""
+        if name.upper() not in self.index:
+            return {}
+        return self._maps_using(self.index[name.upper()])
+
+    def _maps_using(self, j: int) -> dict[str, int]:
+        column = self.counts[:, j]
+        return {self.maps[i]: int(column[i]) for i in np.flatnonzero(column)}
+
+    def used_by(self, map_name: str) -> dict[str, int]:
+        """Assets used by a map, with their number of references."""
+        row = self.counts[self.maps.index(map_name)]
+        return {self.names[j]: int(row[j]) for j in np.flatnonzero(row)}
+
+    def totals(self) -> dict[str, int]:
+        """Number of references of each asset, in all the maps."""
+        return dict(zip(self.names, self.counts.sum(axis=0).tolist()))
+
+    def to_dict(self) -> dict:
+        return {
+            "by_name": {name: self._maps_using(j) for j, name in enumerate(self.names)},
+            "by_map": {map_name: self.used_by(map_name) for map_name in self.maps},
+        }
+
+
+def count_usage(maps: list[str], names_per_map: list[np.ndarray]) -> AssetUsage:
+    """Usage of the names (S8 arrays, one per map) by the maps. Names are compared case-insensitively."""
+    names = np.char.upper(np.concatenate(names_per_map)) if names_per_map else np.array([], dtype="S8")
+    map_ids = np.repeat(np.arange(len(maps)), [len(x) for x in names_per_map])
+
+    keep = ~np.isin(names, NO_TEXTURE)
+    unique, name_ids = np.unique(names[keep], return_inverse=True)
+    counts = np.bincount(
+        map_ids[keep] * len(unique) + name_ids.reshape(-1), minlength=len(maps) * len(unique)
+    ).reshape(len(maps), len(unique))
+    names = [x.decode("ascii", errors="replace") for x in unique]
+    return AssetUsage(maps, names, counts, {name: j for j, name in enumerate(names)})
+
+
+@dataclass
+class UsageIndex:
+    textures: AssetUsage
+    flats: AssetUsage
+
+    def unused(self, wad: WAD_file) -> dict[str, list[str]]:
+        """Textures and flats of the WAD that no map uses."""
+        return {
+            "textures": sorted(set(x.upper() for x in wad.textures or {}) - set(self.textures.names)),
+            "flats": sorted(set(x.upper() for x in wad.flats or []) - set(self.flats.names)),
+        }
+
+    def missing(self, wad: WAD_file) -> dict[str, list[str]]:
+        """Textures and flats used by the maps but not defined in the WAD (e.g. taken from the IWAD)."""
+        return {
+            "textures": sorted(set(self.textures.names) - set(x.upper() for x in wad.textures or {})),
+            "flats": sorted(set(self.flats.names) - set(x.upper() for x in wad.flats or [])),
+        }
+
+
+def usage_index(wad: WAD_file) -> UsageIndex:
+    """Textures and flats used by every map of a WAD."""
+    parsed_maps = {
+        name: parsed_map for name, parsed_map in (wad.maps or {}).items()
+        if parsed_map is not None and parsed_map.sidedefs is not None and parsed_map.sectors is not None
+    }
+    maps = list(parsed_maps.keys())
+    sidedefs = [x.sidedefs for x in parsed_maps.values()]
+    sectors = [x.sectors for x in parsed_maps.values()]
+
+    textures = count_usage(maps, [np.concatenate((x["upper"], x["lower"], x["middle"])) for x in sidedefs])
+    flats = count_usage(maps, [np.concatenate((x["floor"], x["ceiling"])) for x in sectors])
+    logger.info(f"{len(textures.names)} textures and {len(flats.names)} flats used in {len(maps)} maps.")
+    return UsageIndex(textures, flats)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wad", "-w", type=str, help="Path to WAD file", default="WADs/DOOM.WAD")
+    parser.add_argument("--output", "-o", type=str, help="Output JSON file", default="output/texture_usage.json")
+
+    args = parser.parse_args()
+    wad = open_wad_file(args.wad)
+    index = usage_index(wad)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "textures": index.textures.to_dict(),
+                "flats": index.flats.to_dict(),
+                "unused": index.unused(wad),
+                "missing": index.missing(wad),
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"Texture usage written to {args.output}.")
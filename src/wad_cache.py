@@ -0,0 +1,112 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+from loguru import logger
+
+from src.WADParser import SPOOL_THRESHOLD, WAD_file, spool_wad_data
+from src.WADViewer import WadViewer
+
+"""Process-wide cache of parsed WADs, keyed by the hash of their content, so that a WAD uploaded
+by several users (or uploaded again) is parsed only once. Entries are evicted least recently used first,
+once their estimated size exceeds the memory budget. Parsed WADs are only read after parsing:
+sessions share them and keep only the digest of their entry.
+Large WADs are spooled to memory-mapped temporary files: only their decoded structures stay in memory."""
+
+
+def wad_digest(data: bytes | BinaryIO) -> str:
+    """SHA-1 of WAD data, or of the content of a file object, read by blocks."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return hashlib.sha1(data).hexdigest()
+    hasher = hashlib.sha1()
+    data.seek(0)
+    for block in iter(lambda: data.read(1 << 20), b""):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+@dataclass
+class CachedWad:
+    digest: str
+    wad: WAD_file
+    viewer: WadViewer
+    # Estimated size of the parsed WAD, measured once before it is shared. Its caches are counted as they grow.
+    nbytes: int
+    # Derived artifacts shared by the sessions, e.g. the title picture.
+    extras: dict = field(default_factory=dict)
+
+
+class WadCache:
+    def __init__(self, max_bytes: int = 1024**3, spool_threshold: int = SPOOL_THRESHOLD):
+        """Parsed WADs shared by all the sessions, limited to max_bytes in total (estimated).
+        WADs larger than spool_threshold are parsed from memory-mapped temporary files."""
+        self.max_bytes = max_bytes
+        self.spool_threshold = spool_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per WAD being parsed, so that concurrent uploads of a same WAD parse it once.
+        self._loading = {}
+
+    def get(self, digest: str) -> CachedWad | None:
+        """Entry of a WAD already parsed, or None if it is not (or no longer) in the cache."""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+            return entry
+
+    def load(self, data: bytes | BinaryIO, digest: str | None = None) -> CachedWad:
+        """Entry of a WAD, parsed from its content (or a file object, e.g. an upload) if it is not in the cache yet."""
+        digest = digest or wad_digest(data)
+        entry = self.get(digest)
+        if entry is not None:
+            logger.info(f"WAD cache hit: {digest}")
+            return entry
+
+        with self._lock:
+            loading = self._loading.setdefault(digest, threading.Lock())
+        with loading:
+            entry = self.get(digest)
+            if entry is None:
+                wad = WAD_file(spool_wad_data(data, self.spool_threshold))
+                viewer = WadViewer(wad)
+                entry = CachedWad(digest, wad, viewer, viewer.memory_report()["total"])
+                with self._lock:
+                    self._entries[digest] = entry
+                    self._evict()
+                logger.info(f"WAD {digest} parsed and cached ({entry.nbytes / 1e6:.1f} MB).")
+        with self._lock:
+            self._loading.pop(digest, None)
+        return entry
+
+    def _evict(self) -> None:
+        # The most recent entry is always kept, even if it is larger than the budget on its own.
+        while len(self._entries) > 1 and self.size() > self.max_bytes:
+            digest, entry = self._entries.popitem(last=False)
+            # Background jobs of the entry (e.g. its prewarm job) would keep its viewer alive and growing.
+            for extra in entry.extras.values():
+                if hasattr(extra, "cancel"):
+                    extra.cancel()
+            logger.info(f"Evicted from the WAD cache: {digest}")
+
+    def size(self) -> int:
+        """Estimated size of the cached WADs and of their caches, in bytes. Extras are not counted."""
+        return sum(entry.nbytes + entry.viewer.cache_nbytes() for entry in list(self._entries.values()))
+
+    def memory_report(self) -> dict[str, dict]:
+        """Memory reports of the cached WADs and their viewers, keyed by digest."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return {entry.digest: entry.viewer.memory_report() for entry in entries}
+
+    def release_caches(self) -> int:
+        """Drops the decoded caches of every cached WAD. Returns the estimated number of bytes released."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return sum(entry.viewer.release_caches() for entry in entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,305 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from loguru import logger
+
+from src.WADParser import open_wad_file
+from src.parser_utils import find_wads
+from src.wad_cache import wad_digest
+
+"""SQLite index of a collection of WADs: directory entries with the hash of their content, texture definitions
+and map summaries, so that questions such as "which WADs contain MAP07 with more than 20k linedefs",
+"which WADs define STARTAN3" or "where is this sound duplicated" are answered without opening any WAD.
+
+WADs are parsed in parallel by a process pool, and written to the database by the main process.
+Updates are incremental: WADs with unchanged size and modification time are skipped, and WADs whose content
+hash did not change are not parsed again.
+
+CLI use:
+
+python -m src.wad_index -w <WAD files or folders> -d <database> -j <workers> [--prune]
+python -m src.wad_index -d <database> --map MAP07 --min_linedefs 20000
+python -m src.wad_index -d <database> --texture STARTAN3
+python -m src.wad_index -d <database> --duplicates DSPISTOL
+"""
+
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS wads (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    wad_type TEXT,
+    game_type TEXT,
+    n_lumps INTEGER,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS lumps (
+    wad_id INTEGER NOT NULL REFERENCES wads(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT
+);
+CREATE TABLE IF NOT EXISTS textures (
+    wad_id INTEGER NOT NULL REFERENCES wads(id) ON DELETE CASCADE,
+    lump TEXT NOT NULL,
+    name TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    patches TEXT
+);
+CREATE TABLE IF NOT EXISTS maps (
+    wad_id INTEGER NOT NULL REFERENCES wads(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    format TEXT,
+    vertices INTEGER,
+    linedefs INTEGER,
+    sidedefs INTEGER,
+    sectors INTEGER,
+    things INTEGER,
+    width REAL,
+    height REAL
+);
+CREATE INDEX IF NOT EXISTS lumps_wad ON lumps(wad_id);
+CREATE INDEX IF NOT EXISTS lumps_name ON lumps(name);
+CREATE INDEX IF NOT EXISTS lumps_sha1 ON lumps(sha1);
+CREATE INDEX IF NOT EXISTS textures_name ON textures(name);
+CREATE INDEX IF NOT EXISTS maps_name ON maps(name);
+"""
+
+
+def map_format(map_lumps: dict) -> str:
+    if "TEXTMAP" in map_lumps:
+        return "udmf"
+    return "hexen" if "BEHAVIOR" in map_lumps else "doom"
+
+
+def index_wad(wad_path: str, known_sha1: str | None = None) -> dict:
+    """Summary of a WAD for the index. A WAD whose content hash is known_sha1 is not parsed again:
+    only its file stats and hash are returned."""
+
+    stat = os.stat(wad_path)
+    with open(wad_path, "rb") as f:
+        sha1 = wad_digest(f)
+    record = {"path": os.path.abspath(wad_path), "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1}
+    if sha1 == known_sha1:
+        return record
+
+    wad = open_wad_file(wad_path)
+    try:
+        lumps = [
+            (idx, name, offset, size, hashlib.sha1(wad._lump_data(offset, size)).hexdigest() if size > 0 else None)
+            for idx, (name, offset, size) in enumerate(wad.lumps)
+        ]
+        textures = [
+            (lump, name, width, height, ",".join(x[0] for x in patches))
+            for lump, name, width, height, patches in wad.texture_definitions()
+        ]
+        maps = []
+        for name, parsed_map in (wad.maps or {}).items():
+            if parsed_map is None:
+                continue
+            maps.append((
+                name,
+                map_format(wad._maps_lumps[name]),
+                len(parsed_map.vertices),
+                len(parsed_map.linedefs),
+                len(parsed_map.sidedefs) if parsed_map.sidedefs is not None else None,
+                len(parsed_map.sectors) if parsed_map.sectors is not None else None,
+                len(parsed_map.things["all_things"]["x"]) if parsed_map.things else 0,
+                float(parsed_map.map_dims[0]),
+                float(parsed_map.map_dims[1]),
+            ))
+    finally:
+        wad.bytes.close()
+
+    record.update(wad_type=wad.wad_type, game_type=wad.game_type, lumps=lumps, textures=textures, maps=maps)
+    return record
+
+
+def _index_worker(wad_path: str, known_sha1: str | None) -> tuple[str, dict | None, str | None]:
+    """Pool entry point: never raises, so that one broken WAD does not stop the whole update."""
+    try:
+        return wad_path, index_wad(wad_path, known_sha1), None
+    except Exception as exc:
+        return wad_path, None, f"{type(exc).__name__}: {exc}"
+
+
+class WadIndex:
+    def __init__(self, db_path: str):
+        """Index of WADs stored in an SQLite database, created if needed."""
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, INDEX_VERSION):
+            raise ValueError(f"{db_path} is an index of version {version}, expected {INDEX_VERSION}.")
+        self.db.executescript(SCHEMA)
+        self.db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def update(self, paths: list[str], workers: int | None = None, prune: bool = False) -> dict[str, int]:
+        """Indexes the WADs found in paths (files or folders), skipping those that did not change.
+        With prune, WADs of the index that no longer exist on disk are removed.
+        Returns the number of WADs indexed, unchanged, failed and removed."""
+
+        counts = {"indexed": 0, "unchanged": 0, "failed": 0, "removed": 0}
+        known = {row["path"]: row for row in self.db.execute("SELECT path, size, mtime, sha1 FROM wads")}
+
+        todo = []
+        for wad_path in find_wads(paths):
+            stat = os.stat(wad_path)
+            row = known.get(os.path.abspath(wad_path))
+            if row is not None and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime_ns):
+                counts["unchanged"] += 1
+            else:
+                todo.append((wad_path, row["sha1"] if row is not None else None))
+        logger.info(f"{len(todo)} WADs to index, {counts['unchanged']} unchanged.")
+
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_index_worker, wad_path, sha1) for wad_path, sha1 in todo]
+                for future in as_completed(futures):
+                    wad_path, record, error = future.result()
+                    if error is not None:
+                        counts["failed"] += 1
+                        logger.warning(f"Unable to index {wad_path}: {error}")
+                    elif "lumps" not in record:
+                        # Touched, but with the same content.
+                        self.db.execute(
+                            "UPDATE wads SET size = ?, mtime = ? WHERE path = ?",
+                            (record["size"], record["mtime"], record["path"]),
+                        )
+                        counts["unchanged"] += 1
+                    else:
+                        self._store(record)
+                        counts["indexed"] += 1
+                    self.db.commit()
+
+        if prune:
+            removed = [path for path in known if not os.path.isfile(path)]
+            self.db.executemany("DELETE FROM wads WHERE path = ?", [(x,) for x in removed])
+            self.db.commit()
+            counts["removed"] = len(removed)
+
+        logger.info(
+            f"Index updated: {counts['indexed']} indexed, {counts['unchanged']} unchanged, "
+            f"{counts['failed']} failed, {counts['removed']} removed."
+        )
+        return counts
+
+    def _store(self, record: dict) -> None:
+        self.db.execute("DELETE FROM wads WHERE path = ?", (record["path"],))
+        wad_id = self.db.execute(
+            "INSERT INTO wads (path, size, mtime, sha1, wad_type, game_type, n_lumps, indexed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (record["path"], record["size"], record["mtime"], record["sha1"], record["wad_type"],
+             record["game_type"], len(record["lumps"]), time.time()),
+        ).lastrowid
+        self.db.executemany("INSERT INTO lumps VALUES (?, ?, ?, ?, ?, ?)", [(wad_id, *x) for x in record["lumps"]])
+        self.db.executemany("INSERT INTO textures VALUES (?, ?, ?, ?, ?, ?)",
+                            [(wad_id, *x) for x in record["textures"]])
+        self.db.executemany("INSERT INTO maps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(wad_id, *x) for x in record["maps"]])
+
+    def query(self, sql: str, params: tuple = ()) -> list[dict]:
+        """Rows of any SQL query on the index, as dicts."""
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    def find_maps(self, name: str | None = None, min_linedefs: int = 0, map_format: str | None = None) -> list[dict]:
+        """Maps of the indexed WADs, by name (SQL LIKE pattern), size and format ("doom", "hexen" or "udmf")."""
+        sql = "SELECT wads.path, maps.* FROM maps JOIN wads ON wads.id = maps.wad_id WHERE maps.linedefs >= ?"
+        params = [min_linedefs]
+        if name is not None:
+            sql += " AND maps.name LIKE ?"
+            params.append(name)
+        if map_format is not None:
+            sql += " AND maps.format = ?"
+            params.append(map_format)
+        return self.query(sql + " ORDER BY wads.path, maps.name", tuple(params))
+
+    def find_textures(self, name: str) -> list[dict]:
+        """Definitions of a texture (SQL LIKE pattern) in the indexed WADs."""
+        return self.query(
+            "SELECT wads.path, textures.* FROM textures JOIN wads ON wads.id = textures.wad_id "
+            "WHERE textures.name LIKE ? ORDER BY wads.path",
+            (name,),
+        )
+
+    def find_lumps(self, name: str) -> list[dict]:
+        """Directory entries of a lump (SQL LIKE pattern) in the indexed WADs."""
+        return self.query(
+            "SELECT wads.path, lumps.* FROM lumps JOIN wads ON wads.id = lumps.wad_id "
+            "WHERE lumps.name LIKE ? ORDER BY wads.path, lumps.idx",
+            (name,),
+        )
+
+    def find_duplicates(self, name: str | None = None, min_wads: int = 2) -> list[dict]:
+        """Lump contents found in at least min_wads WADs, optionally only for lumps named like name,
+        with the names and paths they are found under."""
+        sql = (
+            "SELECT lumps.sha1, lumps.size, COUNT(DISTINCT lumps.wad_id) AS n_wads, "
+            "GROUP_CONCAT(DISTINCT lumps.name) AS names, GROUP_CONCAT(DISTINCT wads.path) AS paths "
+            "FROM lumps JOIN wads ON wads.id = lumps.wad_id WHERE lumps.sha1 IS NOT NULL"
+        )
+        params = []
+        if name is not None:
+            sql += " AND lumps.sha1 IN (SELECT sha1 FROM lumps WHERE name LIKE ?)"
+            params.append(name)
+        sql += " GROUP BY lumps.sha1 HAVING n_wads >= ? ORDER BY n_wads DESC, lumps.size DESC"
+        params.append(min_wads)
+        return self.query(sql, tuple(params))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wad", "-w", type=str, nargs="+",
+                        help="WAD files or folders to index", default=None)
+    parser.add_argument("--database", "-d", type=str,
+                        help="SQLite database of the index", default="output/wads.sqlite")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of worker processes (defaults to the number of CPUs)", default=None)
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove the WADs that no longer exist from the index")
+    parser.add_argument("--map", type=str,
+                        help="Find maps by name (SQL LIKE pattern)", default=None)
+    parser.add_argument("--min_linedefs", type=int,
+                        help="Minimum number of linedefs of the maps found", default=0)
+    parser.add_argument("--texture", type=str,
+                        help="Find the WADs defining a texture", default=None)
+    parser.add_argument("--lump", type=str,
+                        help="Find the WADs containing a lump", default=None)
+    parser.add_argument("--duplicates", type=str,
+                        help="Find the lumps of this name whose content is in several WADs", default=None)
+
+    args = parser.parse_args()
+
+    index = WadIndex(args.database)
+    if args.wad:
+        index.update(args.wad, workers=args.jobs, prune=args.prune)
+
+    results = []
+    if args.map or args.min_linedefs:
+        results += index.find_maps(args.map, args.min_linedefs)
+    if args.texture:
+        results += index.find_textures(args.texture)
+    if args.lump:
+        results += index.find_lumps(args.lump)
+    if args.duplicates:
+        results += index.find_duplicates(args.duplicates)
+    for row in results:
+        logger.info(f"{row}")
+    index.close()
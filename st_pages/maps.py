@@ -1,26 +1,45 @@
 import streamlit as st
+from src.map_payload import map_viewer_html
 from src.palettes import MAP_CMAPS
 from loguru import logger
 
 
+@st.cache_data(max_entries=16, show_spinner=False)
+def map_viewer(_viewer, wad_digest: str, map_name: str, palette: str) -> str:
+    """HTML of the interactive viewer of a map, built once per WAD content, map and palette."""
+    return map_viewer_html(_viewer.get_map_payload(map_name), palette=palette, height=600)
+
+
 col1, col2, col3, col4 = st.columns(4)
 with col1:
     chosen_map = st.selectbox("Map", options=sorted(st.session_state["wad"].maps.keys()))
-with col2:
-    palette = st.selectbox("Palette", list(MAP_CMAPS.keys()), index=1)
 with col3:
-    things = st.selectbox("Things", ["None", "Dots"])
-    show_things = things == "Dots"
+    interactive = st.toggle("Interactive", value=True, help="Pan, zoom and change the layers in the browser")
+    if not interactive:
+        things = st.selectbox("Things", ["None", "Dots"])
+        show_things = things == "Dots"
+with col2:
+    # The interactive viewer has its own palette selector, changing it needs no rerun.
+    palette = list(MAP_CMAPS.keys())[1]
+    if not interactive:
+        palette = st.selectbox("Palette", list(MAP_CMAPS.keys()), index=1)
 with col4:
-    show_secrets = st.checkbox("Show Secrets")
-    show_specials = st.checkbox("Show Special", value=True)
+    if not interactive:
+        show_secrets = st.checkbox("Show Secrets")
+        show_specials = st.checkbox("Show Special", value=True)
 
-fig = st.session_state["viewer"].draw_map(
-    chosen_map,
-    palette=palette,
-    show_secrets=show_secrets,
-    show_specials=show_specials,
-    show_things=show_things,
-    scale=2,
-)
-st.pyplot(fig, use_container_width=True, format="png", dpi=150)
+if interactive:
+    # The geometry is sent once per map, the browser draws it: palette, layers, pan and zoom need no rerun.
+    html = map_viewer(st.session_state["viewer"], st.session_state["wad_digest"], chosen_map, palette)
+    st.components.v1.html(html, height=640)
+else:
+    # Only the first display of a map draws it: palette and layers changes recolor a cached raster.
+    map_img = st.session_state["viewer"].render_map(
+        chosen_map,
+        palette=palette,
+        show_secrets=show_secrets,
+        show_specials=show_specials,
+        show_things=show_things,
+        scale=2,
+    )
+    st.image(map_img, use_container_width=True)
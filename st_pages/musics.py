@@ -1,15 +1,23 @@
 import sys
 import streamlit as st
+from app_utils import get_session_store
 from src.WADPlayer import WinMIDIPlayer, MIDIWavConverter
-from src.mus2mid import Mus2Mid
-import os
+from src.render_cache import RenderCache
 
-if "music_path" not in st.session_state:
+if "music_extension" not in st.session_state:
     st.session_state["player"] = None
-    st.session_state["music_path"] = None
+    st.session_state["music_extension"] = None
     st.session_state["chosen_music"] = None
     st.session_state["current_music"] = None
 
+
+def close_player():
+    """Releases the synthesizer of the MIDI converter of this session, if any."""
+    if isinstance(st.session_state["player"], MIDIWavConverter):
+        st.session_state["player"].close()
+    st.session_state["player"] = None
+
+
 col1, col2, col3, col4 = st.columns([2, 1, 1, 1], vertical_alignment="bottom")
 
 music_names = st.session_state["wad"].musics
@@ -18,42 +26,40 @@ music_names = st.session_state["wad"].musics
 with col1:
     chosen_music = st.selectbox("Music", music_names)
 
-    if chosen_music != st.session_state["chosen_music"]:
-        music_path = st.session_state["wad"].export_music(chosen_music)
+    # Musics are kept in the store of this session, MUS being converted to MIDI. Wad files can contain midi, mp3, etc...
+    music_key = f"{st.session_state['wad_digest']}/musics/{chosen_music}"
+    if music_key != st.session_state["chosen_music"]:
+        music_data, music_extension = st.session_state["wad"].get_music_data(chosen_music, to_midi=True)
+        get_session_store().put(music_key, music_data)
+        st.session_state["music_extension"] = music_extension
+        st.session_state["chosen_music"] = music_key
 
-        # If the music is in MUS format, convert it to MIDI first
-        if music_path.endswith(".mus"):
-            m2m = Mus2Mid(music_path)
+music_extension = st.session_state["music_extension"]
+music_data = get_session_store().get_or_create(
+    music_key, lambda: st.session_state["wad"].get_music_data(chosen_music, to_midi=True)[0])
 
-            new_path = m2m.to_midi()
-            os.remove(music_path)
-            st.session_state["music_path"] = new_path
-        # Wad files can contain midi, mp3, etc...
-        else:
-            st.session_state["music_path"] = music_path
 
-        st.session_state["chosen_music"] = chosen_music
+def midi_file() -> str:
+    """MCI plays files only: the MIDI data is spilled to the directory of this session."""
+    return get_session_store().get_or_create(f"{music_key}.mid", lambda: music_data, as_file=True, suffix=".mid")
 
-# First, what is the music extension?
-if st.session_state["music_path"] is not None:
-    music_name, music_extension = os.path.splitext(
-        st.session_state["music_path"])
 
 # On Windows, use the WinMIDIPlayer class to play MIDI files
 # However we have to manage buttons ourself.
 if music_extension == ".mid" and sys.platform == "win32":
     if st.session_state["player"] is None:
         try:
-            st.session_state["player"] = WinMIDIPlayer(
-                st.session_state["music_path"])
+            st.session_state["player"] = WinMIDIPlayer(midi_file())
         except Exception as e:
             st.error(f"Error loading music: {e}.")
         st.session_state["current_music"] = chosen_music
 
     if st.session_state["current_music"] != chosen_music:
         st.session_state["player"].stop()
-        st.session_state["player"] = WinMIDIPlayer(
-            st.session_state["music_path"])
+        # The file of the previous music is deleted once its player is stopped.
+        previous_key = f"{st.session_state['wad_digest']}/musics/{st.session_state['current_music']}"
+        get_session_store().discard(f"{previous_key}.mid")
+        st.session_state["player"] = WinMIDIPlayer(midi_file())
         st.session_state["current_music"] = chosen_music
 
     with col2:
@@ -70,12 +76,26 @@ if music_extension == ".mid" and sys.platform == "win32":
             st.session_state["player"].stop()
 
 # On Linux/macOS: render MIDI to WAV with FluidSynth, play with st.audio
+# Renders are cached on disk, so reruns of the page do not synthesize the track again.
+# WADs with a GENMIDI lump can also be played with their own OPL instruments, without FluidSynth.
 elif music_extension == ".mid" and sys.platform != "win32":
+    wad = st.session_state["wad"]
+    genmidi = None
+    if "GENMIDI" in wad._misc_lumps:
+        with col3:
+            use_opl = st.toggle("OPL synth", help="Play with the GENMIDI instruments of the WAD")
+        if use_opl:
+            genmidi = wad._lump_data(*wad._misc_lumps["GENMIDI"])
+
     with st.spinner("Rendering MIDI to WAV..."):
         try:
-            player = MIDIWavConverter(st.session_state["music_path"])
-            wav_path = player.to_wav()
-            st.session_state["player"] = player
+            # One converter per session, kept while the synthesizer is the same: its SoundFont is loaded once.
+            player = st.session_state["player"]
+            if not isinstance(player, MIDIWavConverter) or player.genmidi != genmidi:
+                close_player()
+                player = MIDIWavConverter(cache=RenderCache(), genmidi=genmidi)
+                st.session_state["player"] = player
+            wav_path = player.render_wav(music_data)
             with col2:
                 st.audio(wav_path)
         except Exception as e:
@@ -83,9 +103,9 @@ elif music_extension == ".mid" and sys.platform != "win32":
 
 # For OGG and MP3 files, just use st.audio to play them
 elif music_extension in [".ogg", ".mp3"]:
-    st.session_state["player"] = None
+    close_player()
     with col2:
-        st.audio(st.session_state["music_path"])
+        st.audio(music_data, format=f"audio/{music_extension[1:]}")
 
 else:
     st.error(f"Unsupported music format: {music_extension}")
@@ -1,22 +1,21 @@
 import streamlit as st
 
-import os
-from loguru import logger
+from app_utils import get_session_store
 
 
 if "chosen_sound" not in st.session_state:
     st.session_state["chosen_sound"] = None
-    st.session_state["sound_path"] = None
 
-sound_list = st.session_state["wad"].sounds
+wad = st.session_state["wad"]
+sound_list = wad.sounds
 
 col1, col2 = st.columns(2, vertical_alignment="bottom")
 with col1:
     chosen_sound = st.selectbox("Sound", sound_list)
-    sound_path = f"output/{chosen_sound}.wav"
-    if chosen_sound + ".wav" not in os.listdir("output"):
-        sound_path = st.session_state["wad"].export_sound(chosen_sound)
-    st.session_state["sound_path"] = sound_path
+    st.session_state["chosen_sound"] = chosen_sound
 
 with col2:
-    st.audio(st.session_state["sound_path"])
+    # Sounds are converted to WAV once, and kept in the store of this session.
+    sound_key = f"{st.session_state['wad_digest']}/sounds/{chosen_sound}"
+    wav_data = get_session_store().get_or_create(sound_key, lambda: wad.get_sound_wav(chosen_sound))
+    st.audio(wav_data, format="audio/wav")
@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+
+from benchmarks.synthetic_wad import SyntheticWadSpec, generate_wad
+from src.WADParser import WAD_file
+from src.map_parser import ParsedMap
+from src.map_payload import (
+    LINE_LAYERS,
+    MAP_PAYLOAD_ID,
+    MAP_PAYLOAD_VERSION,
+    PAYLOAD_HEADER,
+    decode_map_geometry,
+    encode_map_geometry,
+)
+
+
+def synthetic_map(map_format: str = "doom") -> ParsedMap:
+    wad = WAD_file(io.BytesIO(generate_wad(SyntheticWadSpec(map_format=map_format, n_maps=1, grid_size=6))))
+    return wad.maps["MAP01"]
+
+
+def test_header_layout():
+    parsed_map = synthetic_map()
+    payload = encode_map_geometry(parsed_map)
+
+    map_id, version, index_size, scale, center_x, center_y, n_vertices, *counts, n_things = (
+        PAYLOAD_HEADER.unpack_from(payload))
+    assert (map_id, version, index_size, scale) == (MAP_PAYLOAD_ID, MAP_PAYLOAD_VERSION, 2, 1.0)
+    x_min, x_max, y_min, y_max = parsed_map.map_lims
+    assert (center_x, center_y) == (round((x_min + x_max) / 2), round((y_min + y_max) / 2))
+    assert counts == [len(getattr(parsed_map, x)) for x in LINE_LAYERS]
+    assert n_things == len(parsed_map.things["all_things"]["x"])
+
+    # Every block starts on 4 bytes, and the blocks fill the payload.
+    blocks = [PAYLOAD_HEADER.size, n_vertices * 2 * 2, sum(counts) * 2 * index_size, n_things * 2 * 2]
+    assert all(x % 4 == 0 for x in blocks)
+    assert len(payload) == sum(blocks)
+
+
+def test_round_trip():
+    for map_format in ["doom", "hexen", "udmf"]:
+        parsed_map = synthetic_map(map_format)
+        decoded = decode_map_geometry(encode_map_geometry(parsed_map))
+        # Doom coordinates are integers that fit in int16: they are encoded exactly.
+        for layer in LINE_LAYERS:
+            np.testing.assert_array_equal(decoded[layer], getattr(parsed_map, layer).reshape(-1, 2, 2))
+        things = parsed_map.things["all_things"]
+        np.testing.assert_array_equal(decoded["things"], np.column_stack((things["x"], things["y"])))
+
+
+def test_large_coordinates_fit_int16():
+    parsed_map = ParsedMap()
+    parsed_map.block = np.array([[[0, 0], [1000, 0]], [[1000, 0], [1000, 1000]]], dtype=np.float64)
+    parsed_map.map_lims = (0, 1000, 0, 1000)
+    # Things far outside the map lines.
+    parsed_map.things = {"all_things": {"x": [500, 90000], "y": [500, -90000]}}
+
+    payload = encode_map_geometry(parsed_map)
+    assert PAYLOAD_HEADER.unpack_from(payload)[3] < 1.0
+    decoded = decode_map_geometry(payload)
+    np.testing.assert_allclose(decoded["things"], [[500, 500], [90000, -90000]], atol=2)
+    np.testing.assert_allclose(decoded["block"], parsed_map.block, atol=2)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_wad import make_mus
+from src.midi_events import decode_midi
+from src.mus2mid import MIDI_ID, mus2mid
+from src.music_decoder import decode_mus, decode_music
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_mus2mid_round_trip(seed):
+    """The MIDI written by mus2mid decodes to the events decode_mus reads from the MUS data."""
+    mus_data = make_mus(np.random.default_rng(seed), 500)
+    midi_data = mus2mid(mus_data)
+    assert midi_data[:4] == MIDI_ID
+
+    from_mus = decode_mus(mus_data)
+    from_midi = decode_midi(midi_data)
+    assert len(from_mus.events) == len(from_midi.events) > 0
+    for field in from_mus.events.dtype.names:
+        np.testing.assert_array_equal(from_mus.events[field], from_midi.events[field], err_msg=field)
+    assert from_mus.duration == pytest.approx(from_midi.duration)
+
+
+def test_truncated_mus():
+    mus_data = make_mus(np.random.default_rng(0), 500)
+    with pytest.raises(ValueError):
+        mus2mid(mus_data[: len(mus_data) // 2])
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decode_music(b"RIFF" + bytes(16))
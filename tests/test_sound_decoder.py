@@ -0,0 +1,48 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.sound_decoder import BANK_HEADER, BANK_ID, SAMPLE_DTYPES, load_sound_bank, pack_sound_bank
+
+
+def make_sounds(dtype: str) -> dict[str, np.ndarray]:
+    rng = np.random.default_rng(0)
+    sounds = {}
+    for name, length in [("DSPISTOL", 1000), ("DSEMPTY", 0), ("DSSHOTGN", 2501)]:
+        samples = rng.uniform(-1, 1, length)
+        if dtype == "uint8":
+            samples = (samples * 127 + 128).astype(np.uint8)
+        elif dtype == "int16":
+            samples = (samples * 32767).astype(np.int16)
+        sounds[name] = samples.astype(dtype)
+    return sounds
+
+
+@pytest.mark.parametrize("dtype", SAMPLE_DTYPES)
+@pytest.mark.parametrize("suffix", [".npz", ".bank"])
+def test_sound_bank_round_trip(tmp_path, dtype, suffix):
+    sounds = make_sounds(dtype)
+    path = str(tmp_path / f"sounds{suffix}")
+    pack_sound_bank(sounds, path, 44100)
+
+    loaded, samplerate = load_sound_bank(path)
+    assert samplerate == 44100
+    assert list(loaded) == list(sounds)
+    for name, samples in sounds.items():
+        assert loaded[name].dtype == samples.dtype
+        np.testing.assert_array_equal(loaded[name], samples)
+
+
+def test_binary_bank_header():
+    sounds = make_sounds("int16")
+    buffer = io.BytesIO()
+    pack_sound_bank(sounds, buffer, 11025)
+
+    bank_id, _, samplerate, dtype_idx, n_sounds = BANK_HEADER.unpack_from(buffer.getvalue())
+    assert (bank_id, samplerate, SAMPLE_DTYPES[dtype_idx], n_sounds) == (BANK_ID, 11025, "int16", len(sounds))
+
+
+def test_unsupported_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        pack_sound_bank({"DSPISTOL": np.zeros(4, dtype=np.int32)}, str(tmp_path / "sounds.bank"), 11025)
@@ -0,0 +1,58 @@
+import os
+
+from benchmarks.synthetic_wad import SyntheticWadSpec, generate_wad
+from src.wad_index import WadIndex
+
+
+def write_wad(path, **spec) -> str:
+    with open(path, "wb") as f:
+        f.write(generate_wad(SyntheticWadSpec(n_maps=2, grid_size=4, **spec)))
+    return str(path)
+
+
+def test_update_and_query(tmp_path):
+    wads_dir = tmp_path / "wads"
+    wads_dir.mkdir()
+    doom_path = write_wad(wads_dir / "doom.wad")
+    write_wad(wads_dir / "udmf.wad", map_format="udmf", seed=1)
+
+    index = WadIndex(str(tmp_path / "index.db"))
+    try:
+        counts = index.update([str(wads_dir)], workers=1)
+        assert (counts["indexed"], counts["unchanged"], counts["failed"]) == (2, 0, 0)
+
+        # A 4 x 4 grid of rooms has 2 * 4 * 5 walls.
+        maps = index.find_maps("MAP%", min_linedefs=40)
+        assert len(maps) == 4
+        assert {x["format"] for x in maps} == {"doom", "udmf"}
+        assert index.find_maps(min_linedefs=41) == []
+        assert [x["format"] for x in index.find_maps("MAP01", map_format="udmf")] == ["udmf"]
+
+        assert len(index.find_textures("TEX00000")) == 2
+        assert len(index.find_lumps("PLAYPAL")) == 2
+        # Both WADs share the same palette.
+        duplicates = index.find_duplicates("PLAYPAL")
+        assert len(duplicates) == 1 and duplicates[0]["n_wads"] == 2
+
+        # Unchanged files are not indexed again, removed ones are pruned.
+        assert index.update([str(wads_dir)], workers=1)["unchanged"] == 2
+        os.remove(doom_path)
+        counts = index.update([str(wads_dir)], workers=1, prune=True)
+        assert (counts["unchanged"], counts["removed"]) == (1, 1)
+        assert {os.path.basename(x["path"]) for x in index.find_lumps("PLAYPAL")} == {"udmf.wad"}
+    finally:
+        index.close()
+
+
+def test_reindex_changed_file(tmp_path):
+    path = write_wad(tmp_path / "test.wad")
+    index = WadIndex(str(tmp_path / "index.db"))
+    try:
+        index.update([path], workers=1)
+        write_wad(tmp_path / "test.wad", n_textures=16)
+        os.utime(path, ns=(0, 1))
+        assert index.update([path], workers=1)["indexed"] == 1
+        assert index.find_textures("TEX00100") == []
+        assert len(index.find_textures("TEX00010")) == 1
+    finally:
+        index.close()